@@ -5,8 +5,13 @@ header('Pragma: no-cache');
 class InputException extends Exception {}
 class InternalServerError extends Exception {}
 class APICallException extends Exception {}
+class CircuitOpenException extends APICallException {}
+class DeadlineExceededException extends APICallException {}
 
-# TODO: Save data locally if a POST request fails
+# From the command line, paths are relative to this script, as they are when it is served
+if (PHP_SAPI === 'cli') {
+    chdir(__DIR__);
+}
 
 if (file_exists('.private/systeme-io-config.php')) {
     require_once '.private/systeme-io-config.php';
@@ -15,7 +20,168 @@ if (file_exists('.private/systeme-io-config.php')) {
     define('API_KEY', getenv('API_KEY') ?: null);
 }
 
-if ($_SERVER['REQUEST_METHOD'] === 'POST') {
+# Tag IDs are cached for this many seconds, since tags are defined ahead of time and almost never change.
+# Set to 0 to look up every tag on every submission.
+if (!defined('TAG_CACHE_TTL')) {
+    define('TAG_CACHE_TTL', getenv('TAG_CACHE_TTL') !== false ? (int)getenv('TAG_CACHE_TTL') : 3600);
+}
+
+# Valid submissions that cannot be sent to the API are appended to this file, and sent later by draining it.
+# With 'fallback', a submission is spooled only if the API fails. With 'always', every submission is spooled
+# and the visitor never waits for the API. With 'off', a failing submission is an error.
+if (!defined('SPOOL_FILE')) {
+    define('SPOOL_FILE', getenv('SPOOL_FILE') ?: '.private/systeme-io-spool.jsonl');
+}
+if (!defined('SPOOL_MODE')) {
+    define('SPOOL_MODE', getenv('SPOOL_MODE') ?: 'fallback');
+}
+# A POST request with this token in an X-Drain-Token header drains the spool, for hosts where cron can only fetch URLs.
+# Draining over HTTP is disabled if it is not set. The token also allows the switches of the diagnostic page.
+if (!defined('SPOOL_DRAIN_TOKEN')) {
+    define('SPOOL_DRAIN_TOKEN', getenv('SPOOL_DRAIN_TOKEN') ?: null);
+}
+# The drain replays this many submissions at a time, and stops early if a whole batch fails
+define('SPOOL_DRAIN_BATCH_SIZE', 20);
+# A submission that has failed this many times is moved to the poison file instead of being retried
+define('SPOOL_MAX_ATTEMPTS', 10);
+
+# Errors are reported to a Slack channel, if SLACK_TOKEN is set. Errors are counted and reported together, in at most
+# one message every SLACK_NOTIFY_INTERVAL seconds, so that an outage does not flood the channel. SLACK_MENTION,
+# e.g. '<!here>', is put in front of each message.
+if (!defined('SLACK_API_URL')) {
+    define('SLACK_API_URL', getenv('SLACK_API_URL') ?: 'https://slack.com');
+}
+if (!defined('SLACK_TOKEN')) {
+    define('SLACK_TOKEN', getenv('SLACK_TOKEN') ?: null);
+}
+if (!defined('SLACK_CHANNEL')) {
+    define('SLACK_CHANNEL', getenv('SLACK_CHANNEL') ?: '#api-errors');
+}
+if (!defined('SLACK_MENTION')) {
+    define('SLACK_MENTION', getenv('SLACK_MENTION') ?: '');
+}
+if (!defined('SLACK_NOTIFY_INTERVAL')) {
+    define('SLACK_NOTIFY_INTERVAL', (int)(getenv('SLACK_NOTIFY_INTERVAL') ?: 300));
+}
+# A message quotes at most this many different errors
+define('SLACK_SAMPLE_ERRORS', 5);
+# Errors that have not been reported yet: how many, since when, a sample of their messages,
+# and when the last message was sent
+define('NO_PENDING_ERRORS', ['count' => 0, 'since' => null, 'samples' => [], 'sentAt' => 0]);
+
+# How a submission finds out whether the contact exists. With 'lookup-first', the contact is looked up, then added
+# if it is not found. With 'create-first', the contact is added, and only looked up if systeme.io answers that the
+# email is taken, which saves a call for new contacts and costs one for returning contacts.
+if (!defined('UPSERT_STRATEGY')) {
+    define('UPSERT_STRATEGY', getenv('UPSERT_STRATEGY') ?: 'lookup-first');
+}
+
+# For tests: pass the X-Test-Run header of a request on to the API mock, which keeps separate state per test run.
+# The tag cache, the circuit breaker and the spool are then kept per test run too. Tests may also pick the upsert
+# strategy of a submission with an X-Upsert-Strategy header.
+if (!defined('FORWARD_TEST_RUN')) {
+    define('FORWARD_TEST_RUN', (bool)getenv('FORWARD_TEST_RUN'));
+}
+
+# At most this many API calls are made at the same time, e.g. when assigning several tags
+define('MAX_PARALLEL_API_CALLS', 4);
+
+# Calls that are safe to repeat are made up to this many times if the API fails or asks to slow down.
+# The delay before each retry is drawn at random up to the base delay doubled for each attempt, or is what
+# a Retry-After header asks for. Calls are not retried if that would mean waiting longer than the max delay.
+define('API_MAX_ATTEMPTS', 3);
+define('API_RETRY_BASE_DELAY', 0.2);
+define('API_RETRY_MAX_DELAY', 2);
+
+# A submission has this many seconds from when the request arrived until the visitor is redirected. Each API call
+# gets what is left of it, less DEADLINE_RESERVE, as its timeout, and no call is started or retried without at least
+# API_MIN_CALL_TIME of it left; the submission is then spooled and the visitor redirected, as when the API fails.
+# The reserve is for spooling and for reporting the error. Set to 0 to give each call API_CALL_TIMEOUT instead.
+# Drains and imports have no deadline.
+if (!defined('SUBMISSION_DEADLINE')) {
+    define('SUBMISSION_DEADLINE', getenv('SUBMISSION_DEADLINE') !== false ? (float)getenv('SUBMISSION_DEADLINE') : 8);
+}
+define('DEADLINE_RESERVE', 1);
+define('API_MIN_CALL_TIME', 0.1);
+define('API_CALL_TIMEOUT', 10);
+define('API_CONNECT_TIMEOUT', 3);
+
+# After this many failed API calls in a row, calls fail at once without being made until the circuit breaker
+# has been open for a while. Then one request gets to try the API again, and closes the breaker if it succeeds.
+define('CIRCUIT_BREAKER_THRESHOLD', 5);
+if (!defined('CIRCUIT_BREAKER_OPEN_SECONDS')) {
+    define('CIRCUIT_BREAKER_OPEN_SECONDS', (int)(getenv('CIRCUIT_BREAKER_OPEN_SECONDS') ?: 30));
+}
+
+# The diagnostic page probes the API with this many calls if asked to with ?probe, or with ?probe&samples=N up to the max.
+# The probe stops after PROBE_TIME_LIMIT seconds.
+define('PROBE_SAMPLES', 5);
+define('PROBE_MAX_SAMPLES', 20);
+define('PROBE_TIME_LIMIT', 5);
+
+# An import sends the contacts of this many rows at a time, and saves a checkpoint after each batch
+define('IMPORT_BATCH_SIZE', 50);
+# An import makes up to this many API calls at the same time. It halves the number whenever the API asks it
+# to slow down, and raises it by one after each round of calls where the API did not.
+define('IMPORT_MAX_CONCURRENCY', 16);
+# Rows that are still rate limited after this many rounds count as failed
+define('IMPORT_MAX_ROUNDS', 5);
+
+if (PHP_SAPI === 'cli') {
+    $command = $argv[1] ?? '';
+    if ($command === 'drain') {
+        # Drain the spool, e.g. from cron: php add-systeme-io-contact.php drain [max submissions]
+        echo json_encode(drainSpool(isset($argv[2]) ? (int)$argv[2] : PHP_INT_MAX)) . "\n";
+    } elseif ($command === 'import' && isset($argv[2])) {
+        # Import contacts from a CSV or JSON lines file: php add-systeme-io-contact.php import <file> [options]
+        $options = ['concurrency' => MAX_PARALLEL_API_CALLS, 'max' => PHP_INT_MAX, 'restart' => false];
+        foreach (array_slice($argv, 3) as $arg) {
+            if (preg_match('/^--(concurrency|max)=(\d+)$/', $arg, $matches)) {
+                $options[$matches[1]] = (int)$matches[2];
+            } elseif ($arg === '--restart') {
+                $options['restart'] = true;
+            } else {
+                fwrite(STDERR, "Unknown option: $arg\n");
+                exit(2);
+            }
+        }
+        $data = @file_get_contents($argv[2]);
+        if ($data === false) {
+            fwrite(STDERR, "Could not read $argv[2]\n");
+            exit(1);
+        }
+        try {
+            $summary = importContacts($data, $options['concurrency'], $options['max'], $options['restart']);
+        } catch (InputException $e) {
+            fwrite(STDERR, $e->getMessage() . "\n");
+            exit(1);
+        }
+        echo json_encode($summary, JSON_UNESCAPED_UNICODE | JSON_UNESCAPED_SLASHES) . "\n";
+        exit(isset($summary['stopped']) ? 1 : 0);
+    } else {
+        fwrite(STDERR, "Usage: php add-systeme-io-contact.php drain [max submissions]\n"
+            . "       php add-systeme-io-contact.php import <CSV or JSON lines file> [--concurrency=N] [--max=N] [--restart]\n");
+        exit(2);
+    }
+} elseif ($_SERVER['REQUEST_METHOD'] === 'POST' && isset($_SERVER['HTTP_X_DRAIN_TOKEN'])) {
+    if (!hasDrainToken()) {
+        header("HTTP/1.1 403 Forbidden");
+    } elseif (isset($_GET['import'])) {
+        # The same token lets the contacts in the request body be imported, where there is no shell
+        try {
+            $summary = importContacts(file_get_contents('php://input'), (int)($_GET['concurrency'] ?? MAX_PARALLEL_API_CALLS),
+                (int)($_GET['max'] ?? PHP_INT_MAX), isset($_GET['restart']));
+            header('Content-Type: application/json');
+            echo json_encode($summary, JSON_UNESCAPED_UNICODE | JSON_UNESCAPED_SLASHES);
+        } catch (InputException $e) {
+            header("HTTP/1.1 400 Bad Request");
+            echo $e->getMessage();
+        }
+    } else {
+        header('Content-Type: application/json');
+        echo json_encode(drainSpool((int)($_GET['max'] ?? PHP_INT_MAX)));
+    }
+} elseif ($_SERVER['REQUEST_METHOD'] === 'POST') {
     if (!API_BASE_URL || !API_KEY) {
         # Misconfigured; redirect to a GET request to self, which will run a diagnose
         header("HTTP/1.1 303");
@@ -31,12 +197,14 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
         } catch (InternalServerError $e) {
             header("HTTP/1.1 500 Internal Server Error");
             echo $e->getMessage();
+            notifyError($e->getMessage());
         } catch (APICallException $e) {
             header("HTTP/1.1 500 Internal Server Error");
             echo $e->getMessage();
         } catch (Exception $e) {
             header("HTTP/1.1 500 Internal Server Error");
             echo $e->getMessage();
+            notifyError($e->getMessage());
         }
     }
 } elseif ($_SERVER['REQUEST_METHOD'] === 'GET') {
@@ -45,77 +213,306 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
     header("HTTP/1.1 405 Method Not Allowed");
 }
 
-function postToAPI($url, $data) {
-    $data_string = json_encode($data);
-    $ch = curl_init($url);
-    if ($ch === false) {
-        throw new InternalServerError('curl_init failed');
+// All API calls in a request go through one curl multi handle, which keeps its connections to the API alive
+// between calls. Where the API speaks HTTP/2, concurrent calls are multiplexed on a single connection.
+function getAPIClient() {
+    static $mh = null;
+    if ($mh === null) {
+        $mh = curl_multi_init();
+        curl_multi_setopt($mh, CURLMOPT_PIPELINING, CURLPIPE_MULTIPLEX);
+        curl_multi_setopt($mh, CURLMOPT_MAX_HOST_CONNECTIONS, MAX_PARALLEL_API_CALLS);
     }
-    curl_setopt($ch, CURLOPT_CUSTOMREQUEST, 'POST');
-    curl_setopt($ch, CURLOPT_POSTFIELDS, $data_string);
-    curl_setopt($ch, CURLOPT_RETURNTRANSFER, true);
-    curl_setopt($ch, CURLOPT_TIMEOUT, 10);
-    curl_setopt($ch, CURLOPT_HTTPHEADER, [
-        'Content-Type: application/json',
-        'Content-Length: ' . strlen($data_string),
-        'X-API-Key: ' . API_KEY,
-    ]);
-    $result = curl_exec($ch);
-    if ($result === false) {
-        $error = curl_error($ch);
-        curl_close($ch);
-        throw new APICallException('curl_exec failed: ' . $error);
+    return $mh;
+}
+
+// Return a curl share handle that keeps connections and DNS lookups alive across requests
+// served by the same PHP process, or null where this is not supported (before PHP 8.5)
+function getPersistentShare() {
+    static $sh = false;
+    if ($sh === false) {
+        $sh = function_exists('curl_share_init_persistent')
+            ? curl_share_init_persistent([CURL_LOCK_DATA_CONNECT, CURL_LOCK_DATA_DNS, CURL_LOCK_DATA_SSL_SESSION])
+            : null;
     }
-    $status = curl_getinfo($ch, CURLINFO_HTTP_CODE);
-    curl_close($ch);
-    return [$status, json_decode($result)];
+    return $sh;
 }
 
-function patchToAPI($url, $data) {
-    $data_string = json_encode($data);
+// Return the time, as from microtime(true), by which the current submission, or probe, has to be done, or null if
+// it has no deadline. $deadline sets it.
+function submissionDeadline($deadline = null) {
+    static $current = null;
+    if ($deadline !== null) {
+        $current = $deadline;
+    }
+    return $current;
+}
+
+// Return $timeout, or the seconds left until $reserve seconds before the submission deadline if that is sooner
+function limitTimeout($timeout, $reserve = 0) {
+    $deadline = submissionDeadline();
+    return $deadline === null ? $timeout : min($timeout, $deadline - $reserve - microtime(true));
+}
+
+// Return true if an API call can still be started after waiting $wait seconds, without running into the reserve
+// at the end of the submission deadline
+function hasTimeForAPICall($wait = 0) {
+    return limitTimeout(API_CALL_TIMEOUT, DEADLINE_RESERVE) >= $wait + API_MIN_CALL_TIME;
+}
+
+// Create a curl handle for an API call. $data is sent as JSON unless the method is GET.
+function createAPIRequest($method, $url, $data = null) {
     $ch = curl_init($url);
     if ($ch === false) {
         throw new InternalServerError('curl_init failed');
     }
-    curl_setopt($ch, CURLOPT_CUSTOMREQUEST, 'PATCH');
-    curl_setopt($ch, CURLOPT_POSTFIELDS, $data_string);
+    $headers = [];
+    if ($method != 'GET') {
+        $data_string = json_encode($data);
+        curl_setopt($ch, CURLOPT_CUSTOMREQUEST, $method);
+        curl_setopt($ch, CURLOPT_POSTFIELDS, $data_string);
+        $headers[] = 'Content-Type: ' . ($method == 'PATCH' ? 'application/merge-patch+json' : 'application/json');
+        $headers[] = 'Content-Length: ' . strlen($data_string);
+    }
+    $headers[] = 'X-API-Key: ' . API_KEY;
+    $testRun = getTestRun();
+    if ($testRun !== null) {
+        $headers[] = "X-Test-Run: $testRun";
+    }
     curl_setopt($ch, CURLOPT_RETURNTRANSFER, true);
-    curl_setopt($ch, CURLOPT_TIMEOUT, 10);
-    curl_setopt($ch, CURLOPT_HTTPHEADER, [
-        'Content-Type: application/merge-patch+json',
-        'Content-Length: ' . strlen($data_string),
-        'X-API-Key: ' . API_KEY,
-    ]);
-    $result = curl_exec($ch);
-    if ($result === false) {
-        $error = curl_error($ch);
-        curl_close($ch);
+    $timeout = limitTimeout(API_CALL_TIMEOUT, DEADLINE_RESERVE);
+    curl_setopt($ch, CURLOPT_TIMEOUT_MS, max(1, (int)($timeout * 1000)));
+    curl_setopt($ch, CURLOPT_CONNECTTIMEOUT_MS, max(1, (int)(min(API_CONNECT_TIMEOUT, $timeout) * 1000)));
+    curl_setopt($ch, CURLOPT_HTTPHEADER, $headers);
+    // Prefer HTTP/2 over TLS, and wait for a connection that can be multiplexed rather than opening another one
+    curl_setopt($ch, CURLOPT_HTTP_VERSION, CURL_HTTP_VERSION_2TLS);
+    curl_setopt($ch, CURLOPT_PIPEWAIT, true);
+    $sh = getPersistentShare();
+    if ($sh) {
+        curl_setopt($ch, CURLOPT_SHARE, $sh);
+    }
+    return $ch;
+}
+
+// Make an API call and return the status and the decoded response
+function callAPI($method, $url, $data = null) {
+    [[$status, $response, $error]] = callAPIConcurrently([[$method, $url, $data]]);
+    if ($error) {
         throw new APICallException('curl_exec failed: ' . $error);
     }
-    $status = curl_getinfo($ch, CURLINFO_HTTP_CODE);
-    curl_close($ch);
-    return [$status, json_decode($result)];
+    return [$status, $response];
+}
+
+function postToAPI($url, $data) {
+    return callAPI('POST', $url, $data);
+}
+
+function patchToAPI($url, $data) {
+    return callAPI('PATCH', $url, $data);
 }
 
 function getFromAPI($url) {
-    $ch = curl_init($url);
-    if ($ch === false) {
-        throw new InternalServerError('curl_init failed');
+    return callAPI('GET', $url);
+}
+
+// Make independent API calls concurrently, at most MAX_PARALLEL_API_CALLS at a time, and retry those that fail
+// and are safe to repeat. $calls maps keys to [$method, $url, $data]. Return the same keys mapped to
+// [$status, $response, $error], where $error is null if the call was made, or the curl error if it failed.
+// $rateLimited is increased by the number of times the API asked to slow down.
+// Throw CircuitOpenException if the API is known to be down, or DeadlineExceededException if the submission
+// deadline leaves no time for some of the calls.
+function callAPIConcurrently($calls, $maxParallel = MAX_PARALLEL_API_CALLS, &$rateLimited = 0) {
+    $results = [];
+    for ($attempt = 1; $calls; $attempt++) {
+        if (!isCircuitClosed()) {
+            throw new CircuitOpenException('API is unavailable');
+        }
+        $retries = [];
+        $delay = 0;
+        $sent = sendAPICalls($calls, $maxParallel);
+        foreach ($sent as $key => [$status, $response, $error, $retryAfter]) {
+            if ($status == 429) {
+                $rateLimited++;
+            }
+            $failed = $error || $status >= 500;
+            recordAPICallResult($failed);
+            [$method, $url] = $calls[$key];
+            $retryable = $status == 429 || ($failed && isIdempotentAPICall($method, $url));
+            $wait = $retryAfter ?? mt_rand() / mt_getrandmax() * API_RETRY_BASE_DELAY * 2 ** ($attempt - 1);
+            if ($retryable && $attempt < API_MAX_ATTEMPTS && $wait <= API_RETRY_MAX_DELAY && hasTimeForAPICall($wait)) {
+                $retries[$key] = $calls[$key];
+                $delay = max($delay, $wait);
+            } else {
+                $results[$key] = [$status, $response, $error];
+            }
+        }
+        if (count($sent) < count($calls)) {
+            throw new DeadlineExceededException('Submission deadline of ' . SUBMISSION_DEADLINE . 's exceeded');
+        }
+        $calls = $retries;
+        if ($calls) {
+            usleep((int)($delay * 1000000));
+        }
     }
-    curl_setopt($ch, CURLOPT_RETURNTRANSFER, true);
-    curl_setopt($ch, CURLOPT_TIMEOUT, 10);
-    curl_setopt($ch, CURLOPT_HTTPHEADER, [
-        'X-API-Key: ' . API_KEY,
-    ]);
-    $result = curl_exec($ch);
-    if ($result === false) {
-        $error = curl_error($ch);
-        curl_close($ch);
-        throw new APICallException('curl_exec failed: ' . $error);
+    return $results;
+}
+
+// Return true if making an API call twice has the same effect as making it once. Creating a contact is the
+// only call that is not; assigning a tag that a contact already has succeeds without changing anything.
+function isIdempotentAPICall($method, $url) {
+    return $method == 'GET' || $method == 'PATCH' || preg_match('#/api/contacts/\d+/tags$#', $url);
+}
+
+// Make API calls concurrently, at most $maxParallel at a time, once each. Return the keys of $calls mapped to [$status, $response, $error, $retryAfter, $info],
+// where $retryAfter is the number of seconds a Retry-After header asks to wait, or null, and $info is what curl_getinfo() returns,
+// with the number of connections the call opened as num_connects.
+// Calls that there is no time left for under the submission deadline are not made, and have no result.
+function sendAPICalls($calls, $maxParallel = MAX_PARALLEL_API_CALLS) {
+    $results = [];
+    $active = [];
+    $retryAfter = [];
+    $mh = getAPIClient();
+    do {
+        while (count($active) < $maxParallel && $calls) {
+            if (!hasTimeForAPICall()) {
+                $calls = [];
+                break;
+            }
+            $key = array_key_first($calls);
+            [$method, $url, $data] = $calls[$key];
+            unset($calls[$key]);
+            $ch = createAPIRequest($method, $url, $data);
+            $id = spl_object_id($ch);
+            curl_setopt($ch, CURLOPT_HEADERFUNCTION, function ($ch, $header) use (&$retryAfter, $id) {
+                if (stripos($header, 'Retry-After:') === 0) {
+                    $value = trim(substr($header, strlen('Retry-After:')));
+                    $retryAfter[$id] = max(0, is_numeric($value) ? (int)$value : (int)strtotime($value) - time());
+                }
+                return strlen($header);
+            });
+            curl_multi_add_handle($mh, $ch);
+            $active[$id] = $key;
+        }
+
+        curl_multi_exec($mh, $running);
+        if ($running && curl_multi_select($mh, 1.0) === -1) {
+            usleep(1000);
+        }
+
+        while ($info = curl_multi_info_read($mh)) {
+            $ch = $info['handle'];
+            $id = spl_object_id($ch);
+            $key = $active[$id];
+            unset($active[$id]);
+            $callInfo = curl_getinfo($ch) + ['num_connects' => curl_getinfo($ch, CURLINFO_NUM_CONNECTS)];
+            if ($info['result'] === CURLE_OK) {
+                $results[$key] = [curl_getinfo($ch, CURLINFO_HTTP_CODE), json_decode(curl_multi_getcontent($ch)), null, $retryAfter[$id] ?? null, $callInfo];
+            } else {
+                $results[$key] = [0, null, curl_error($ch) ?: curl_strerror($info['result']), null, $callInfo];
+            }
+            unset($retryAfter[$id]);
+            curl_multi_remove_handle($mh, $ch);
+            curl_close($ch);
+        }
+    } while ($active || $calls);
+    return $results;
+}
+
+// Return the name of the file that holds the circuit breaker state when APCu is not available
+function getCircuitBreakerFile() {
+    return getStateDir() . '/systeme-io-circuit-breaker-' . md5(getStateKey()) . '.json';
+}
+
+// Return the circuit breaker state, after changing it with $update if given. The state is shared by all requests,
+// and holds the number of API calls in a row that have failed, and when the breaker opened or null if it is closed.
+function updateCircuitBreaker($update = null) {
+    $closed = ['failures' => 0, 'openedAt' => null];
+    if (useAPCu()) {
+        $key = 'systeme-io-circuit-breaker:' . getStateKey();
+        $state = apcu_fetch($key) ?: $closed;
+        if ($update) {
+            $state = $update($state);
+            apcu_store($key, $state);
+        }
+        return $state;
     }
-    $status = curl_getinfo($ch, CURLINFO_HTTP_CODE);
-    curl_close($ch);
-    return [$status, json_decode($result)];
+    return updateStateFile(getCircuitBreakerFile(), $closed, $update);
+}
+
+// Return the state in a JSON file, or $default if there is none, after changing it with $update if given.
+// The file is locked while it is read and written, so that concurrent updates are not lost.
+function updateStateFile($file, $default, $update = null) {
+    $fp = @fopen($file, 'c+');
+    if (!$fp) {
+        return $default;
+    }
+    flock($fp, $update ? LOCK_EX : LOCK_SH);
+    $state = json_decode(stream_get_contents($fp), true) ?: $default;
+    if ($update) {
+        $state = $update($state);
+        ftruncate($fp, 0);
+        rewind($fp);
+        fwrite($fp, json_encode($state));
+        fflush($fp);
+    }
+    flock($fp, LOCK_UN);
+    fclose($fp);
+    return $state;
+}
+
+// Return 'closed', 'open', or 'half-open' once the breaker has been open for CIRCUIT_BREAKER_OPEN_SECONDS
+function getCircuitState() {
+    $openedAt = updateCircuitBreaker()['openedAt'];
+    if ($openedAt === null) {
+        return 'closed';
+    }
+    return time() < $openedAt + CIRCUIT_BREAKER_OPEN_SECONDS ? 'open' : 'half-open';
+}
+
+// Return true if API calls may be made. While the breaker is half-open, only the first request to ask gets to make
+// calls; its calls decide whether the breaker closes or opens again.
+function isCircuitClosed() {
+    static $probing = false;
+    $state = getCircuitState();
+    if ($state == 'closed' || $probing) {
+        return true;
+    }
+    if ($state == 'open') {
+        return false;
+    }
+    // Open the breaker again for everyone else while this request probes the API
+    updateCircuitBreaker(function ($state) use (&$probing) {
+        if ($state['openedAt'] !== null && time() >= $state['openedAt'] + CIRCUIT_BREAKER_OPEN_SECONDS) {
+            $state['openedAt'] = time();
+            $probing = true;
+        }
+        return $state;
+    });
+    return $probing;
+}
+
+// Count a failed API call towards opening the circuit breaker, or close it after a call that succeeded
+function recordAPICallResult($failed) {
+    $state = updateCircuitBreaker();
+    if (!$failed && $state['failures'] == 0 && $state['openedAt'] === null) {
+        return;
+    }
+    updateCircuitBreaker(function ($state) use ($failed) {
+        if (!$failed) {
+            return ['failures' => 0, 'openedAt' => null];
+        }
+        $state['failures']++;
+        if ($state['failures'] >= CIRCUIT_BREAKER_THRESHOLD) {
+            $state['openedAt'] = time();
+        }
+        return $state;
+    });
+}
+
+function resetCircuitBreaker() {
+    if (useAPCu()) {
+        apcu_delete('systeme-io-circuit-breaker:' . getStateKey());
+    }
+    @unlink(getCircuitBreakerFile());
 }
 
 // Get a contact by email, or null if not found
@@ -132,6 +529,12 @@ function getContactByEmail($email) {
 
 // Add a contact. Return the contact or null if not successful
 function addContact($email, $firstName) {
+    return tryAddContact($email, $firstName)[0];
+}
+
+// Add a contact. Return the contact, or null if not successful, and whether it failed because the email is taken.
+// systeme.io answers a taken email with 422 and a violation of the email property.
+function tryAddContact($email, $firstName) {
     $path = '/api/contacts';
     $url = API_BASE_URL . $path;
     $data = ['email' => $email, 'fields' => []];
@@ -140,10 +543,10 @@ function addContact($email, $firstName) {
     }
     [$status, $response] = postToAPI($url, $data);
     if ($status == 201) {
-        return $response;
-    } else {
-        return null;
+        return [$response, false];
     }
+    $taken = $status == 422 && in_array('email', array_column($response->violations ?? [], 'propertyPath'));
+    return [null, $taken];
 }
 
 // Get a tag by name, or null if not found
@@ -158,6 +561,165 @@ function getTagByName($tag) {
     }
 }
 
+// Return the test run of the request if it is to be passed on to the API, or null
+function getTestRun() {
+    $testRun = $_SERVER['HTTP_X_TEST_RUN'] ?? '';
+    return FORWARD_TEST_RUN && preg_match('/^[\w.-]{1,64}$/', $testRun) ? $testRun : null;
+}
+
+// Return the key of state that is shared between requests to the same API, in the same test run
+function getStateKey() {
+    $testRun = getTestRun();
+    return $testRun === null ? API_BASE_URL : API_BASE_URL . "#$testRun";
+}
+
+function getSpoolFile() {
+    $testRun = getTestRun();
+    return $testRun === null ? SPOOL_FILE : SPOOL_FILE . ".$testRun";
+}
+
+// Return the directory for state that is shared between requests when APCu is not available:
+// .private, or the system temp directory if .private is not writable
+function getStateDir() {
+    return is_dir('.private') && is_writable('.private') ? '.private' : sys_get_temp_dir();
+}
+
+// Return the name of the file that caches tag IDs when APCu is not available
+function getTagCacheFile() {
+    return getStateDir() . '/systeme-io-tag-cache-' . md5(getStateKey()) . '.json';
+}
+
+function useAPCu() {
+    return function_exists('apcu_enabled') && apcu_enabled();
+}
+
+// Get a cached tag ID, or null if the tag is not cached or has expired
+function getCachedTagId($tagName) {
+    if (TAG_CACHE_TTL <= 0) {
+        return null;
+    }
+    if (useAPCu()) {
+        $tagId = apcu_fetch('systeme-io-tag:' . getStateKey() . ":$tagName", $success);
+        return $success ? $tagId : null;
+    }
+    $cache = updateStateFile(getTagCacheFile(), []);
+    if (isset($cache[$tagName]) && $cache[$tagName]['expires'] > time()) {
+        return $cache[$tagName]['id'];
+    }
+    return null;
+}
+
+// Cache a tag ID, or forget it if $tagId is null
+function setCachedTagId($tagName, $tagId) {
+    if (TAG_CACHE_TTL <= 0) {
+        return;
+    }
+    if (useAPCu()) {
+        $key = 'systeme-io-tag:' . getStateKey() . ":$tagName";
+        if ($tagId === null) {
+            apcu_delete($key);
+        } else {
+            apcu_store($key, $tagId, TAG_CACHE_TTL);
+        }
+        return;
+    }
+    // Concurrent requests cache different tags, so update the file under a lock rather than overwrite their entries
+    updateStateFile(getTagCacheFile(), [], function ($cache) use ($tagName, $tagId) {
+        if ($tagId === null) {
+            unset($cache[$tagName]);
+        } else {
+            $cache[$tagName] = ['id' => $tagId, 'expires' => time() + TAG_CACHE_TTL];
+        }
+        return $cache;
+    });
+}
+
+// Write to a temporary file and rename it over $file, so that readers never see a partial file
+function writeFileAtomically($file, $contents) {
+    $tempFile = @tempnam(dirname($file), 'systeme-io');
+    if ($tempFile && file_put_contents($tempFile, $contents) !== false) {
+        chmod($tempFile, 0644);
+        rename($tempFile, $file);
+    } elseif ($tempFile) {
+        unlink($tempFile);
+    }
+}
+
+function clearTagCache() {
+    if (useAPCu()) {
+        apcu_delete(new APCUIterator('/^' . preg_quote('systeme-io-tag:' . getStateKey() . ':', '/') . '/'));
+    }
+    @unlink(getTagCacheFile());
+}
+
+// Get a tag ID by name from the cache, or from the API if it is not cached. Return null if the tag is not found.
+function getTagId($tagName) {
+    $tagId = getCachedTagId($tagName);
+    if ($tagId !== null) {
+        return $tagId;
+    }
+    $tag = getTagByName($tagName);
+    if (!$tag) {
+        return null;
+    }
+    setCachedTagId($tagName, $tag->id);
+    return $tag->id;
+}
+
+// Get the IDs of tags by name, from the cache or else from concurrent API lookups.
+// Return an array that maps the names of the tags that were found to their IDs.
+function getTagIds($tagNames) {
+    $tagIds = [];
+    $calls = [];
+    foreach (array_unique($tagNames) as $tagName) {
+        $tagId = getCachedTagId($tagName);
+        if ($tagId !== null) {
+            $tagIds[$tagName] = $tagId;
+        } else {
+            $calls[$tagName] = ['GET', API_BASE_URL . "/api/tags?query=$tagName", null];
+        }
+    }
+    foreach (callAPIConcurrently($calls) as $tagName => [$status, $response, $error]) {
+        if ($error) {
+            throw new APICallException('curl_exec failed: ' . $error);
+        }
+        // Only a successful lookup tells that a tag does not exist; anything else is the API failing
+        if ($status != 200) {
+            throw new APICallException("Could not look up tag");
+        }
+        $tag = $response->items[0] ?? null;
+        if ($tag) {
+            setCachedTagId($tagName, $tag->id);
+            $tagIds[$tagName] = $tag->id;
+        }
+    }
+    return $tagIds;
+}
+
+// Assign tags to a contact concurrently. $tagIds maps tag names to IDs.
+function assignTagsToContact($contact_id, $tagIds) {
+    $calls = [];
+    foreach ($tagIds as $tagName => $tagId) {
+        $calls[$tagName] = ['POST', API_BASE_URL . "/api/contacts/$contact_id/tags", ['tagId' => $tagId]];
+    }
+    foreach (callAPIConcurrently($calls) as $tagName => [$status, $response, $error]) {
+        if ($error) {
+            throw new APICallException('curl_exec failed: ' . $error);
+        }
+        # 204 No Content (there is no response body)
+        $assigned = $status == 204;
+        if (!$assigned) {
+            // The cached ID may be stale if the tag has been recreated, so look it up again before giving up
+            setCachedTagId($tagName, null);
+            $freshTagId = getTagId($tagName);
+            $assigned = $freshTagId !== null && $freshTagId != $tagIds[$tagName] && assignTagToContact($contact_id, $freshTagId);
+        }
+        if (!$assigned) {
+            throw new APICallException("Could not assign tag to contact");
+        }
+    }
+}
+
 // Assign a tag to a contact. Return true if successful
 function assignTagToContact($contact_id, $tag_id) {
     $path = "/api/contacts/$contact_id/tags";
@@ -190,25 +752,32 @@ function validateAndSplitTags($tagsString) {
 
 // Return trimmed and validated parameters in alphabetical order
 function getAndValidatePostParameters() {
-    $email = trim($_POST['email'] ?? '');
     $redirectTo = trim($_POST['redirect-to'] ?? '');
-    $firstName = $_POST['first_name'] ?? '';
     $honeyPot = $_POST['last_name'] ?? null;
 
     if ($honeyPot) {
         throw new InputException("Rejected");
     }
 
-    $tags = validateAndSplitTags($_POST['tags'] ?? "");
-
-    if (!filter_var($email, FILTER_VALIDATE_EMAIL)) {
-        throw new InputException("Invalid email");
-    }
+    [$email, $firstName, $tags] = validateSubmission($_POST['email'] ?? '', $_POST['first_name'] ?? '', $_POST['tags'] ?? "");
 
     if (!filter_var($redirectTo, FILTER_VALIDATE_URL)) {
         throw new InputException("Invalid redirect-to");
     }
 
+    // Mind the alphabetical order
+    return [$email, $firstName, $redirectTo, $tags];
+}
+
+// Return the trimmed and validated email, first name and array of tags of a submission, from the form or an import
+function validateSubmission($email, $firstName, $tagsString) {
+    $email = trim($email);
+    $tags = validateAndSplitTags($tagsString);
+
+    if (!filter_var($email, FILTER_VALIDATE_EMAIL)) {
+        throw new InputException("Invalid email");
+    }
+
     // Replace all single quotes in $firstName with apostrophes to prevent SQL injection.
     // Then validate that $firstName is a string of zero or more international characters, spaces, hyphens, and some cultural characters.
     $firstName = trim($firstName);
@@ -217,34 +786,52 @@ function getAndValidatePostParameters() {
         throw new InputException("Invalid first_name");
     }
 
-    // Mind the alphabetical order
-    return [$email, $firstName, $redirectTo, $tags];
+    return [$email, $firstName, $tags];
 }
 
 function handlePost() {
+    if (SUBMISSION_DEADLINE > 0) {
+        submissionDeadline(($_SERVER['REQUEST_TIME_FLOAT'] ?? microtime(true)) + SUBMISSION_DEADLINE);
+    }
     [$email, $firstName, $redirectTo, $tags] = getAndValidatePostParameters();
 
-    $contact = getContactByEmail($email);
-    if ($contact) {
-        $storedFirstName = null;
-        foreach ($contact->fields as $field) {
-            if ($field->slug == 'first_name') {
-                $storedFirstName = $field->value;
-                break;
+    if (SPOOL_MODE != 'always' || !spoolSubmission($email, $firstName, $tags)) {
+        try {
+            saveSubmission($email, $firstName, $tags);
+        } catch (APICallException $e) {
+            notifyError($e->getMessage());
+            // The submission is valid, so keep it to be sent later rather than lose it
+            if (SPOOL_MODE == 'off' || !spoolSubmission($email, $firstName, $tags)) {
+                throw $e;
             }
+            error_log('Spooled submission after API error: ' . $e->getMessage());
         }
+    }
 
-        if ($firstName && $storedFirstName != $firstName) {
-            $path = "/api/contacts/$contact->id";
-            $url = API_BASE_URL . $path;
-            $data = ['fields' => [['slug' => 'first_name', 'value' => $firstName]]];
-            [$status, $contact] = patchToAPI($url, $data);
-            if ($status != 200) {
-                throw new APICallException("Could not update contact");
+    header("HTTP/1.1 303 See Other");
+    header("Location: $redirectTo");
+    // Report errors that were counted while notifications were held back, now that the interval may have passed
+    sendDueNotification();
+}
+
+// Add or update a contact and assign tags to it. Saving the same submission again has no further effect,
+// so a submission can be retried after it fails partway.
+function saveSubmission($email, $firstName, $tags) {
+    if (getUpsertStrategy() == 'create-first') {
+        [$contact, $taken] = tryAddContact($email, $firstName);
+        if ($taken) {
+            $contact = getContactByEmail($email);
+            if ($contact) {
+                $contact = updateFirstName($contact, $firstName);
             }
         }
     } else {
-        $contact = addContact($email, $firstName);
+        $contact = getContactByEmail($email);
+        if ($contact) {
+            $contact = updateFirstName($contact, $firstName);
+        } else {
+            $contact = addContact($email, $firstName);
+        }
     }
 
     // By now the contact should be either found or added
@@ -253,29 +840,575 @@ function handlePost() {
     }
 
     // Verify that all tags exist, then assign them
-    $tagIds = [];
-    foreach ($tags as $tagName) {
-        $tag = getTagByName($tagName);
-        if ($tag) {
-            $tagIds[] = $tag->id;
+    $tagIds = getTagIds($tags);
+    if (count($tagIds) != count(array_unique($tags))) {
+        throw new InputException("Could not find all tags");
+    }
+    assignTagsToContact($contact->id, $tagIds);
+}
+
+// Return the upsert strategy of the submission: UPSERT_STRATEGY, or in tests the one asked for by the request
+function getUpsertStrategy() {
+    $strategy = $_SERVER['HTTP_X_UPSERT_STRATEGY'] ?? '';
+    return FORWARD_TEST_RUN && in_array($strategy, ['lookup-first', 'create-first']) ? $strategy : UPSERT_STRATEGY;
+}
+
+// Set the first name of a contact if it is given and differs from the stored one. Return the contact.
+function updateFirstName($contact, $firstName) {
+    if (!$firstName || getFirstName($contact) == $firstName) {
+        return $contact;
+    }
+    $path = "/api/contacts/$contact->id";
+    $url = API_BASE_URL . $path;
+    $data = ['fields' => [['slug' => 'first_name', 'value' => $firstName]]];
+    [$status, $contact] = patchToAPI($url, $data);
+    if ($status != 200) {
+        throw new APICallException("Could not update contact");
+    }
+    return $contact;
+}
+
+// Return the first name stored for a contact, or null
+function getFirstName($contact) {
+    foreach ($contact->fields as $field) {
+        if ($field->slug == 'first_name') {
+            return $field->value;
         }
     }
-    if (count($tagIds) != count($tags)) {
-        throw new InputException("Could not find all tags");
+    return null;
+}
+
+// Append a submission to the spool. Return false if it could not be spooled.
+function spoolSubmission($email, $firstName, $tags) {
+    $entry = [
+        'id' => bin2hex(random_bytes(8)),
+        'time' => time(),
+        'email' => $email,
+        'firstName' => $firstName,
+        'tags' => $tags,
+        'attempts' => 0
+    ];
+    return appendToSpoolFile(getSpoolFile(), [$entry]);
+}
+
+// Append entries to a spool file as lines of JSON, under an exclusive lock so that concurrent appends never
+// interleave. A drain may move the file away between opening and locking it; then append to the new file instead.
+function appendToSpoolFile($file, $entries) {
+    $dir = dirname($file);
+    if (!is_dir($dir) || !is_writable($dir)) {
+        return false;
     }
-    foreach ($tagIds as $tagId) {
-        $response = assignTagToContact($contact->id, $tagId);
-        if (!$response) {
-            throw new APICallException("Could not assign tag to contact");
+    $lines = '';
+    foreach ($entries as $entry) {
+        $lines .= json_encode($entry, JSON_UNESCAPED_UNICODE | JSON_UNESCAPED_SLASHES) . "\n";
+    }
+    while (true) {
+        $fp = @fopen($file, 'a');
+        if (!$fp || !flock($fp, LOCK_EX)) {
+            return false;
+        }
+        clearstatcache(true, $file);
+        $moved = @fileinode($file) !== fstat($fp)['ino'];
+        $written = !$moved && fwrite($fp, $lines) === strlen($lines) && fflush($fp);
+        flock($fp, LOCK_UN);
+        fclose($fp);
+        if (!$moved) {
+            return $written;
         }
     }
+}
 
-    header("HTTP/1.1 303 See Other");
-    header("Location: $redirectTo");
+// Send spooled submissions to the API, at most $maxEntries of them, in batches of SPOOL_DRAIN_BATCH_SIZE.
+// Submissions that fail because the API fails are put back in the spool to be retried by a later drain.
+// Submissions that are rejected as invalid, or have failed SPOOL_MAX_ATTEMPTS times, are moved to a poison file.
+// Return a summary of what was done.
+function drainSpool($maxEntries = PHP_INT_MAX) {
+    $summary = ['succeeded' => 0, 'retried' => 0, 'poisoned' => 0, 'remaining' => 0];
+    $spoolFile = getSpoolFile();
+
+    // Only one drain at a time
+    $lock = @fopen($spoolFile . '.lock', 'c');
+    if (!$lock) {
+        return $summary;
+    }
+    if (!flock($lock, LOCK_EX | LOCK_NB)) {
+        fclose($lock);
+        return $summary + ['busy' => true];
+    }
+
+    // Take the spool over so that new submissions go to a new file. A drain that was interrupted leaves its file
+    // behind, and its submissions are sent again, which is safe since saving a submission twice has no further effect.
+    $drainingFile = $spoolFile . '.draining';
+    if (!file_exists($drainingFile) && file_exists($spoolFile)) {
+        $fp = fopen($spoolFile, 'r');
+        flock($fp, LOCK_EX);
+        rename($spoolFile, $drainingFile);
+        flock($fp, LOCK_UN);
+        fclose($fp);
+    }
+    $lines = file_exists($drainingFile) ? file($drainingFile, FILE_IGNORE_NEW_LINES | FILE_SKIP_EMPTY_LINES) : [];
+
+    $retry = [];
+    $poison = [];
+    $apiIsDown = false;
+    foreach (array_chunk($lines, SPOOL_DRAIN_BATCH_SIZE) as $batch) {
+        $entries = array_map(function ($line) { return json_decode($line, true) ?? ['line' => $line]; }, $batch);
+        if ($apiIsDown || $maxEntries <= 0) {
+            array_push($retry, ...$entries);
+            continue;
+        }
+        $batchSucceeded = false;
+        $batchFailed = false;
+        foreach ($entries as $entry) {
+            if ($maxEntries-- <= 0) {
+                $retry[] = $entry;
+                continue;
+            }
+            try {
+                if (!isset($entry['email'], $entry['firstName'], $entry['tags'])) {
+                    throw new InputException('Invalid spool entry');
+                }
+                saveSubmission($entry['email'], $entry['firstName'], $entry['tags']);
+                $summary['succeeded']++;
+                $batchSucceeded = true;
+            } catch (InputException $e) {
+                $poison[] = $entry + ['error' => $e->getMessage()];
+            } catch (CircuitOpenException $e) {
+                // Nothing was sent, so this is not an attempt
+                $retry[] = $entry;
+                $maxEntries = 0;
+            } catch (Exception $e) {
+                $entry['attempts'] = ($entry['attempts'] ?? 0) + 1;
+                $entry['lastError'] = $e->getMessage();
+                $batchFailed = true;
+                if ($entry['attempts'] >= SPOOL_MAX_ATTEMPTS) {
+                    $poison[] = $entry + ['error' => $e->getMessage()];
+                } else {
+                    $retry[] = $entry;
+                    $summary['retried']++;
+                }
+            }
+        }
+        // Leave the rest for a later drain rather than fail every one of them
+        $apiIsDown = $batchFailed && !$batchSucceeded;
+    }
+
+    if ((!$poison || appendToSpoolFile($spoolFile . '.poison', $poison))
+        && (!$retry || appendToSpoolFile($spoolFile, $retry))) {
+        @unlink($drainingFile);
+    }
+    $summary['poisoned'] = count($poison);
+    $summary['remaining'] = count($retry);
+
+    flock($lock, LOCK_UN);
+    fclose($lock);
+    sendDueNotification();
+    return $summary;
+}
+
+// Import contacts from CSV with a header row, or from JSON lines, with the email, first_name and tags of the form.
+// Rows are validated like form submissions, tags are looked up once, and contacts are added or updated and tagged
+// in batches of IMPORT_BATCH_SIZE rows, with up to $concurrency API calls at a time. After each batch, a checkpoint
+// is saved, so that importing the same data again carries on where an earlier import stopped, unless $restart is set.
+// At most $maxRows rows are imported. Return a summary of the whole import, so far.
+function importContacts($data, $concurrency = MAX_PARALLEL_API_CALLS, $maxRows = PHP_INT_MAX, $restart = false) {
+    $rows = readImportRows($data);
+    $checkpointFile = getStateDir() . '/systeme-io-import-' . md5(getStateKey() . sha1($data)) . '.json';
+    $checkpoint = $restart ? null : json_decode(@file_get_contents($checkpointFile) ?: 'null', true);
+    $position = $checkpoint['position'] ?? 0;
+    $summary = $checkpoint['summary'] ?? [
+        'rows' => count($rows), 'created' => 0, 'updated' => 0, 'unchanged' => 0, 'invalid' => 0, 'failed' => 0,
+        'rateLimited' => 0, 'errors' => []
+    ];
+    $concurrency = max(1, min(IMPORT_MAX_CONCURRENCY, $concurrency));
+    curl_multi_setopt(getAPIClient(), CURLMOPT_MAX_HOST_CONNECTIONS, IMPORT_MAX_CONCURRENCY);
+    $rows = array_slice($rows, $position, min($maxRows, count($rows) - $position), true);
+
+    try {
+        // Look up every tag once, and afresh, since a cached ID may be stale and would then fail every row
+        $tagNames = [];
+        foreach ($rows as $row) {
+            try {
+                array_push($tagNames, ...validateAndSplitTags($row['tags']));
+            } catch (InputException $e) {
+                // The row is reported when its batch is imported
+            }
+        }
+        $tagNames = array_unique($tagNames);
+        foreach ($tagNames as $tagName) {
+            setCachedTagId($tagName, null);
+        }
+        $tagIds = getTagIds($tagNames);
+
+        foreach (array_chunk($rows, IMPORT_BATCH_SIZE, true) as $batch) {
+            importBatch($batch, $tagIds, $concurrency, $summary);
+            $position = array_key_last($batch) + 1;
+            writeFileAtomically($checkpointFile, json_encode(['position' => $position, 'summary' => $summary]));
+        }
+    } catch (APICallException $e) {
+        // The batch that failed is imported again next time
+        $summary['stopped'] = $e->getMessage();
+    }
+
+    $summary['remaining'] = $summary['rows'] - $position;
+    $summary['concurrency'] = $concurrency;
+    if ($summary['remaining'] == 0) {
+        @unlink($checkpointFile);
+    }
+    return $summary;
+}
+
+// Return the rows of CSV or JSON lines data as arrays with an email, a first_name and a comma-separated tags string.
+// Rows that are not valid JSON are returned without an email, so that they are reported as invalid.
+function readImportRows($data) {
+    $rows = [];
+    if (preg_match('/^\s*\{/', $data)) {
+        foreach (preg_split('/\R/', $data, -1, PREG_SPLIT_NO_EMPTY) as $line) {
+            $row = json_decode($line, true);
+            $tags = $row['tags'] ?? '';
+            $rows[] = [
+                'email' => (string)($row['email'] ?? ''),
+                'first_name' => (string)($row['first_name'] ?? ''),
+                'tags' => is_array($tags) ? implode(',', $tags) : (string)$tags
+            ];
+        }
+        return $rows;
+    }
+
+    $fp = fopen('php://temp', 'r+');
+    fwrite($fp, preg_replace('/^\xEF\xBB\xBF/', '', $data));
+    rewind($fp);
+    $header = array_map('trim', fgetcsv($fp, null, ',', '"', '') ?: []);
+    if (!in_array('email', $header)) {
+        throw new InputException('The first row must name the columns, which include email');
+    }
+    while (($values = fgetcsv($fp, null, ',', '"', '')) !== false) {
+        if ($values == [null]) {
+            continue;
+        }
+        $row = array_combine($header, array_pad(array_slice($values, 0, count($header)), count($header), ''));
+        $rows[] = ['email' => $row['email'], 'first_name' => $row['first_name'] ?? '', 'tags' => $row['tags'] ?? ''];
+    }
+    fclose($fp);
+    return $rows;
+}
+
+// Import a batch of rows, keyed by their index. Rows that are rate limited are imported again in another round,
+// after $concurrency has been lowered, as are rows with the email of an earlier row, so that a contact is never
+// added twice at the same time. Count the outcome of each row in $summary.
+function importBatch($rows, $tagIds, &$concurrency, &$summary) {
+    $submissions = [];
+    foreach ($rows as $i => $row) {
+        try {
+            [$email, $firstName, $tags] = validateSubmission($row['email'], $row['first_name'], $row['tags']);
+            $unknownTags = array_diff($tags, array_keys($tagIds));
+            if ($unknownTags) {
+                throw new InputException('Unknown tag: ' . implode(', ', $unknownTags));
+            }
+            $submissions[$i] = [$email, $firstName, array_unique($tags)];
+        } catch (InputException $e) {
+            $summary['invalid']++;
+            $summary['errors'][] = ['row' => $i + 1, 'error' => $e->getMessage()];
+        }
+    }
+
+    for ($round = 1; $submissions; $round++) {
+        $current = [];
+        $later = [];
+        foreach ($submissions as $i => $submission) {
+            $email = strtolower($submission[0]);
+            if (isset($current[$email])) {
+                $later[$i] = $submission;
+            } else {
+                $current[$email] = $i;
+            }
+        }
+        $current = array_intersect_key($submissions, array_flip($current));
+
+        $rateLimited = 0;
+        $outcomes = saveSubmissionsConcurrently($current, $tagIds, $concurrency, $rateLimited);
+        $summary['rateLimited'] += $rateLimited;
+        // Back off quickly and recover slowly
+        $concurrency = $rateLimited ? max(1, intdiv($concurrency, 2)) : min(IMPORT_MAX_CONCURRENCY, $concurrency + 1);
+
+        $retries = [];
+        foreach ($outcomes as $i => $outcome) {
+            if ($outcome == 'rate limited' && $round < IMPORT_MAX_ROUNDS) {
+                $retries[$i] = $current[$i];
+            } elseif (in_array($outcome, ['created', 'updated', 'unchanged'])) {
+                $summary[$outcome]++;
+            } else {
+                $summary['failed']++;
+                $summary['errors'][] = ['row' => $i + 1, 'error' => $outcome];
+            }
+        }
+        $submissions = $retries + $later;
+        ksort($submissions);
+        if ($retries) {
+            usleep((int)(API_RETRY_MAX_DELAY * $round * 1000000));
+        }
+    }
+}
+
+// Save submissions like saveSubmission(), but in three rounds of concurrent API calls for all of them: look the
+// contacts up, add or update them, then assign the tags they do not have yet. $submissions maps keys to
+// [$email, $firstName, $tags]. Return the same keys mapped to 'created', 'updated', 'unchanged', 'rate limited',
+// or an error message.
+function saveSubmissionsConcurrently($submissions, $tagIds, $maxParallel, &$rateLimited) {
+    $outcomes = [];
+    $contacts = [];
+
+    $calls = [];
+    foreach ($submissions as $key => [$email]) {
+        $calls[$key] = ['GET', API_BASE_URL . '/api/contacts?email=' . urlencode($email), null];
+    }
+    $writes = [];
+    foreach (callAPIConcurrently($calls, $maxParallel, $rateLimited) as $key => [$status, $response, $error]) {
+        [$email, $firstName] = $submissions[$key];
+        $contact = $response->items[0] ?? null;
+        if ($status != 200) {
+            $outcomes[$key] = describeFailedCall('Could not look up contact', $status, $error);
+        } elseif (!$contact) {
+            $data = ['email' => $email, 'fields' => []];
+            if ($firstName) {
+                $data['fields'][] = ['slug' => 'first_name', 'value' => $firstName];
+            }
+            $writes[$key] = ['POST', API_BASE_URL . '/api/contacts', $data];
+            $outcomes[$key] = 'created';
+        } elseif ($firstName && getFirstName($contact) != $firstName) {
+            $writes[$key] = ['PATCH', API_BASE_URL . "/api/contacts/$contact->id", ['fields' => [['slug' => 'first_name', 'value' => $firstName]]]];
+            $outcomes[$key] = 'updated';
+        } else {
+            $contacts[$key] = $contact;
+            $outcomes[$key] = 'unchanged';
+        }
+    }
+
+    foreach (callAPIConcurrently($writes, $maxParallel, $rateLimited) as $key => [$status, $response, $error]) {
+        if ($status == 201 || $status == 200) {
+            $contacts[$key] = $response;
+        } else {
+            $outcomes[$key] = describeFailedCall('Could not ' . ($writes[$key][0] == 'POST' ? 'add' : 'update') . ' contact', $status, $error);
+        }
+    }
+
+    $calls = [];
+    foreach ($contacts as $key => $contact) {
+        $assigned = array_column($contact->tags ?? [], 'id');
+        foreach ($submissions[$key][2] as $tagName) {
+            if (!in_array($tagIds[$tagName], $assigned)) {
+                $calls["$key:$tagName"] = ['POST', API_BASE_URL . "/api/contacts/$contact->id/tags", ['tagId' => $tagIds[$tagName]]];
+            }
+        }
+    }
+    foreach (callAPIConcurrently($calls, $maxParallel, $rateLimited) as $call => [$status, $response, $error]) {
+        $key = explode(':', $call, 2)[0];
+        # 204 No Content (there is no response body)
+        if ($status != 204) {
+            $outcomes[$key] = describeFailedCall('Could not assign tag to contact', $status, $error);
+        } elseif ($outcomes[$key] == 'unchanged') {
+            $outcomes[$key] = 'updated';
+        }
+    }
+    return $outcomes;
+}
+
+// Return 'rate limited' if the API asked to slow down, or else $message with what went wrong
+function describeFailedCall($message, $status, $error) {
+    if ($status == 429) {
+        return 'rate limited';
+    }
+    return $error ? "$message: $error" : "$message: status $status";
+}
+
+// Return the name of the file that holds the errors that have not been reported to Slack yet
+function getNotificationFile() {
+    return getStateDir() . '/systeme-io-notifications-' . md5(getStateKey()) . '.json';
+}
+
+// Count an error towards the next Slack message, and send the message if it is due.
+// The errors are always kept in a locked file, even with APCu, so that one message at most is sent per interval.
+function notifyError($message) {
+    if (!SLACK_TOKEN) {
+        return;
+    }
+    $errors = null;
+    updateStateFile(getNotificationFile(), NO_PENDING_ERRORS, function ($state) use ($message, &$errors) {
+        $state['count']++;
+        $state['since'] = $state['since'] ?? time();
+        if (count($state['samples']) < SLACK_SAMPLE_ERRORS && !in_array($message, $state['samples'])) {
+            $state['samples'][] = $message;
+        }
+        return takeDueErrors($state, $errors);
+    });
+    if ($errors) {
+        postErrorsToSlack($errors);
+    }
+}
+
+// Send the errors counted so far to Slack, if the last message was sent long enough ago
+function sendDueNotification() {
+    if (!SLACK_TOKEN) {
+        return;
+    }
+    // Read without locking first, since there is usually nothing to send
+    $state = json_decode(@file_get_contents(getNotificationFile()) ?: 'null', true);
+    if (!$state || $state['count'] == 0 || time() < $state['sentAt'] + SLACK_NOTIFY_INTERVAL) {
+        return;
+    }
+    $errors = null;
+    updateStateFile(getNotificationFile(), NO_PENDING_ERRORS, function ($state) use (&$errors) {
+        return takeDueErrors($state, $errors);
+    });
+    if ($errors) {
+        postErrorsToSlack($errors);
+    }
+}
+
+// If a message is due, set $errors to the pending errors and return the state with none pending. Else return the state.
+function takeDueErrors($state, &$errors) {
+    if ($state['count'] == 0 || time() < $state['sentAt'] + SLACK_NOTIFY_INTERVAL) {
+        return $state;
+    }
+    $errors = $state;
+    return ['sentAt' => time()] + NO_PENDING_ERRORS;
+}
+
+function resetNotifications() {
+    @unlink(getNotificationFile());
+}
+
+// Post one message about pending errors to Slack. Return true if successful.
+function postErrorsToSlack($errors) {
+    $text = trim(SLACK_MENTION . ' systeme.io integration errors: ' . $errors['count'] . ' since '
+        . gmdate('Y-m-d H:i:s', $errors['since']) . ' UTC, e.g.');
+    foreach ($errors['samples'] as $sample) {
+        $text .= "\n• $sample";
+    }
+    $data_string = json_encode(['channel' => SLACK_CHANNEL, 'text' => $text]);
+
+    $ch = curl_init(SLACK_API_URL . '/api/chat.postMessage');
+    $headers = [
+        'Content-Type: application/json; charset=utf-8',
+        'Authorization: Bearer ' . SLACK_TOKEN
+    ];
+    $testRun = getTestRun();
+    if ($testRun !== null) {
+        $headers[] = "X-Test-Run: $testRun";
+    }
+    curl_setopt($ch, CURLOPT_POST, true);
+    curl_setopt($ch, CURLOPT_POSTFIELDS, $data_string);
+    curl_setopt($ch, CURLOPT_HTTPHEADER, $headers);
+    curl_setopt($ch, CURLOPT_RETURNTRANSFER, true);
+    // The visitor is waiting, so don't wait long for Slack, nor past the submission deadline
+    curl_setopt($ch, CURLOPT_TIMEOUT_MS, (int)(max(API_MIN_CALL_TIME, limitTimeout(2)) * 1000));
+    $response = curl_exec($ch);
+    $status = curl_getinfo($ch, CURLINFO_HTTP_CODE);
+    curl_close($ch);
+    if ($response === false || $status != 200) {
+        error_log("Could not post to Slack: status $status");
+        return false;
+    }
+    return true;
+}
+
+// Time $samples cheap API calls, one after another so that they can reuse a connection. Return the timings in
+// milliseconds as min, median and max over the samples: DNS lookup, connect and TLS handshake, which take no time
+// on a reused connection, then the time to the first byte of the response and the total time since the call started.
+// Only timings, statuses and curl errors are returned, never the responses. So as not to add to the load on an API
+// in trouble, no calls are made while the circuit breaker is open, and the probe stops after PROBE_TIME_LIMIT seconds.
+function probeAPI($samples) {
+    $timings = ['dns' => [], 'connect' => [], 'tls' => [], 'firstByte' => [], 'total' => []];
+    $statuses = [];
+    $errors = [];
+    $reused = 0;
+    $made = 0;
+    $stopped = getCircuitState() == 'open' ? 'circuit breaker is open' : null;
+    // The calls draw their timeouts from the time limit, as those of a submission do from its deadline
+    submissionDeadline(microtime(true) + PROBE_TIME_LIMIT + DEADLINE_RESERVE);
+    for ($i = 0; $i < $samples && !$stopped; $i++) {
+        $results = sendAPICalls([['GET', API_BASE_URL . '/api/tags?limit=10', null]], 1);
+        if (!$results) {
+            $stopped = 'time limit of ' . PROBE_TIME_LIMIT . 's reached';
+            break;
+        }
+        [[$status, , $error, , $info]] = $results;
+        $made++;
+        $key = $status ?: 'none';
+        $statuses[$key] = ($statuses[$key] ?? 0) + 1;
+        if ($error) {
+            $errors[] = $error;
+            continue;
+        }
+        // curl measures each phase from the start of the call
+        $timings['dns'][] = $info['namelookup_time_us'] / 1000;
+        $timings['connect'][] = max(0, $info['connect_time_us'] - $info['namelookup_time_us']) / 1000;
+        $timings['tls'][] = $info['appconnect_time_us'] ? max(0, $info['appconnect_time_us'] - $info['connect_time_us']) / 1000 : 0;
+        $timings['firstByte'][] = $info['starttransfer_time_us'] / 1000;
+        $timings['total'][] = $info['total_time_us'] / 1000;
+        // A call that did not have to open a connection reused one
+        if ($info['num_connects'] == 0) {
+            $reused++;
+        }
+    }
+    ksort($statuses);
+    return [
+        'samples' => $made,
+        'requestedSamples' => $samples,
+        'stopped' => $stopped,
+        'statuses' => $statuses,
+        'errors' => array_values(array_unique($errors)),
+        'reusedConnections' => $reused,
+        'timings' => array_map('summarizeTimings', $timings)
+    ];
+}
+
+// Return the min, median and max of durations in milliseconds, or nulls if there are none
+function summarizeTimings($values) {
+    if (!$values) {
+        return ['min' => null, 'median' => null, 'max' => null];
+    }
+    sort($values);
+    $middle = intdiv(count($values), 2);
+    $median = count($values) % 2 ? $values[$middle] : ($values[$middle - 1] + $values[$middle]) / 2;
+    return ['min' => round($values[0], 1), 'median' => round($median, 1), 'max' => round(end($values), 1)];
+}
+
+// Return true if the request carries the drain token in an X-Drain-Token header
+function hasDrainToken() {
+    return SPOOL_DRAIN_TOKEN && hash_equals(SPOOL_DRAIN_TOKEN, $_SERVER['HTTP_X_DRAIN_TOKEN'] ?? '');
 }
 
 function diagnose() {
+    $probe = null;
+    // The probe makes calls with the API key, which count towards its rate limit, so it needs the drain token too
+    if (isset($_GET['probe']) && hasDrainToken()) {
+        $probe = probeAPI(max(1, min(PROBE_MAX_SAMPLES, (int)($_GET['samples'] ?? PROBE_SAMPLES))));
+        if (($_GET['format'] ?? '') === 'json') {
+            header('Content-Type: application/json');
+            echo json_encode($probe);
+            return;
+        }
+    }
     echo "<html>\n<head>\n<title>Environment check</title>\n</head>\n<body>\n<pre>\n";
+    // The switches change state that all requests share, or call the API, so only those with the drain token may use them
+    $switches = array_intersect(['clear-tag-cache', 'reset-circuit-breaker', 'reset-notifications', 'probe'], array_keys($_GET));
+    if ($switches && !hasDrainToken()) {
+        echo "Ignored " . implode(', ', $switches) . ": the X-Drain-Token header is missing or wrong\n";
+        $switches = [];
+    }
+    if (in_array('clear-tag-cache', $switches)) {
+        clearTagCache();
+        echo "Tag cache cleared\n";
+    }
+    if (in_array('reset-circuit-breaker', $switches)) {
+        resetCircuitBreaker();
+        echo "Circuit breaker reset\n";
+    }
+    if (in_array('reset-notifications', $switches)) {
+        resetNotifications();
+        echo "Notifications reset\n";
+    }
     echo "API_BASE_URL: " . API_BASE_URL . "\n";
     if (strlen(API_KEY) != 64) {
         echo "API_KEY: (invalid: has " . strlen(API_KEY) . " characters)\n";
@@ -287,5 +1420,37 @@ function diagnose() {
     } else {
         echo "curl_init is not defined\n";
     }
+    if (TAG_CACHE_TTL <= 0) {
+        echo "Tag cache: off\n";
+    } elseif (useAPCu()) {
+        echo "Tag cache: APCu, TTL " . TAG_CACHE_TTL . "s\n";
+    } else {
+        echo "Tag cache: file, TTL " . TAG_CACHE_TTL . "s\n";
+    }
+    echo "Circuit breaker: " . getCircuitState() . "\n";
+    echo "Submission deadline: " . (SUBMISSION_DEADLINE > 0 ? SUBMISSION_DEADLINE . 's' : 'off, ' . API_CALL_TIMEOUT . 's per API call') . "\n";
+    echo "Slack notifications: " . (SLACK_TOKEN ? SLACK_CHANNEL . ', at most every ' . SLACK_NOTIFY_INTERVAL . 's' : 'off') . "\n";
+    $spoolFile = getSpoolFile();
+    $spoolWritable = is_dir(dirname($spoolFile)) && is_writable(dirname($spoolFile));
+    echo "Spool: " . SPOOL_MODE . ($spoolWritable ? '' : ' (unavailable: ' . dirname($spoolFile) . ' is not writable)') . "\n";
+    echo "Spooled submissions: " . (file_exists($spoolFile) ? count(file($spoolFile, FILE_SKIP_EMPTY_LINES)) : 0) . "\n";
+    echo "Poisoned submissions: " . (file_exists($spoolFile . '.poison') ? count(file($spoolFile . '.poison', FILE_SKIP_EMPTY_LINES)) : 0) . "\n";
+    if ($probe) {
+        echo "\nProbe: " . $probe['samples'] . " calls to GET /api/tags, connection reused by " . $probe['reusedConnections'] . "\n";
+        if ($probe['stopped']) {
+            echo "  stopped: " . $probe['stopped'] . "\n";
+        }
+        foreach ($probe['statuses'] as $status => $count) {
+            echo "  status $status: $count\n";
+        }
+        foreach ($probe['errors'] as $error) {
+            echo "  error: " . htmlspecialchars($error, ENT_NOQUOTES) . "\n";
+        }
+        printf("  %-10s %9s %9s %9s\n", 'ms', 'min', 'median', 'max');
+        foreach ($probe['timings'] as $phase => $timing) {
+            printf("  %-10s %9s %9s %9s\n", $phase, $timing['min'] ?? '-', $timing['median'] ?? '-', $timing['max'] ?? '-');
+        }
+        echo "\n" . htmlspecialchars(json_encode($probe, JSON_PRETTY_PRINT), ENT_NOQUOTES) . "\n";
+    }
     echo "\n</pre>\n</body>\n</html>\n";
 }
@@ -1,25 +1,708 @@
 #!/usr/bin/env python3
 
-from flask import Flask, request, jsonify
-
+from flask import Flask, request, jsonify, g, has_request_context
+from werkzeug.local import LocalProxy
+
+import atexit
+import collections
+import gc
+import itertools
+import json
+import math
+import multiprocessing
+import multiprocessing.managers
+import os
+import pickle
+import queue
+import random
+import re
+import signal
+import socket
+import sys
+import threading
 import time
 
+import waitress
+
 app = Flask(__name__)
 
 #-------------------
-# Test Endpoints
-
-contacts = []
-latest_contact_id = 0
-is_broken = False
-
-tags = [
-    {'id': 1, 'name': 'tag1'},
-    {'id': 2, 'name': 'tag2'},
-    {'id': 3, 'name': 'tag3'}
-]
+# State
+
+DELETED = object()
+
+# A dictionary of changes on top of a read-only base dictionary, which may be
+# shared with a cached snapshot. Deleting a key that is in the base hides it.
+# Values are never None, so get() returning None means that the key is absent.
+class Overlay:
+    def __init__(self, base=None):
+        self.base = base if base is not None else {}
+        self.changes = {}
+
+    def get(self, key, default=None):
+        value = self.changes.get(key, None)
+        if value is None:
+            return self.base.get(key, default)
+        return default if value is DELETED else value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+
+    def __delitem__(self, key):
+        if key in self.base:
+            self.changes[key] = DELETED
+        else:
+            del self.changes[key]
+
+    def update(self, pairs):
+        self.changes.update(pairs)
+
+    def isdisjoint(self, keys):
+        return all(key not in self for key in keys)
+
+    def is_changed(self, key):
+        return key in self.changes
+
+    def values(self):
+        for key, value in self.base.items():
+            if key not in self.changes:
+                yield value
+        for value in self.changes.values():
+            if value is not DELETED:
+                yield value
+
+# A contact as stored. Tags are kept as a tuple of tag ids rather than references
+# to the tag records, and fields as a tuple of (slug, value) pairs with interned
+# slugs, since every contact has the same few. Tuples are replaced rather than
+# changed, so copies share them, and the empty tuple is shared by every contact
+# without tags or fields.
+class Contact:
+    __slots__ = ('id', 'email', 'tag_ids', 'fields')
+
+    def __init__(self, contact_id, email, tag_ids=(), fields=()):
+        self.id = contact_id
+        self.email = email
+        self.tag_ids = tag_ids
+        self.fields = fields
+
+    def copy(self):
+        return Contact(self.id, self.email, self.tag_ids, self.fields)
+
+    # Return the contact as the API represents it
+    def to_json(self, tags_by_id):
+        return {
+            "id": self.id,
+            "email": self.email,
+            "tags": [tags_by_id[tag_id] for tag_id in self.tag_ids],
+            "fields": [{'slug': slug, 'value': value} for slug, value in self.fields]
+        }
+
+    # Return roughly how many bytes the contact takes, not counting what it shares
+    # with other contacts
+    def size(self):
+        size = sys.getsizeof(self) + sys.getsizeof(self.id) + sys.getsizeof(self.email)
+        if self.tag_ids:
+            size += sys.getsizeof(self.tag_ids)
+        if self.fields:
+            size += sys.getsizeof(self.fields) + sum(sys.getsizeof(field) + sys.getsizeof(field[1]) for field in self.fields)
+        return size
+
+# Return fields from the API as (slug, value) pairs with interned slugs
+def compact_fields(fields):
+    return tuple((sys.intern(field['slug']) if isinstance(field['slug'], str) else field['slug'], field['value']) for field in fields)
+
+# Upper bounds in seconds of the latency histogram buckets in /test/metrics
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, math.inf]
+
+# Number of calls kept for /test/requests
+RECENT_CALLS = 1000
+
+def format_bound(bound):
+    return '+Inf' if bound == math.inf else str(bound)
+
+# All mutable state of the mock lives in a Store. Contacts and tags are kept in
+# dictionaries keyed on every attribute that the endpoints look them up by, so
+# that lookups stay O(1) however many contacts the mock has been seeded with.
+# Contacts are stored as Contact records and turned into JSON on the way out.
+#
+# For long soak tests, the number of contacts can be capped, and the oldest
+# contacts are then evicted to make room for new ones.
+#
+# The contact dictionaries are Overlays on the contacts of the last restored
+# snapshot, which stay untouched so that restoring the same snapshot again only
+# drops the changes. A contact from the snapshot is copied before it is changed.
+#
+# For conditional GETs, lookups carry an ETag made of the generation of the state,
+# which changes whenever the state is reset or restored, and a version of what was
+# looked up: of the contact, for a contact that was found, or else of the contacts
+# or the tags as a whole. Only contacts that were added through the API or have
+# changed since they were seeded have a version of their own, so that seeded
+# contacts cost nothing extra. The Last-Modified of a lookup by email is the last
+# change to the contacts as a whole, since which contact has the email changes
+# when contacts are added, seeded or evicted, and not only when that contact does.
+#
+# Every method that the endpoints call takes the lock, reads included, so that id
+# allocation and check-and-insert are atomic between request threads, and a read
+# never sees an Overlay halfway through a change. Only the helpers that those
+# methods call while holding it (get_contact_for_update, page, load_snapshot)
+# don't. The endpoints only ever call methods, never touch attributes, which lets
+# several worker processes share one Store hosted by a StoreManager (see
+# serve_with_workers). Through the manager, return values are copies, so all
+# changes must go through methods.
+class Store:
+    DEFAULT_TAGS = ['tag1', 'tag2', 'tag3']
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Loaded snapshots by path, with the modification time of the file
+        self.snapshots = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.contacts_by_id = Overlay()
+            self.contacts_by_email = Overlay()
+            self.tags_by_id = {}
+            self.tags_by_name = {}
+            self.latest_contact_id = 0
+            self.latest_tag_id = 0
+            self.contact_count = 0
+            # Contacts with lower ids than this have been evicted
+            self.oldest_contact_id = 1
+            self.start_generation()
+            for name in self.DEFAULT_TAGS:
+                self.add_tag(name)
+            self.reset_test_controls()
+
+    # Start versioning the state afresh, so that no ETag from before matches
+    def start_generation(self):
+        with self.lock:
+            self.generation = format(time.time_ns(), 'x')
+            self.generation_time = time.time()
+            # (version, time of the last change) of contacts added through the API or
+            # changed since they were seeded by id, and of the contacts and the tags as a whole
+            self.contact_versions = {}
+            self.contacts_version = (0, self.generation_time)
+            self.tags_version = (0, self.generation_time)
+
+    # Count a change to a contact, or only to the contacts as a whole if contact_id is None
+    def bump_contact_version(self, contact_id=None):
+        with self.lock:
+            now = time.time()
+            if contact_id is not None:
+                self.contact_versions[contact_id] = (self.contact_versions.get(contact_id, (0,))[0] + 1, now)
+            self.contacts_version = (self.contacts_version[0] + 1, now)
+
+    def reset_test_controls(self):
+        with self.lock:
+            self.broken = False
+            self.slack_payloads = []
+            # Number of calls per route, e.g. {"GET /api/tags": 3}
+            self.call_counts = collections.Counter()
+            # Number of calls being handled per route, now and at most since the reset
+            self.in_flight = collections.Counter()
+            self.max_in_flight = collections.Counter()
+            # Client addresses and ports that calls have come from, one per TCP connection
+            self.connections = set()
+            # Injected faults per route, see /test/faults
+            self.faults = {}
+            # Requests, bytes and latency per systeme.io and Slack route, see /test/metrics
+            self.metrics = {}
+            # The latest systeme.io and Slack calls in the order they were answered, see /test/requests
+            self.recent_calls = collections.deque(maxlen=RECENT_CALLS)
+            # Most contacts to keep, or None to keep them all, see /test/memory
+            self.max_contacts = int(os.environ.get('MOCK_MAX_CONTACTS', '0')) or None
+            self.evicted_contacts = 0
+
+    # Add a contact and return it, or return None if the email is taken
+    def add_contact(self, email, fields):
+        with self.lock:
+            if email in self.contacts_by_email:
+                return None
+            self.latest_contact_id += 1
+            contact = Contact(self.latest_contact_id, email, (), compact_fields(fields))
+            self.contacts_by_id[contact.id] = contact
+            self.contacts_by_email[email] = contact
+            self.contact_count += 1
+            self.bump_contact_version(contact.id)
+            self.evict_contacts()
+            return contact.to_json(self.tags_by_id)
+
+    # Add one contact without fields per email, building the indexes in bulk.
+    # Return the new Contact records.
+    def add_contacts(self, emails):
+        with self.lock:
+            first_id = self.latest_contact_id + 1
+            new_contacts = list(map(Contact, range(first_id, first_id + len(emails)), emails))
+            self.contacts_by_id.update(zip(range(first_id, first_id + len(new_contacts)), new_contacts))
+            self.contacts_by_email.update(zip(emails, new_contacts))
+            self.latest_contact_id += len(new_contacts)
+            self.contact_count += len(new_contacts)
+            self.bump_contact_version()
+            self.evict_contacts()
+            return new_contacts
+
+    # Remove the oldest contacts while there are more than max_contacts
+    def evict_contacts(self):
+        with self.lock:
+            while self.max_contacts and self.contact_count > self.max_contacts:
+                contact = self.contacts_by_id.get(self.oldest_contact_id)
+                if contact:
+                    del self.contacts_by_id[contact.id]
+                    del self.contacts_by_email[contact.email]
+                    self.contact_versions.pop(contact.id, None)
+                    self.bump_contact_version()
+                    self.contact_count -= 1
+                    self.evicted_contacts += 1
+                self.oldest_contact_id += 1
+
+    # Add count synthetic contacts and give each tag to the given fraction of those
+    # that are kept when contacts are capped. Return the first and last id and the
+    # number of contacts per tag, or None if one of the generated emails is taken.
+    def seed(self, count, tag_fractions, seed):
+        with self.lock:
+            first_id = self.latest_contact_id + 1
+            emails = [f'seed{contact_id}@example.com' for contact_id in range(first_id, first_id + count)]
+            if not self.contacts_by_email.isdisjoint(emails):
+                return None
+            new_contacts = self.add_contacts(emails)
+            # The oldest are evicted first, so the contacts that are kept are the last ones
+            kept_contacts = new_contacts[max(self.oldest_contact_id - first_id, 0):]
+
+            rng = random.Random(seed)
+            tag_counts = {}
+            for name, fraction in tag_fractions.items():
+                tag = self.tags_by_name.get(name) or self.add_tag(name)
+                tagged = rng.sample(kept_contacts, round(fraction * len(kept_contacts)))
+                for contact in tagged:
+                    contact.tag_ids += (tag['id'],)
+                tag_counts[name] = len(tagged)
+            self.bump_contact_version()
+            return {'firstId': first_id, 'lastId': self.latest_contact_id, 'tags': tag_counts}
+
+    def get_contact(self, contact_id):
+        with self.lock:
+            contact = self.contacts_by_id.get(contact_id)
+            return contact.to_json(self.tags_by_id) if contact else None
+
+    def get_contact_by_email(self, email):
+        with self.lock:
+            contact = self.contacts_by_email.get(email)
+            return contact.to_json(self.tags_by_id) if contact else None
+
+    # Return a Contact record that can be changed without changing the restored snapshot.
+    # Call with the lock held.
+    def get_contact_for_update(self, contact_id):
+        contact = self.contacts_by_id.get(contact_id)
+        if not contact or self.contacts_by_id.is_changed(contact_id):
+            return contact
+        contact = contact.copy()
+        self.contacts_by_id[contact_id] = contact
+        self.contacts_by_email[contact.email] = contact
+        return contact
+
+    # Change the email and merge the fields of a contact. Return the contact and
+    # None, or None and an error message.
+    def update_contact(self, contact_id, email, fields):
+        with self.lock:
+            contact = self.get_contact_for_update(contact_id)
+            if not contact:
+                return None, "contact not found"
+
+            if email is not None and email != contact.email:
+                if email in self.contacts_by_email:
+                    return None, "duplicate"
+                del self.contacts_by_email[contact.email]
+                contact.email = email
+                self.contacts_by_email[email] = contact
+
+            if fields:
+                merged_fields = dict(contact.fields)
+                merged_fields.update(compact_fields(fields))
+                contact.fields = tuple(merged_fields.items())
+            self.bump_contact_version(contact_id)
+            return contact.to_json(self.tags_by_id), None
+
+    # Assign a tag to a contact, if it does not already have it. Return the contact
+    # and None, or None and an error message.
+    def assign_tag(self, contact_id, tag_id):
+        with self.lock:
+            contact = self.get_contact_for_update(contact_id)
+            if not contact:
+                return None, "contact not found"
+
+            # If the contact already has the tag, act as if the tag was successfully assigned
+            if tag_id not in contact.tag_ids:
+                if tag_id not in self.tags_by_id:
+                    return None, "tag not found"
+                contact.tag_ids += (tag_id,)
+                self.bump_contact_version(contact_id)
+            return contact.to_json(self.tags_by_id), None
+
+    def page_contacts(self, starting_after, limit):
+        with self.lock:
+            contacts, has_more = self.page(self.contacts_by_id, self.latest_contact_id, max(starting_after, self.oldest_contact_id - 1), limit)
+            return [contact.to_json(self.tags_by_id) for contact in contacts], has_more
+
+    def add_tag(self, name):
+        with self.lock:
+            self.latest_tag_id += 1
+            tag = {'id': self.latest_tag_id, 'name': name}
+            self.tags_by_id[tag['id']] = tag
+            self.tags_by_name[name] = tag
+            self.tags_version = (self.tags_version[0] + 1, time.time())
+            return tag
+
+    # Return the ETag and the time of the last change of what a lookup of a contact by
+    # email returns. Get them before the contact, so that they are never newer than it.
+    def get_contact_validators(self, email):
+        with self.lock:
+            contact = self.contacts_by_email.get(email)
+            if not contact:
+                return self.get_collection_validators('contacts')
+            version = self.contact_versions.get(contact.id, (0,))[0]
+            return f'{self.generation}-c{contact.id}.{version}', self.contacts_version[1]
+
+    # Return the ETag and the time of the last change of the 'contacts' or the 'tags'
+    def get_collection_validators(self, collection):
+        with self.lock:
+            version, modified = self.contacts_version if collection == 'contacts' else self.tags_version
+            return f'{self.generation}-{collection}.{version}', modified
+
+    def get_tag(self, tag_id):
+        with self.lock:
+            return self.tags_by_id.get(tag_id)
+
+    def get_tag_by_name(self, name):
+        with self.lock:
+            return self.tags_by_name.get(name)
+
+    def page_tags(self, starting_after, limit):
+        with self.lock:
+            return self.page(self.tags_by_id, self.latest_tag_id, starting_after, limit)
+
+    # Return up to limit records with ids above starting_after, in id order, and
+    # whether there are more. Ids are allocated in increasing order, so a record
+    # that is added while a client is paging always ends up after its cursor.
+    @staticmethod
+    def page(records_by_id, latest_id, starting_after, limit):
+        items = []
+        next_id = max(starting_after, 0) + 1
+        while next_id <= latest_id and len(items) <= limit:
+            record = records_by_id.get(next_id)
+            if record:
+                items.append(record)
+            next_id += 1
+        return items[:limit], len(items) > limit
+
+    # Save contacts, tags and id counters to a file. Contacts are saved column by
+    # column, which pickles and unpickles much faster than one object per contact.
+    def save_snapshot(self, path):
+        with self.lock:
+            contacts = list(self.contacts_by_id.values())
+            state = {
+                'contacts': {
+                    'ids': [contact.id for contact in contacts],
+                    'emails': [contact.email for contact in contacts],
+                    'tagIds': [contact.tag_ids for contact in contacts],
+                    'fields': [contact.fields for contact in contacts]
+                },
+                'tags': list(self.tags_by_id.values()),
+                'latestContactId': self.latest_contact_id,
+                'latestTagId': self.latest_tag_id
+            }
+            temporary_path = path + '.tmp'
+            with open(temporary_path, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, path)
+            return len(contacts)
+
+    # Replace contacts, tags and id counters with those in a snapshot file. The
+    # file is only read the first time, or when it has changed, and the loaded
+    # contacts are kept as the base that later changes are laid over.
+    def restore_snapshot(self, path):
+        with self.lock:
+            modified = os.stat(path).st_mtime_ns
+            snapshot = self.snapshots.get(path)
+            if not snapshot or snapshot['modified'] != modified:
+                snapshot = self.load_snapshot(path)
+                snapshot['modified'] = modified
+                self.snapshots[path] = snapshot
+
+            self.contacts_by_id = Overlay(snapshot['contactsById'])
+            self.contacts_by_email = Overlay(snapshot['contactsByEmail'])
+            self.tags_by_id = dict(snapshot['tagsById'])
+            self.tags_by_name = {tag['name']: tag for tag in self.tags_by_id.values()}
+            self.latest_contact_id = snapshot['latestContactId']
+            self.latest_tag_id = snapshot['latestTagId']
+            self.contact_count = len(snapshot['contactsById'])
+            self.oldest_contact_id = 1
+            self.start_generation()
+            self.reset_test_controls()
+            self.evict_contacts()
+            return self.contact_count
+
+    @staticmethod
+    def load_snapshot(path):
+        # Unpickling a million small objects is several times faster without the
+        # cyclic garbage collector scanning them as they are created. They are not
+        # frozen afterwards, since frozen objects stay in the permanent generation
+        # until gc.unfreeze(), and every restore would add another snapshot to it.
+        gc.disable()
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            columns = state['contacts']
+            contacts = list(map(Contact, columns['ids'], columns['emails'], columns['tagIds'], columns['fields']))
+            snapshot = {
+                'contactsById': dict(zip(columns['ids'], contacts)),
+                'contactsByEmail': dict(zip(columns['emails'], contacts)),
+                'tagsById': {tag['id']: tag for tag in state['tags']},
+                'latestContactId': state['latestContactId'],
+                'latestTagId': state['latestTagId']
+            }
+        finally:
+            gc.enable()
+        return snapshot
+
+    # Set the most contacts to keep, or None to keep them all, evicting the oldest
+    # contacts if there are more
+    def set_max_contacts(self, max_contacts):
+        with self.lock:
+            self.max_contacts = max_contacts
+            self.evict_contacts()
+
+    # Return the number of contacts, how many have been evicted, and roughly how
+    # many bytes they take, measured on a sample of the contacts
+    def get_memory_usage(self, sample_size=1000):
+        with self.lock:
+            sample = list(itertools.islice(self.contacts_by_id.values(), sample_size))
+            index_bytes = sum(
+                sys.getsizeof(index.base) + sys.getsizeof(index.changes)
+                for index in [self.contacts_by_id, self.contacts_by_email]
+            )
+            contact_bytes = sum(contact.size() for contact in sample) / len(sample) if sample else 0
+            total_bytes = round(index_bytes + contact_bytes * self.contact_count)
+            return {
+                'contacts': self.contact_count,
+                'maxContacts': self.max_contacts,
+                'evictedContacts': self.evicted_contacts,
+                'bytes': total_bytes,
+                'bytesPerContact': round(total_bytes / self.contact_count) if self.contact_count else None
+            }
+
+    def is_broken(self):
+        with self.lock:
+            return self.broken
+
+    def set_broken(self, broken):
+        with self.lock:
+            self.broken = broken
+
+    def add_slack_payload(self, payload):
+        with self.lock:
+            self.slack_payloads.append(payload)
+
+    def get_slack_payloads(self):
+        with self.lock:
+            return list(self.slack_payloads)
+
+    def start_call(self, route, connection):
+        with self.lock:
+            self.connections.add(connection)
+            self.call_counts[route] += 1
+            self.in_flight[route] += 1
+            self.max_in_flight[route] = max(self.max_in_flight[route], self.in_flight[route])
+
+    def finish_call(self, route):
+        with self.lock:
+            # Calls that started before a reset are not counted after it
+            if self.in_flight[route] > 0:
+                self.in_flight[route] -= 1
+
+    def get_connection_count(self):
+        with self.lock:
+            return len(self.connections)
+
+    def get_concurrency(self):
+        with self.lock:
+            return {route: {'current': self.in_flight[route], 'max': self.max_in_flight[route]} for route in self.max_in_flight}
+
+    def get_call_counts(self):
+        with self.lock:
+            return dict(self.call_counts)
+
+    def record_call(self, route, path, status, request_bytes, response_bytes, duration):
+        with self.lock:
+            self.recent_calls.append({
+                'route': route,
+                'path': path,
+                'status': status,
+                'requestBytes': request_bytes,
+                'responseBytes': response_bytes
+            })
+            metrics = self.metrics.get(route)
+            if not metrics:
+                metrics = self.metrics[route] = {
+                    'requests': collections.Counter(),
+                    'requestBytes': 0,
+                    'responseBytes': 0,
+                    'buckets': [0] * len(LATENCY_BUCKETS),
+                    'durationSum': 0.0
+                }
+            metrics['requests'][str(status)] += 1
+            metrics['requestBytes'] += request_bytes
+            metrics['responseBytes'] += response_bytes
+            # Histogram buckets are not cumulative here; get_metrics makes them so
+            metrics['buckets'][next(i for i, bound in enumerate(LATENCY_BUCKETS) if duration <= bound)] += 1
+            metrics['durationSum'] += duration
+
+    def get_recent_calls(self):
+        with self.lock:
+            return list(self.recent_calls)
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                route: {
+                    'requests': dict(metrics['requests']),
+                    'requestBytes': metrics['requestBytes'],
+                    'responseBytes': metrics['responseBytes'],
+                    'duration': {
+                        'buckets': dict(zip(
+                            (format_bound(bound) for bound in LATENCY_BUCKETS),
+                            itertools.accumulate(metrics['buckets'])
+                        )),
+                        'sum': metrics['durationSum'],
+                        'count': sum(metrics['buckets'])
+                    }
+                }
+                for route, metrics in self.metrics.items()
+            }
+
+    def set_fault(self, route, config):
+        with self.lock:
+            if config:
+                self.faults[route] = Fault(config)
+            else:
+                self.faults.pop(route, None)
+
+    def get_faults(self):
+        with self.lock:
+            return {route: fault.config for route, fault in self.faults.items()}
+
+    # Return the fault configuration of a route, or None, and the seconds until
+    # its rate limit lets a call through, or 0 if it does now
+    def take_fault(self, route):
+        with self.lock:
+            fault = self.faults.get(route)
+            if not fault:
+                return None, 0
+            return fault.config, fault.bucket.take() if fault.bucket else 0
+
+# Each test run has its own Store, picked by the X-Test-Run header of a request, so
+# that test runs sharing one mock do not see each other's contacts, tags, Slack
+# payloads, faults or counts. Requests without the header share the default Store.
+TEST_RUN_HEADER = 'X-Test-Run'
+
+class Tenants:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stores = {}
+
+    def get(self, test_run):
+        with self.lock:
+            store = self.stores.get(test_run)
+            if store is None:
+                store = self.stores[test_run] = Store()
+            return store
+
+class StoreManager(multiprocessing.managers.BaseManager):
+    pass
+
+tenants = Tenants()
+
+# In the manager process, Tenants() is the one Tenants of that process, and
+# Tenants.get returns a proxy to the Store that already exists there
+StoreManager.register('Tenants', lambda: tenants, method_to_typeid={'get': 'TenantStore'})
+StoreManager.register('TenantStore', lambda store: store, create_method=False)
+# The Stores of the test runs seen by this process, or proxies to them when
+# serving with several workers
+tenant_stores = {}
+
+def get_store(test_run=''):
+    store = tenant_stores.get(test_run)
+    if store is None:
+        store = tenant_stores.setdefault(test_run, tenants.get(test_run))
+    return store
+
+# The Store of the test run of the current request, or the default Store outside of requests
+store = LocalProxy(lambda: get_store(request.headers.get(TEST_RUN_HEADER, '') if has_request_context() else ''))
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    # Take a token and return 0, or return the seconds until a token is available
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class Fault:
+    def __init__(self, config):
+        self.config = config
+        rate_limit = config.get('rateLimit')
+        self.bucket = TokenBucket(rate_limit['rate'], rate_limit['burst']) if rate_limit else None
+
+LATENCY_DISTRIBUTIONS = {
+    'uniform': lambda latency: random.uniform(latency['min'], latency['max']),
+    'exponential': lambda latency: random.expovariate(1 / latency['mean']),
+    'lognormal': lambda latency: random.lognormvariate(math.log(latency['median']), latency['sigma'])
+}
+
+# Draw a delay in seconds from the latency distribution of a fault
+def fault_delay(config):
+    latency = config.get('latency')
+    if not latency:
+        return 0
+    return max(0, LATENCY_DISTRIBUTIONS[latency['distribution']](latency))
+
+# Return an error message if the configuration of a fault is invalid, otherwise None
+def validate_fault(config):
+    if not isinstance(config, dict):
+        return "each fault must be an object"
+    latency = config.get('latency')
+    if latency is not None:
+        required = {'uniform': ['min', 'max'], 'exponential': ['mean'], 'lognormal': ['median', 'sigma']}
+        keys = required.get(latency.get('distribution') if isinstance(latency, dict) else None)
+        if keys is None:
+            return "latency.distribution must be one of " + ', '.join(required)
+        if not all(isinstance(latency.get(key), (int, float)) and latency[key] >= 0 for key in keys):
+            return "latency needs non-negative " + ' and '.join(keys)
+        if latency.get('mean') == 0 or latency.get('median') == 0 or latency.get('min', 0) > latency.get('max', 0):
+            return "latency needs a positive mean or median, and min at most max"
+    failure_rate = config.get('failureRate', 0)
+    if not isinstance(failure_rate, (int, float)) or failure_rate < 0 or failure_rate > 1:
+        return "failureRate must be a number between 0 and 1"
+    rate_limit = config.get('rateLimit')
+    if rate_limit is not None:
+        if not isinstance(rate_limit, dict) or not all(isinstance(rate_limit.get(key), (int, float)) and rate_limit[key] > 0 for key in ['rate', 'burst']):
+            return "rateLimit needs positive rate and burst"
+    return None
 
-slack_payloads = []
+#-------------------
+# Test Endpoints
 
 # Only used as a readiness probe
 @app.route('/')
@@ -32,32 +715,183 @@ def root():
 def reset():
     log_request()
 
-    global is_broken
-    is_broken = False
+    store.reset()
+
+    return log_result(jsonify({'result': 'OK'}), 204)
+
+@app.route('/test/break', methods=['POST'])
+def break_server():
+    log_request()
+
+    store.set_broken(True)
+    return log_result(jsonify({'result': 'OK'}), 204)
 
-    global contacts
-    contacts = []
+# Create synthetic contacts in one call. The body says how many contacts to create,
+# and which fraction of them should get each tag, e.g.
+# {"contacts": 100000, "tags": {"tag1": 0.5, "newsletter": 1.0}, "seed": 42}
+# Tags that do not exist are created. The same seed gives the same assignments.
+@app.route('/test/seed', methods=['POST'])
+def seed():
+    log_request()
 
-    global latest_contact_id
-    latest_contact_id = 0
+    parameters = get_json_object()
+    if parameters is None:
+        return log_result(jsonify({"error":"body must be a JSON object"}), 400)
+    count = parameters.get('contacts')
+    tag_fractions = parameters.get('tags', {})
+    random_seed = parameters.get('seed')
+    # bool is an int in Python, but true is not a number of contacts
+    if not isinstance(count, int) or isinstance(count, bool) or count < 0:
+        return log_result(jsonify({"error":"contacts must be a non-negative integer"}), 400)
+    if not isinstance(tag_fractions, dict):
+        return log_result(jsonify({"error":"tags must map tag names to fractions"}), 400)
+    for fraction in tag_fractions.values():
+        if not isinstance(fraction, (int, float)) or isinstance(fraction, bool) or fraction < 0 or fraction > 1:
+            return log_result(jsonify({"error":"tag fractions must be numbers between 0 and 1"}), 400)
+    if random_seed is not None and (not isinstance(random_seed, (int, str)) or isinstance(random_seed, bool)):
+        return log_result(jsonify({"error":"seed must be an integer or a string"}), 400)
+
+    result = store.seed(count, tag_fractions, random_seed)
+    if not result:
+        return log_result(jsonify({"error":"duplicate"}), 422)
+    return log_result(jsonify(result), 201)
+
+# Save contacts, tags and id counters under a name, e.g. {"name": "baseline"}
+@app.route('/test/snapshot', methods=['POST'])
+def snapshot():
+    log_request()
 
-    global slack_payloads
-    slack_payloads = []
+    path, error = get_snapshot_path()
+    if error:
+        return log_result(jsonify({"error":error}), 400)
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    count = store.save_snapshot(path)
+    return log_result(jsonify({'contacts': count, 'bytes': os.path.getsize(path)}), 201)
+
+# Replace contacts, tags and id counters with a saved snapshot, e.g. {"name": "baseline"}.
+# Like /test/reset, this also clears the test controls. Restoring the same snapshot
+# again is nearly free, since it is kept in memory after it has been loaded once.
+@app.route('/test/restore', methods=['POST'])
+def restore():
+    log_request()
+
+    path, error = get_snapshot_path()
+    if error:
+        return log_result(jsonify({"error":error}), 400)
+    if not os.path.exists(path):
+        return log_result(jsonify({"error":"snapshot not found"}), 404)
+    count = store.restore_snapshot(path)
+    return log_result(jsonify({'contacts': count}), 200)
+
+# Set the fraction of requests that are written to the request log, 0 to switch it off
+@app.route('/test/log', methods=['POST'])
+def configure_log():
+    log_request()
 
+    parameters = get_json_object()
+    if parameters is None:
+        return log_result(jsonify({"error":"body must be a JSON object"}), 400)
+    sample_rate = parameters.get('sampleRate')
+    if not isinstance(sample_rate, (int, float)) or sample_rate < 0 or sample_rate > 1:
+        return log_result(jsonify({"error":"sampleRate must be a number between 0 and 1"}), 400)
+    request_log.sample_rate = sample_rate
     return log_result(jsonify({'result': 'OK'}), 204)
 
-@app.route('/test/break', methods=['POST'])
-def break_server():
+# Configure faults per systeme.io route, keyed like the call counts. For example
+# {"GET /api/tags": {
+#     "latency": {"distribution": "lognormal", "median": 0.2, "sigma": 0.5},
+#     "failureRate": 0.01,
+#     "rateLimit": {"rate": 2, "burst": 5}
+# }}
+# delays every tag lookup, fails 1% of them with 500, and answers with 429 and
+# Retry-After beyond 2 calls per second. Uniform latency takes min and max, and
+# exponential latency takes mean, in seconds. Posting replaces the faults of the
+# given routes; an empty object for a route removes its faults.
+@app.route('/test/faults', methods=['GET', 'POST'])
+def configure_faults():
     log_request()
 
-    global is_broken
-    is_broken = True
+    if request.method == 'GET':
+        return log_result(jsonify(store.get_faults()), 200)
+
+    new_faults = get_json_object()
+    if new_faults is None:
+        return log_result(jsonify({"error":"faults must be an object keyed on route"}), 400)
+    routes = systeme_io_routes()
+    for route, config in new_faults.items():
+        if route not in routes:
+            return log_result(jsonify({"error":f"unknown route {route}, expected one of {', '.join(sorted(routes))}"}), 400)
+        error = validate_fault(config)
+        if error:
+            return log_result(jsonify({"error":error}), 400)
+
+    for route, config in new_faults.items():
+        store.set_fault(route, config)
     return log_result(jsonify({'result': 'OK'}), 204)
 
+# Report the number of contacts and roughly how many bytes of memory they take,
+# to size soak tests. Posting {"maxContacts": 100000} caps the number of contacts,
+# evicting the oldest ones to make room for new ones, and {"maxContacts": null}
+# removes the cap. The cap defaults to MOCK_MAX_CONTACTS and is cleared by a reset.
+@app.route('/test/memory', methods=['GET', 'POST'])
+def memory():
+    log_request()
+
+    if request.method == 'POST':
+        parameters = get_json_object()
+        if parameters is None:
+            return log_result(jsonify({"error":"body must be a JSON object"}), 400)
+        max_contacts = parameters.get('maxContacts')
+        if max_contacts is not None and (not isinstance(max_contacts, int) or max_contacts < 1):
+            return log_result(jsonify({"error":"maxContacts must be a positive integer or null"}), 400)
+        store.set_max_contacts(max_contacts)
+    return log_result(jsonify(store.get_memory_usage()), 200)
+
+# Number of calls per systeme.io and Slack route since the last reset
+@app.route('/test/calls', methods=['GET'])
+def get_call_counts():
+    log_request()
+    return log_result(jsonify(store.get_call_counts()), 200)
+
+# Number of calls per systeme.io and Slack route being handled now, and the most
+# that have been handled at the same time since the last reset
+@app.route('/test/concurrency', methods=['GET'])
+def get_concurrency():
+    log_request()
+    return log_result(jsonify(store.get_concurrency()), 200)
+
+# Number of TCP connections that systeme.io and Slack calls have been made on since
+# the last reset. Connections are kept alive, so a client that reuses its
+# connection makes many calls on one.
+@app.route('/test/connections', methods=['GET'])
+def get_connection_count():
+    log_request()
+    return log_result(jsonify({'connections': store.get_connection_count()}), 200)
+
+# The latest systeme.io and Slack calls since the last reset, oldest first, with
+# their route, path, status, and request and response bytes
+@app.route('/test/requests', methods=['GET'])
+def get_recent_calls():
+    log_request()
+    return log_result(jsonify(store.get_recent_calls()), 200)
+
+# Requests per status, request and response bytes, and latency histograms per
+# systeme.io and Slack route since the last reset, in the Prometheus text format,
+# or as JSON with ?format=json
+@app.route('/test/metrics', methods=['GET'])
+def get_metrics():
+    log_request()
+    metrics = store.get_metrics()
+    if request.args.get('format') == 'json':
+        return log_result(jsonify(metrics), 200)
+    response = app.response_class(format_prometheus_metrics(metrics), mimetype='text/plain')
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return log_result(response, 200)
+
 @app.route('/test/slack/payloads', methods=['GET'])
 def get_slack_payloads():
     log_request()
-    return log_result(jsonify(slack_payloads), 200)
+    return log_result(jsonify(store.get_slack_payloads()), 200)
 
 #-------------------
 # Systeme.IO Endpoints
@@ -66,12 +900,12 @@ def get_slack_payloads():
 def add_contact():
     log_request()
 
-    global is_broken
-    if is_broken:
+    if store.is_broken():
         return log_result(jsonify({"error":"emulating broken backend"}), 500)
 
-    global latest_contact_id
-    global contacts
+    fault = inject_fault()
+    if fault:
+        return fault
 
     api_key = request.headers.get('X-API-Key')
     if not api_key or len(api_key) == 0:
@@ -83,10 +917,6 @@ def add_contact():
     if not email:
         return log_result(jsonify({"error":"email parameter is missing"}), 400)
 
-    for contact in contacts:
-        if contact['email'] == email:
-            return log_result(jsonify({"error":"duplicate"}), 422)
-
     # If the contact has fields, verify that fields is a list of dictionaries, each of which has 'slug' and 'value' keys
     fields = new_contact.get('fields')
     if fields:
@@ -98,31 +928,29 @@ def add_contact():
             if 'slug' not in field or 'value' not in field:
                 return log_result(jsonify({"error":"each field must have 'slug' and 'value' keys"}), 400)
 
-    latest_contact_id += 1
-    contact = {
-        "id": latest_contact_id,
-        "email": email,
-        "tags": [],
-        "fields": new_contact.get('fields', [])
-    }
-    contacts.append(contact)
+    contact = store.add_contact(email, new_contact.get('fields', []))
+    if not contact:
+        return duplicate_email_error()
+    # Logged, so that a replay can tell which calls are about this contact
+    g.created_id = contact['id']
     return log_result(jsonify(contact), 201)
 
 @app.route('/api/contacts/<int:contact_id>', methods=['PATCH'])
 def update_contact(contact_id):
     log_request()
 
-    global is_broken
-    if is_broken:
+    if store.is_broken():
         return log_result(jsonify({"error":"emulating broken backend"}), 500)
 
-    global contacts
+    fault = inject_fault()
+    if fault:
+        return fault
 
     api_key = request.headers.get('X-API-Key')
     if not api_key or len(api_key) == 0:
         return log_result(jsonify({"error":"unauthorized"}), 401)
 
-    contact = next((contact for contact in contacts if contact['id'] == contact_id), None)
+    contact = store.get_contact(contact_id)
     if not contact:
         return log_result(jsonify({"error":"contact not found"}), 404)
 
@@ -132,19 +960,11 @@ def update_contact(contact_id):
 
     new_contact_data = request.get_json()
 
-    if 'email' in new_contact_data:
-        contact['email'] = new_contact_data['email']
-
-    if 'fields' in new_contact_data:
-        fields = new_contact_data['fields']
-        for field in fields:
-            field_slug = field['slug']
-            field_value = field['value']
-            existing_field = next((f for f in contact['fields'] if f['slug'] == field_slug), None)
-            if existing_field:
-                existing_field['value'] = field_value
-            else:
-                contact['fields'].append({'slug': field_slug, 'value': field_value})
+    contact, error = store.update_contact(contact_id, new_contact_data.get('email'), new_contact_data.get('fields', []))
+    if error == "duplicate":
+        return duplicate_email_error()
+    if error:
+        return log_result(jsonify({"error":error}), 404)
 
     return log_result(jsonify(contact), 200)
 
@@ -152,12 +972,12 @@ def update_contact(contact_id):
 def assign_tag(contact_id):
     log_request()
 
-    global is_broken
-    if is_broken:
+    if store.is_broken():
         return log_result(jsonify({"error":"emulating broken backend"}), 500)
 
-    global contacts
-    global tags
+    fault = inject_fault()
+    if fault:
+        return fault
 
     api_key = request.headers.get('X-API-Key')
     if not api_key or len(api_key) == 0:
@@ -167,56 +987,69 @@ def assign_tag(contact_id):
     if not tag_id:
         return log_result(jsonify({"error":"tagId parameter is missing"}), 400)
 
-    contact = next((contact for contact in contacts if contact['id'] == contact_id), None)
-    if not contact:
-        return log_result(jsonify({"error":"contact not found"}), 404)
-
-    # If the contact already has the tag, act as if the tag was successfully assigned
-    if next((tag for tag in contact['tags'] if tag['id'] == tag_id), None):
-        return log_result(jsonify(contact), 204)
-
-    # Look up the tag by ID and assign it to the contact
-    tag = next((tag for tag in tags if tag['id'] == tag_id), None)
-    if not tag:
-        return log_result(jsonify({"error":"tag not found"}), 404)
-    contact['tags'].append(tag)
+    contact, error = store.assign_tag(contact_id, tag_id)
+    if error:
+        return log_result(jsonify({"error":error}), 404)
     return log_result(jsonify(contact), 204)
 
 @app.route('/api/contacts', methods=['GET'])
 def list_contacts():
     log_request()
 
-    global is_broken
-    if is_broken:
+    if store.is_broken():
         return log_result(jsonify({"error":"emulating broken backend"}), 500)
 
+    fault = inject_fault()
+    if fault:
+        return fault
+
     email = request.args.get('email')
 
-    global contacts
     if email:
+        validators = store.get_contact_validators(email)
+        if is_not_modified(*validators):
+            return not_modified(*validators)
         # Return a list containing only the matching contact
-        selection = list(contact for contact in contacts if contact['email'] == email)
-        return log_result(jsonify({'items': selection, 'hasMore': False}), 200)
-    else:
-        return log_result(jsonify({'items': contacts, 'hasMore': False}), 200)
+        contact = store.get_contact_by_email(email)
+        selection = [contact] if contact else []
+        return log_result(add_validators(jsonify({'items': selection, 'hasMore': False}), *validators), 200)
+
+    starting_after, limit, error = get_page_parameters()
+    if error:
+        return log_result(jsonify({"error":error}), 400)
+    validators = store.get_collection_validators('contacts')
+    if is_not_modified(*validators):
+        return not_modified(*validators)
+    items, has_more = store.page_contacts(starting_after, limit)
+    return log_result(add_validators(jsonify({'items': items, 'hasMore': has_more}), *validators), 200)
 
 @app.route('/api/tags', methods=['GET'])
 def list_tags():
     log_request()
 
-    global is_broken
-    if is_broken:
+    if store.is_broken():
         return log_result(jsonify({"error":"emulating broken backend"}), 500)
 
+    fault = inject_fault()
+    if fault:
+        return fault
+
     query = request.args.get('query')
+    starting_after, limit, error = (0, 0, None) if query else get_page_parameters()
+    if error:
+        return log_result(jsonify({"error":error}), 400)
+    validators = store.get_collection_validators('tags')
+    if is_not_modified(*validators):
+        return not_modified(*validators)
 
-    global tags
     if query:
         # Return a list containing only the matching tags
-        selection = list(tag for tag in tags if tag['name'] == query)
-        return log_result(jsonify({'items': selection, 'hasMore': False}), 200)
-    else:
-        return log_result(jsonify({'items': tags, 'hasMore': False}), 200)
+        tag = store.get_tag_by_name(query)
+        selection = [tag] if tag else []
+        return log_result(add_validators(jsonify({'items': selection, 'hasMore': False}), *validators), 200)
+
+    items, has_more = store.page_tags(starting_after, limit)
+    return log_result(add_validators(jsonify({'items': items, 'hasMore': has_more}), *validators), 200)
 
 #-------------------
 # Slack Endpoints
@@ -229,30 +1062,306 @@ def post_message():
     if not authorization or authorization != 'Bearer 123':
         return log_result(jsonify({"error":"unauthorized"}), 401)
 
-    global slack_payloads
-    slack_payloads.append(request.get_json())
+    store.add_slack_payload(request.get_json())
 
     return log_result(jsonify({'result': 'OK'}), 200)
 
 #-------------------
 # Helper Functions
 
+# Like the real API, list endpoints return at most limit items (10-100, default 10)
+# and continue after the id given in startingAfter
+MIN_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+DEFAULT_PAGE_SIZE = 10
+
+# Answer a taken email like systeme.io does, with an API Platform validation error
+def duplicate_email_error():
+    response = jsonify({
+        'type': 'https://tools.ietf.org/html/rfc2616#section-10',
+        'title': 'An error occurred',
+        'detail': 'email: This value is already used.',
+        'violations': [{'propertyPath': 'email', 'message': 'This value is already used.', 'code': None}]
+    })
+    response.mimetype = 'application/problem+json'
+    return log_result(response, 422)
+
+# Whether the client's copy of a lookup is current, going by If-None-Match, or by
+# If-Modified-Since if there is no If-None-Match, as RFC 9110 asks
+def is_not_modified(etag, modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    return request.if_modified_since is not None and int(modified) <= request.if_modified_since.timestamp()
+
+def not_modified(etag, modified):
+    return log_result(add_validators(app.response_class(status=304), etag, modified), 304)
+
+def add_validators(response, etag, modified):
+    response.set_etag(etag)
+    response.last_modified = modified
+    return response
+
+# Return starting_after, limit and an error message, which is None if the parameters are valid
+def get_page_parameters():
+    try:
+        starting_after = int(request.args.get('startingAfter', 0))
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return None, None, "startingAfter and limit must be integers"
+    if limit < MIN_PAGE_SIZE or limit > MAX_PAGE_SIZE:
+        return None, None, f"limit must be between {MIN_PAGE_SIZE} and {MAX_PAGE_SIZE}"
+    return starting_after, limit, None
+
+# Return the JSON object in the request body, or None if the body is missing, not JSON or not an object
+def get_json_object():
+    body = request.get_json(silent=True)
+    return body if isinstance(body, dict) else None
+
+SNAPSHOT_DIR = os.environ.get('MOCK_SNAPSHOT_DIR', '/tmp/mock-snapshots')
+
+# Return the path of the snapshot named in the request body and an error message,
+# which is None if the name is valid
+def get_snapshot_path():
+    name = (request.get_json(silent=True) or {}).get('name')
+    if not isinstance(name, str) or not re.match(r'^[a-zA-Z0-9_-]+$', name):
+        return None, "name must consist of letters, digits, '_' and '-'"
+    return os.path.join(SNAPSHOT_DIR, name + '.pickle'), None
+
+# Writes one JSON line per request/response pair from a background thread, so
+# that request handlers only pay for putting a record on a queue. The file is
+# rotated by size and logging can be sampled or switched off entirely.
+#
+# Each batch is appended with a single write, so worker processes that share the
+# file do not interleave their lines, and a writer that finds the file rotated
+# by another process reopens it.
+class RequestLog:
+    BATCH_SIZE = 256
+
+    def __init__(self, path, sample_rate=1.0, max_bytes=10_000_000, backups=3):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.start()
+
+    # Start the writer thread. A forked process must call this again, since it
+    # does not inherit the thread.
+    def start(self):
+        self.queue = queue.Queue()
+        self.fd = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def should_log(self):
+        return self.sample_rate >= 1.0 or (self.sample_rate > 0.0 and random.random() < self.sample_rate)
+
+    def put(self, record):
+        self.queue.put(record)
+
+    # Block until everything put so far has been written
+    def flush(self):
+        self.queue.join()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(''.join(json.dumps(record) + '\n' for record in batch))
+            except OSError as e:
+                print(f'Could not write request log: {e}', flush=True)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def write(self, text):
+        if self.fd is not None and not self.is_current():
+            os.close(self.fd)
+            self.fd = None
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self.fd, text.encode())
+        if os.fstat(self.fd).st_size >= self.max_bytes:
+            self.rotate()
+
+    # Whether the open file is still the one at path, that is, not rotated by another process
+    def is_current(self):
+        try:
+            return os.stat(self.path).st_ino == os.fstat(self.fd).st_ino
+        except FileNotFoundError:
+            return False
+
+    def rotate(self):
+        is_current = self.is_current()
+        os.close(self.fd)
+        self.fd = None
+        if not is_current:
+            return
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+request_log = RequestLog(
+    os.environ.get('MOCK_LOG_PATH', '/var/log/requests.txt'),
+    sample_rate=float(os.environ.get('MOCK_LOG_SAMPLE_RATE', '1.0')),
+    max_bytes=int(os.environ.get('MOCK_LOG_MAX_BYTES', '10000000')),
+    backups=int(os.environ.get('MOCK_LOG_BACKUPS', '3'))
+)
+atexit.register(request_log.flush)
+os.register_at_fork(after_in_child=lambda: request_log.start())
+
+def route_key():
+    return f'{request.method} {request.url_rule.rule}'
+
+def systeme_io_routes():
+    return {
+        f'{method} {rule.rule}'
+        for rule in app.url_map.iter_rules() if rule.rule.startswith('/api/') and 'chat.postMessage' not in rule.rule
+        for method in rule.methods - {'HEAD', 'OPTIONS'}
+    }
+
+# Apply the faults configured for the current route. Return an error response to
+# send instead of handling the request, or None to handle it normally.
+def inject_fault():
+    config, wait = store.take_fault(route_key())
+    if not config:
+        return None
+    if wait:
+        response = jsonify({"error":"too many requests"})
+        response.headers['Retry-After'] = str(math.ceil(wait))
+        return log_result(response, 429)
+    time.sleep(fault_delay(config))
+    if random.random() < config.get('failureRate', 0):
+        return log_result(jsonify({"error":"emulating failing backend"}), 500)
+    return None
+
+def format_prometheus_metrics(metrics):
+    def labels(route, **extra):
+        method, _, path = route.partition(' ')
+        pairs = dict(method=method, path=path, **extra)
+        return ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs.items())
+
+    lines = [
+        '# HELP mock_requests_total Requests handled by the mock.',
+        '# TYPE mock_requests_total counter'
+    ]
+    for route, route_metrics in metrics.items():
+        for status, count in route_metrics['requests'].items():
+            lines.append(f'mock_requests_total{{{labels(route, status=status)}}} {count}')
+    for name, key, description in [
+        ('mock_request_bytes_total', 'requestBytes', 'Bytes in request bodies.'),
+        ('mock_response_bytes_total', 'responseBytes', 'Bytes in response bodies.')
+    ]:
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} counter']
+        for route, route_metrics in metrics.items():
+            lines.append(f'{name}{{{labels(route)}}} {route_metrics[key]}')
+    lines += [
+        '# HELP mock_request_duration_seconds Time spent handling requests.',
+        '# TYPE mock_request_duration_seconds histogram'
+    ]
+    for route, route_metrics in metrics.items():
+        duration = route_metrics['duration']
+        for bound, count in duration['buckets'].items():
+            lines.append(f'mock_request_duration_seconds_bucket{{{labels(route, le=bound)}}} {count}')
+        lines.append(f'mock_request_duration_seconds_sum{{{labels(route)}}} {duration["sum"]}')
+        lines.append(f'mock_request_duration_seconds_count{{{labels(route)}}} {duration["count"]}')
+    return '\n'.join(lines) + '\n'
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
 def log_request():
-    timestamp = str(time.time())
-    with open('/var/log/requests.txt', 'a') as f:
-        f.write('===================\n')
-        f.write(timestamp + '\n\n')
-        f.write(request.method + ' ' + request.url + '\n')
-        f.write(str(request.headers))
-        f.write(str(request.get_data(as_text=True)) + '\n')
+    g.start_time = time.time()
+    if request.path.startswith('/api/'):
+        store.start_call(route_key(), (request.remote_addr, request.environ.get('REMOTE_PORT')))
+        g.call_started = True
+    g.log_this_request = request_log.should_log()
+
+@app.teardown_request
+def finish_call(exception):
+    if g.get('call_started'):
+        store.finish_call(route_key())
 
 def log_result(response, status_code):
-    with open('/var/log/requests.txt', 'a') as f:
-        f.write('-------------------\n')
-        f.write(str(status_code) + '\n')
-        f.write(str(response.json) + '\n')
+    duration = time.time() - g.start_time
+    path = request.full_path if request.query_string else request.path
+    if g.get('call_started'):
+        store.record_call(route_key(), path, status_code, request.content_length or 0, response.content_length or 0, duration)
+    if g.log_this_request:
+        record = {
+            'timestamp': g.start_time,
+            'method': request.method,
+            'path': path,
+            'status': status_code,
+            'duration': duration,
+            'requestBytes': request.content_length or 0,
+            'responseBytes': response.content_length or 0,
+            'body': request.get_data(as_text=True),
+            'testRun': request.headers.get(TEST_RUN_HEADER)
+        }
+        if g.get('created_id') is not None:
+            record['createdId'] = g.created_id
+        request_log.put(record)
+    # The same duration as in the request log, so that a replay can compare its latency with that of the log
+    response.headers['Server-Timing'] = f'app;dur={duration * 1000:.3f}'
     return response, status_code
 
+# Serve from several processes that accept connections on the same socket and
+# share the Stores, hosted by a manager process
+def serve_with_workers(workers, host, port):
+    context = multiprocessing.get_context('fork')
+    manager = StoreManager(ctx=context)
+    manager.start()
+
+    # Exit through sys.exit on SIGTERM, so that the workers and the manager are stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    listener = socket.create_server((host, port), backlog=128)
+    processes = [
+        context.Process(target=serve_worker, args=(listener, manager.address), daemon=True)
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+# Serve in a worker process, with the Stores of the manager at address
+def serve_worker(listener, address):
+    global tenants
+    manager = StoreManager(address=address)
+    manager.connect()
+    tenants = manager.Tenants()
+    tenant_stores.clear()
+    serve_forever(listener)
+
+# Serve from a thread of this process, e.g. for tests that should not need the
+# mock container. Return the server, with its base URL in server.url; call
+# server.close() to stop it.
+def serve_in_background(host='127.0.0.1', port=0):
+    server = waitress.create_server(app, host=host, port=port, threads=int(os.environ.get('MOCK_THREADS', '32')))
+    server.url = f'http://{host}:{server.effective_port}'
+    threading.Thread(target=server.run, daemon=True).start()
+    return server
+
+# Serve with waitress rather than the Flask development server, since the latter
+# closes the connection after every response, and the real API keeps it alive
+def serve_forever(listener):
+    waitress.serve(app, sockets=[listener], threads=int(os.environ.get('MOCK_THREADS', '32')))
+
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8081)
+    workers = int(os.environ.get('MOCK_WORKERS', '1'))
+    port = int(os.environ.get('MOCK_PORT', '8081'))
+    if workers > 1:
+        serve_with_workers(workers, '0.0.0.0', port)
+    else:
+        serve_forever(socket.create_server(('0.0.0.0', port), backlog=128))
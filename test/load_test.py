@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# Drive add-systeme-io-contact.php with a mix of submissions and report
+# throughput, latency and upstream calls as JSON, so runs can be compared.
+#
+# Hold 20 submissions in flight for 30 seconds:
+#   load_test.py --concurrency 20 --duration 30
+# Start 50 submissions per second regardless of how fast they complete:
+#   load_test.py --rate 50 --duration 30 --mix new=1,tags=1
+# Measure the effect of slow tag lookups:
+#   load_test.py --faults '{"GET /api/tags": {"latency": {"distribution": "exponential", "mean": 0.5}}}'
+
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+
+import requests
+
+SCENARIOS = ['new', 'returning', 'rename', 'tags']
+FIRST_NAMES = ['John', 'Jane', 'Håkan', 'Chiyoko', 'Ana']
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'unknown scenario: {name}')
+        mix[name] = float(weight or 1)
+    return mix
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Load test add-systeme-io-contact.php')
+    parser.add_argument('--url', default='http://web:8080/add-systeme-io-contact.php')
+    parser.add_argument('--mock-url', default='http://localhost:8081')
+    parser.add_argument('--concurrency', type=int, default=10, help='submissions in flight (the worker pool size)')
+    parser.add_argument('--rate', type=float, help='start this many submissions per second instead of keeping the pool busy')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('new=4,returning=3,rename=2,tags=1'),
+                        help='relative weights of the scenarios ' + ','.join(SCENARIOS))
+    parser.add_argument('--tags', default='tag1,tag2,tag3', help='tags sent by the tags scenario')
+    parser.add_argument('--returning-contacts', type=int, default=1000, help='contacts to seed for the returning and rename scenarios')
+    parser.add_argument('--max-contacts', type=int, help='cap the contacts in the mock, evicting the oldest, for long soak runs')
+    parser.add_argument('--faults', type=json.loads, help='faults to inject into the mock, as JSON for its /test/faults endpoint')
+    parser.add_argument('--seed', type=int, help='random seed for the scenario mix')
+    parser.add_argument('--output', help='write the report to this file instead of stdout')
+    return parser.parse_args()
+
+# Nearest-rank percentile of a sorted list
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else None
+    }
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.run_id = uuid.uuid4().hex[:8]
+        self.new_contact_ids = itertools.count()
+        self.sessions = threading.local()
+        self.lock = threading.Lock()
+        self.results = []
+
+    def session(self):
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = requests.Session()
+        return self.sessions.session
+
+    def prepare(self):
+        requests.post(self.args.mock_url + '/test/reset').raise_for_status()
+        response = requests.post(self.args.mock_url + '/test/seed', json={'contacts': self.args.returning_contacts})
+        response.raise_for_status()
+        seeded = response.json()
+        self.returning_emails = [f'seed{i}@example.com' for i in range(seeded['firstId'], seeded['lastId'] + 1)]
+        if self.args.faults:
+            requests.post(self.args.mock_url + '/test/faults', json=self.args.faults).raise_for_status()
+        if self.args.max_contacts:
+            requests.post(self.args.mock_url + '/test/memory', json={'maxContacts': self.args.max_contacts}).raise_for_status()
+
+    def form_data(self, scenario):
+        with self.lock:
+            if scenario in ('returning', 'rename') and self.returning_emails:
+                email = self.random.choice(self.returning_emails)
+            else:
+                email = f'load-{self.run_id}-{next(self.new_contact_ids)}@example.com'
+            first_name = self.random.choice(FIRST_NAMES) if scenario == 'rename' else ''
+        form_data = {'email': email, 'first_name': first_name, 'redirect-to': 'https://example.com/success'}
+        if scenario == 'tags':
+            form_data['tags'] = self.args.tags
+        return form_data
+
+    def submit(self, scenario, scheduled_at):
+        form_data = self.form_data(scenario)
+        try:
+            response = self.session().post(self.args.url, data=form_data, allow_redirects=False)
+            status = str(response.status_code)
+        except requests.RequestException as e:
+            status = type(e).__name__
+        # Measure from when the submission should have started, so that a backlog
+        # in rate mode shows up as latency instead of being hidden
+        latency = time.perf_counter() - scheduled_at
+        with self.lock:
+            self.results.append((scenario, status, latency))
+
+    def choose_scenario(self):
+        with self.lock:
+            return self.random.choices(list(self.args.mix), weights=list(self.args.mix.values()))[0]
+
+    def run_closed_loop(self, deadline):
+        def worker():
+            while time.perf_counter() < deadline:
+                self.submit(self.choose_scenario(), time.perf_counter())
+        threads = [threading.Thread(target=worker) for _ in range(self.args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_open_loop(self, start, deadline):
+        interval = 1 / self.args.rate
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            for i in itertools.count():
+                scheduled_at = start + i * interval
+                if scheduled_at >= deadline:
+                    break
+                time.sleep(max(0, scheduled_at - time.perf_counter()))
+                executor.submit(self.submit, self.choose_scenario(), scheduled_at)
+
+    def run(self):
+        self.prepare()
+        start = time.perf_counter()
+        deadline = start + self.args.duration
+        if self.args.rate:
+            self.run_open_loop(start, deadline)
+        else:
+            self.run_closed_loop(deadline)
+        elapsed = time.perf_counter() - start
+        calls = requests.get(self.args.mock_url + '/test/calls').json()
+        memory = requests.get(self.args.mock_url + '/test/memory').json()
+        return self.report(elapsed, calls, memory)
+
+    def report(self, elapsed, calls, memory):
+        by_scenario = collections.defaultdict(list)
+        for scenario, _, latency in self.results:
+            by_scenario[scenario].append(latency)
+        # Slack notifications are not calls to systeme.io
+        upstream_calls = {route: count for route, count in calls.items() if 'chat.postMessage' not in route}
+        submissions = len(self.results)
+        return {
+            'config': {
+                'url': self.args.url,
+                'concurrency': self.args.concurrency,
+                'rate': self.args.rate,
+                'duration': self.args.duration,
+                'mix': self.args.mix,
+                'tags': self.args.tags,
+                'maxContacts': self.args.max_contacts,
+                'faults': self.args.faults
+            },
+            'elapsed': elapsed,
+            'submissions': submissions,
+            'throughput': submissions / elapsed,
+            'latency': summarize([latency for _, _, latency in self.results]),
+            'statuses': dict(collections.Counter(status for _, status, _ in self.results)),
+            'scenarios': {scenario: summarize(latencies) for scenario, latencies in by_scenario.items()},
+            'upstream': {
+                'calls': sum(upstream_calls.values()),
+                'callsPerSubmission': sum(upstream_calls.values()) / submissions if submissions else None,
+                'byRoute': upstream_calls
+            },
+            'mockMemory': memory
+        }
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    report = LoadTest(args).run()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+# Turn captured traffic into a trace, and replay the trace with its original
+# timing, or faster, to reproduce bursts such as a campaign launch on demand.
+# The report compares the status codes and latency of the replay with the
+# original run, as JSON. For systeme.io calls, both latencies are the time the
+# mock took to answer, as in its request log. For form posts, the original
+# latency is the server time in the access log, and the replayed one the round
+# trip, so they are not compared.
+#
+# Capture the systeme.io calls that the mock logged, and replay them against the mock 10 times as fast:
+#   replay.py capture /var/log/requests.txt --output trace.jsonl
+#   replay.py replay trace.jsonl --speed 10
+# Capture the form posts in a sanitized access log, and replay them against the script as fast as possible:
+#   replay.py capture access.log --output trace.jsonl
+#   replay.py replay trace.jsonl --speed 0
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import itertools
+import json
+import re
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+import requests
+
+from load_test import summarize
+
+FORM_PATH = '/add-systeme-io-contact.php'
+
+# A line in the common or combined log format, optionally followed by the time taken to
+# serve the request in microseconds (%D), as in LogFormat "%h %l %u %t \"%r\" %>s %b ... %D"
+ACCESS_LOG_LINE = re.compile(
+    r'^\S+ \S+ \S+ \[(?P<time>[^\]]+)\] "(?P<method>[A-Z]+) (?P<path>\S+)[^"]*" (?P<status>\d{3}) \S+'
+    r'(?: "[^"]*" "[^"]*")?(?: (?P<microseconds>\d+))?\s*$'
+)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Capture traffic into a trace, and replay it')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    capture = commands.add_parser('capture', help='parse mock request logs or access logs into a trace')
+    capture.add_argument('logs', nargs='+', help='mock request logs (JSON lines) or access logs, oldest first')
+    capture.add_argument('--test-run', help='only capture the mock requests of this test run')
+    capture.add_argument('--output', help='write the trace to this file instead of stdout')
+
+    replay = commands.add_parser('replay', help='replay a trace and compare it with the original run')
+    replay.add_argument('trace')
+    replay.add_argument('--url', default='http://web:8080' + FORM_PATH, help='the script, for traces of form posts')
+    replay.add_argument('--mock-url', default='http://localhost:8081', help='the mock, for traces of systeme.io calls')
+    replay.add_argument('--speed', type=float, default=1, help='speed-up of the original timing, 0 for as fast as possible')
+    replay.add_argument('--concurrency', type=int, default=50, help='requests in flight at most')
+    replay.add_argument('--test-run', help='the X-Test-Run header to replay with, a new one by default')
+    replay.add_argument('--output', help='write the report to this file instead of stdout')
+    return parser.parse_args()
+
+#-------------------
+# Capture
+
+# A trace is a JSON header line, then one JSON array per request, in the order they started:
+# [offset in seconds from the first request, method, path, status, duration or null, body or null, created id or null, segment]
+# Traces of form posts have no bodies, since access logs have none; the replay makes up a new contact for each.
+# Each test run has a mock state of its own, and ids restart and emails become free again at every /test/reset,
+# so the calls are split into segments, one per test run and stretch between two of its resets. The replay
+# gives each segment a state of its own.
+def capture(paths, test_run=None):
+    entries = []
+    kind = None
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                if line.lstrip().startswith('{'):
+                    entry = parse_mock_record(json.loads(line), test_run)
+                    line_kind = 'api'
+                else:
+                    entry = parse_access_log_line(line)
+                    line_kind = 'form'
+                if entry is None:
+                    continue
+                if kind and kind != line_kind:
+                    raise ValueError(f'{path} mixes mock requests and access log lines')
+                kind = line_kind
+                entries.append(entry)
+    entries.sort(key=lambda entry: entry[0])
+    entries = number_segments(entries)
+    spread_within_seconds(entries)
+    start = entries[0][0] if entries else 0
+    trace = [[round(timestamp - start, 6), *rest] for timestamp, *rest in entries]
+    header = {
+        'trace': 1,
+        'kind': kind or 'api',
+        'requests': len(trace),
+        'duration': trace[-1][0] if trace else 0,
+        'segments': len({entry[7] for entry in trace}),
+        'start': start
+    }
+    return header, trace
+
+# Only the systeme.io and Slack calls are captured, and the resets that separate segments, not the other
+# requests that control the mock. Until number_segments, the segment is the test run of the call.
+def parse_mock_record(record, test_run):
+    if not record['path'].startswith('/api/') and record['path'] != '/test/reset':
+        return None
+    if test_run is not None and record.get('testRun') != test_run:
+        return None
+    return [record['timestamp'], record['method'], record['path'], record['status'], record['duration'],
+            record['body'] or None, record.get('createdId'), record.get('testRun')]
+
+def parse_access_log_line(line):
+    match = ACCESS_LOG_LINE.match(line)
+    if not match or match['method'] != 'POST' or urllib.parse.urlsplit(match['path']).path != FORM_PATH:
+        return None
+    timestamp = datetime.datetime.strptime(match['time'], '%d/%b/%Y:%H:%M:%S %z').timestamp()
+    duration = int(match['microseconds']) / 1e6 if match['microseconds'] else None
+    return [timestamp, 'POST', match['path'], int(match['status']), duration, None, None, None]
+
+# Number the segments in the order they start, and drop the resets
+def number_segments(entries):
+    resets = collections.Counter()
+    segments = {}
+    calls = []
+    for entry in entries:
+        test_run = entry[7]
+        if entry[2] == '/test/reset':
+            resets[test_run] += 1
+            continue
+        entry[7] = segments.setdefault((test_run, resets[test_run]), len(segments))
+        calls.append(entry)
+    return calls
+
+# Access logs only have whole seconds, so spread the requests of each second evenly over it
+# rather than replay them as one burst
+def spread_within_seconds(entries):
+    for timestamp, group in itertools.groupby(entries, key=lambda entry: entry[0]):
+        group = list(group)
+        if len(group) > 1 and timestamp == int(timestamp):
+            for i, entry in enumerate(group):
+                entry[0] = timestamp + i / len(group)
+
+def write_trace(header, trace, f):
+    f.write(json.dumps(header) + '\n')
+    for entry in trace:
+        f.write(json.dumps(entry, separators=(',', ':'), ensure_ascii=False) + '\n')
+
+def read_trace(path):
+    with open(path, encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        return header, [json.loads(line) for line in f if line.strip()]
+
+#-------------------
+# Replay
+
+# The time the mock took to answer a call, from its Server-Timing header
+def server_duration(response):
+    match = re.search(r'\bapp;dur=([0-9.]+)', response.headers.get('Server-Timing', ''))
+    return float(match[1]) / 1000 if match else None
+
+class Replay:
+    def __init__(self, args, header, trace):
+        self.args = args
+        self.header = header
+        self.trace = trace
+        self.test_run = args.test_run or 'replay-' + uuid.uuid4().hex[:8]
+        self.sessions = threading.local()
+        self.lock = threading.Lock()
+        # Contacts get other ids in the replay than they had in the original run, by segment and original id
+        self.contact_ids = {}
+        # Set once the request that created a contact in the original run has finished in the replay, so that
+        # the requests for that contact are not sent before its new id is known
+        self.created = {(entry[7], entry[6]): threading.Event() for entry in trace if entry[6] is not None}
+        self.results = []
+
+    def session(self):
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = requests.Session()
+            self.sessions.session.headers['X-Test-Run'] = self.test_run
+        return self.sessions.session
+
+    # Each segment is replayed in a test run of its own, the first one in the test run of the replay
+    def segment_test_run(self, segment):
+        return f'{self.test_run}-{segment}' if segment else self.test_run
+
+    # Start every segment from an empty mock
+    def prepare(self):
+        for segment in sorted({entry[7] for entry in self.trace} | {0}):
+            self.session().post(self.args.mock_url + '/test/reset',
+                                headers={'X-Test-Run': self.segment_test_run(segment)}).raise_for_status()
+
+    # Wait until the contacts in the path of a request have been created, as they had been in the original run
+    def wait_for_contacts(self, entry):
+        if self.header['kind'] == 'api':
+            for contact_id in re.findall(r'(?<=/api/contacts/)\d+', entry[2]):
+                if (entry[7], int(contact_id)) in self.created:
+                    self.created[entry[7], int(contact_id)].wait()
+
+    def request(self, i, entry):
+        _, method, path, _, _, body, created_id, segment = entry
+        if self.header['kind'] == 'form':
+            url = self.args.url
+            data = {'email': f'{self.test_run}-{i}@example.com', 'redirect-to': 'https://example.com/success'}
+            return self.session().post(url, data=data, allow_redirects=False)
+        headers = {'X-API-Key': '123', 'Authorization': 'Bearer 123', 'X-Test-Run': self.segment_test_run(segment)}
+        if body is not None:
+            headers['Content-Type'] = 'application/merge-patch+json' if method == 'PATCH' else 'application/json'
+        with self.lock:
+            path = re.sub(r'(?<=/api/contacts/)(\d+)',
+                          lambda match: str(self.contact_ids.get((segment, int(match[1])), match[1])), path)
+        try:
+            response = self.session().request(method, self.args.mock_url + path, data=body and body.encode(), headers=headers)
+            if created_id is not None and response.status_code == 201:
+                with self.lock:
+                    self.contact_ids[segment, created_id] = response.json()['id']
+            return response
+        finally:
+            # If the create failed, the requests for the contact go out with its original id, and their
+            # statuses show the divergence
+            if created_id is not None:
+                self.created[segment, created_id].set()
+
+    def send(self, i, entry, scheduled_at):
+        # Requests start in the order of the trace, so a create always starts before the requests that wait for it
+        self.wait_for_contacts(entry)
+        started_at = time.perf_counter()
+        try:
+            response = self.request(i, entry)
+            status = response.status_code
+        except requests.RequestException as e:
+            response = None
+            status = type(e).__name__
+        latency = time.perf_counter() - started_at
+        if self.header['kind'] == 'api':
+            latency = server_duration(response) if response is not None else None
+        with self.lock:
+            self.results.append((i, status, latency, started_at - scheduled_at))
+
+    def run(self):
+        self.prepare()
+        speed = self.args.speed
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            for i, entry in enumerate(self.trace):
+                scheduled_at = start + entry[0] / speed if speed > 0 else time.perf_counter()
+                time.sleep(max(0, scheduled_at - time.perf_counter()))
+                executor.submit(self.send, i, entry, scheduled_at)
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed):
+        self.results.sort()
+        statuses = collections.Counter()
+        diverged = collections.Counter()
+        latencies = collections.defaultdict(lambda: ([], []))
+        for i, status, latency, _ in self.results:
+            _, method, path, original_status, original_latency = self.trace[i][:5]
+            statuses[str(status)] += 1
+            if status != original_status:
+                diverged[f'{original_status} -> {status}'] += 1
+            route = f'{method} {re.sub(r"/[0-9]+", "/<id>", urllib.parse.urlsplit(path).path)}'
+            if original_latency is not None:
+                latencies[route][0].append(original_latency)
+            if latency is not None:
+                latencies[route][1].append(latency)
+
+        # Only latencies of the same measure are compared
+        same_measure = self.header['kind'] == 'api'
+        by_route = {}
+        for route, (original, replayed) in latencies.items():
+            original, replayed = summarize(original), summarize(replayed)
+            by_route[route] = {'original': original, 'replayed': replayed}
+            if same_measure:
+                by_route[route]['p95Ratio'] = replayed['p95'] / original['p95'] if original['p95'] and replayed['p95'] else None
+        return {
+            'config': {
+                'trace': self.args.trace,
+                'kind': self.header['kind'],
+                'speed': self.args.speed,
+                'concurrency': self.args.concurrency,
+                'testRun': self.test_run
+            },
+            'requests': len(self.results),
+            'originalDuration': self.header['duration'],
+            'elapsed': elapsed,
+            'statuses': dict(statuses),
+            'divergence': {
+                'statuses': sum(diverged.values()),
+                'statusRate': sum(diverged.values()) / len(self.results) if self.results else None,
+                'byChange': dict(diverged)
+            },
+            'latency': by_route,
+            'latencyMeasures': {'original': 'server', 'replayed': 'server' if same_measure else 'round trip'},
+            # How late requests started compared to the trace, e.g. because all workers were busy
+            'lateness': summarize([lateness for _, _, _, lateness in self.results])
+        }
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    if args.command == 'capture':
+        header, trace = capture(args.logs, args.test_run)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                write_trace(header, trace, f)
+        else:
+            write_trace(header, trace, sys.stdout)
+    else:
+        report = Replay(args, *read_trace(args.trace)).run()
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            print()
@@ -1,19 +1,53 @@
+import concurrent.futures
+import gc
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 import requests
 
+import api_mock
+
+# The mock under test. Without MOCK_URL, e.g. MOCK_URL=http://localhost:8081 for the
+# mock container, a mock is served from a thread of this process for the tests.
+MOCK_URL = os.environ.get('MOCK_URL')
+mock_server = None
+
+def setUpModule():
+    global MOCK_URL, mock_server
+    if not MOCK_URL:
+        if 'MOCK_LOG_PATH' not in os.environ:
+            api_mock.request_log.sample_rate = 0
+        mock_server = api_mock.serve_in_background()
+        MOCK_URL = mock_server.url
+
+def tearDownModule():
+    if mock_server:
+        mock_server.close()
+
+# Requests made by the tests carry the X-Test-Run header if TEST_RUN is set, so that
+# several test runs can share the mock without seeing each other's state
+session = requests.Session()
+if os.environ.get('TEST_RUN'):
+    session.headers['X-Test-Run'] = os.environ['TEST_RUN']
+
 # Test the API mock so we can use it to test the web application
 
 TEST_EMAIL = 'test@example.com'
 
 class TestCreateContact(unittest.TestCase):
     def setUp(self):
-        requests.post('http://localhost:8081/test/reset')
+        session.post(MOCK_URL + '/test/reset')
 
     def test_create_contact(self):
         contact_data = {
             'email': TEST_EMAIL
         }
-        response = requests.post('http://localhost:8081/api/contacts', json=contact_data, headers={'X-API-Key': '123'})
+        response = session.post(MOCK_URL + '/api/contacts', json=contact_data, headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 201)
         contact = response.json()
 
@@ -26,20 +60,22 @@ class TestCreateContact(unittest.TestCase):
         contact_data = {
             'email': TEST_EMAIL
         }
-        response = requests.post('http://localhost:8081/api/contacts', json=contact_data, headers={'X-API-Key': '123'})
+        response = session.post(MOCK_URL + '/api/contacts', json=contact_data, headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 201)
 
         # Subscribe the same contact again
-        response = requests.post('http://localhost:8081/api/contacts', json=contact_data, headers={'X-API-Key': '123'})
+        response = session.post(MOCK_URL + '/api/contacts', json=contact_data, headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.headers['Content-Type'], 'application/problem+json')
+        self.assertEqual(response.json()['violations'][0]['propertyPath'], 'email')
 
     def test_create_contact_missing_email(self):
         contact_data = {}
-        response = requests.post('http://localhost:8081/api/contacts', json=contact_data, headers={'X-API-Key': '123'})
+        response = session.post(MOCK_URL + '/api/contacts', json=contact_data, headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 400)
 
     def test_create_contact_with_first_name(self):
-        requests.post('http://localhost:8081/test/reset')
+        session.post(MOCK_URL + '/test/reset')
 
         self.contact_data = {
             'email': TEST_EMAIL,
@@ -47,7 +83,7 @@ class TestCreateContact(unittest.TestCase):
                 {'slug': 'first_name', 'value': 'John'}
             ]
         }
-        response = requests.post('http://localhost:8081/api/contacts', json=self.contact_data, headers={'X-API-Key': '123'})
+        response = session.post(MOCK_URL + '/api/contacts', json=self.contact_data, headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 201)
         contact = response.json()
 
@@ -60,7 +96,7 @@ class TestCreateContact(unittest.TestCase):
 
 class TestUpdateContact(unittest.TestCase):
     def setUp(self):
-        requests.post('http://localhost:8081/test/reset')
+        session.post(MOCK_URL + '/test/reset')
 
         # Add a new contact
         self.contact_data = {
@@ -70,17 +106,17 @@ class TestUpdateContact(unittest.TestCase):
                 {'slug': 'last_name', 'value': 'Doe'}
             ]
         }
-        requests.post('http://localhost:8081/api/contacts', json=self.contact_data, headers={'X-API-Key': '123'})
+        session.post(MOCK_URL + '/api/contacts', json=self.contact_data, headers={'X-API-Key': '123'})
 
     def test_change_email(self):
         new_contact_data = {
             'email': 'test2@example.com'
         }
-        response = requests.patch('http://localhost:8081/api/contacts/1', json=new_contact_data, headers={'X-API-Key': '123', 'Content-Type': 'application/merge-patch+json'})
+        response = session.patch(MOCK_URL + '/api/contacts/1', json=new_contact_data, headers={'X-API-Key': '123', 'Content-Type': 'application/merge-patch+json'})
         self.assertEqual(response.status_code, 200)
 
         # Verify the contact details
-        response = requests.get(f'http://localhost:8081/api/contacts', headers={'X-API-Key': '123'})
+        response = session.get(f'{MOCK_URL}/api/contacts', headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 200)
         contacts = response.json()
         self.assertEqual(len(contacts['items']), 1)
@@ -94,11 +130,11 @@ class TestUpdateContact(unittest.TestCase):
                 {'slug': 'first_name', 'value': 'Jane'}
             ]
         }
-        response = requests.patch('http://localhost:8081/api/contacts/1', json=new_contact_data, headers={'X-API-Key': '123', 'Content-Type': 'application/merge-patch+json'})
+        response = session.patch(MOCK_URL + '/api/contacts/1', json=new_contact_data, headers={'X-API-Key': '123', 'Content-Type': 'application/merge-patch+json'})
         self.assertEqual(response.status_code, 200)
 
         # Verify the contact details
-        response = requests.get(f'http://localhost:8081/api/contacts', headers={'X-API-Key': '123'})
+        response = session.get(f'{MOCK_URL}/api/contacts', headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 200)
         contacts = response.json()
         self.assertEqual(len(contacts['items']), 1)
@@ -114,13 +150,13 @@ class TestUpdateContact(unittest.TestCase):
 
 class TestAssignTag(unittest.TestCase):
     def setUp(self):
-        requests.post('http://localhost:8081/test/reset')
+        session.post(MOCK_URL + '/test/reset')
 
         # Add a new contact
         self.contact_data = {
             'email': TEST_EMAIL
         }
-        response = requests.post('http://localhost:8081/api/contacts', json=self.contact_data, headers={'X-API-Key': '123'})
+        response = session.post(MOCK_URL + '/api/contacts', json=self.contact_data, headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 201)
         self.contact = response.json()
 
@@ -132,11 +168,11 @@ class TestAssignTag(unittest.TestCase):
         tag_data = {
             'tagId': 1
         }
-        response = requests.post(f'http://localhost:8081/api/contacts/{contact["id"]}/tags', json=tag_data, headers={'X-API-Key': '123'})
+        response = session.post(f'{MOCK_URL}/api/contacts/{contact["id"]}/tags', json=tag_data, headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 204)
 
         # Verify that the tag is assigned to the contact
-        response = requests.get(f'http://localhost:8081/api/contacts?email={contact_data["email"]}', headers={'X-API-Key': '123'})
+        response = session.get(f'{MOCK_URL}/api/contacts?email={contact_data["email"]}', headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 200)
         contact = response.json()
         self.assertEqual(len(contact['items']), 1)
@@ -148,7 +184,7 @@ class TestAssignTag(unittest.TestCase):
 
         # Assign a tag to the contact without a tag ID
         tag_data = {}
-        response = requests.post(f'http://localhost:8081/api/contacts/{contact["id"]}/tags', json=tag_data, headers={'X-API-Key': '123'})
+        response = session.post(f'{MOCK_URL}/api/contacts/{contact["id"]}/tags', json=tag_data, headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 400)
 
     def test_assign_tag_missing_contact(self):
@@ -156,7 +192,7 @@ class TestAssignTag(unittest.TestCase):
         tag_data = {
             'tagId': 1
         }
-        response = requests.post('http://localhost:8081/api/contacts/2/tags', json=tag_data, headers={'X-API-Key': '123'})
+        response = session.post(MOCK_URL + '/api/contacts/2/tags', json=tag_data, headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 404)
 
     def test_assign_tag_unauthorized(self):
@@ -166,7 +202,7 @@ class TestAssignTag(unittest.TestCase):
         tag_data = {
             'tagId': 1
         }
-        response = requests.post(f'http://localhost:8081/api/contacts/{contact["id"]}/tags', json=tag_data)
+        response = session.post(f'{MOCK_URL}/api/contacts/{contact["id"]}/tags', json=tag_data)
         self.assertEqual(response.status_code, 401)
 
     def test_assign_two_tags(self):
@@ -177,17 +213,17 @@ class TestAssignTag(unittest.TestCase):
         tag_data = {
             'tagId': 1
         }
-        response = requests.post(f'http://localhost:8081/api/contacts/{contact["id"]}/tags', json=tag_data, headers={'X-API-Key': '123'})
+        response = session.post(f'{MOCK_URL}/api/contacts/{contact["id"]}/tags', json=tag_data, headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 204)
 
         tag_data = {
             'tagId': 2
         }
-        response = requests.post(f'http://localhost:8081/api/contacts/{contact["id"]}/tags', json=tag_data, headers={'X-API-Key': '123'})
+        response = session.post(f'{MOCK_URL}/api/contacts/{contact["id"]}/tags', json=tag_data, headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 204)
 
         # Verify that the tags are assigned to the contact
-        response = requests.get(f'http://localhost:8081/api/contacts?email={contact_data["email"]}', headers={'X-API-Key': '123'})
+        response = session.get(f'{MOCK_URL}/api/contacts?email={contact_data["email"]}', headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 200)
         contact = response.json()
         self.assertEqual(len(contact['items']), 1)
@@ -203,15 +239,15 @@ class TestAssignTag(unittest.TestCase):
         tag_data = {
             'tagId': 1
         }
-        response = requests.post(f'http://localhost:8081/api/contacts/{contact["id"]}/tags', json=tag_data, headers={'X-API-Key': '123'})
+        response = session.post(f'{MOCK_URL}/api/contacts/{contact["id"]}/tags', json=tag_data, headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 204)
 
         # Assign the same tag to the contact again
-        response = requests.post(f'http://localhost:8081/api/contacts/{contact["id"]}/tags', json=tag_data, headers={'X-API-Key': '123'})
+        response = session.post(f'{MOCK_URL}/api/contacts/{contact["id"]}/tags', json=tag_data, headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 204)
 
         # Verify that the tag is assigned to the contact only once
-        response = requests.get(f'http://localhost:8081/api/contacts?email={contact_data["email"]}', headers={'X-API-Key': '123'})
+        response = session.get(f'{MOCK_URL}/api/contacts?email={contact_data["email"]}', headers={'X-API-Key': '123'})
         self.assertEqual(response.status_code, 200)
         contact = response.json()
         self.assertEqual(len(contact['items']), 1)
@@ -219,5 +255,738 @@ class TestAssignTag(unittest.TestCase):
         self.assertEqual(contact['items'][0]['tags'][0]['id'], 1)
 
 
+class TestPagination(unittest.TestCase):
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+
+        for i in range(25):
+            session.post(MOCK_URL + '/api/contacts', json={'email': f'test{i}@example.com'}, headers={'X-API-Key': '123'})
+
+    def get_contacts_page(self, query=''):
+        response = session.get(f'{MOCK_URL}/api/contacts{query}', headers={'X-API-Key': '123'})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_default_page_size(self):
+        page = self.get_contacts_page()
+        self.assertEqual([contact['id'] for contact in page['items']], list(range(1, 11)))
+        self.assertTrue(page['hasMore'])
+
+    def test_page_through_contacts(self):
+        emails = []
+        starting_after = 0
+        while True:
+            page = self.get_contacts_page(f'?limit=10&startingAfter={starting_after}')
+            emails += [contact['email'] for contact in page['items']]
+            if not page['hasMore']:
+                break
+            starting_after = page['items'][-1]['id']
+        self.assertEqual(emails, [f'test{i}@example.com' for i in range(25)])
+
+    def test_no_more_when_page_is_exactly_full(self):
+        page = self.get_contacts_page('?limit=25')
+        self.assertEqual(len(page['items']), 25)
+        self.assertFalse(page['hasMore'])
+
+    def test_insert_while_paging(self):
+        page = self.get_contacts_page('?limit=20')
+        session.post(MOCK_URL + '/api/contacts', json={'email': 'late@example.com'}, headers={'X-API-Key': '123'})
+
+        page = self.get_contacts_page(f'?limit=20&startingAfter={page["items"][-1]["id"]}')
+        self.assertEqual([contact['email'] for contact in page['items']], [f'test{i}@example.com' for i in range(20, 25)] + ['late@example.com'])
+        self.assertFalse(page['hasMore'])
+
+    def test_invalid_limit(self):
+        for limit in ['5', '101', 'ten']:
+            response = session.get(f'{MOCK_URL}/api/contacts?limit={limit}', headers={'X-API-Key': '123'})
+            self.assertEqual(response.status_code, 400)
+
+    def test_list_tags(self):
+        response = session.get(MOCK_URL + '/api/tags?limit=10&startingAfter=1', headers={'X-API-Key': '123'})
+        self.assertEqual(response.status_code, 200)
+        page = response.json()
+        self.assertEqual([tag['name'] for tag in page['items']], ['tag2', 'tag3'])
+        self.assertFalse(page['hasMore'])
+
+
+class TestSeed(unittest.TestCase):
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+
+    def seed(self, parameters):
+        response = session.post(MOCK_URL + '/test/seed', json=parameters)
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def test_seed_contacts_and_tags(self):
+        result = self.seed({'contacts': 1000, 'tags': {'tag1': 0.25, 'seeded': 1.0}, 'seed': 1})
+        self.assertEqual(result, {'firstId': 1, 'lastId': 1000, 'tags': {'tag1': 250, 'seeded': 1000}})
+
+        response = session.get(MOCK_URL + '/api/contacts?email=seed1000@example.com', headers={'X-API-Key': '123'})
+        contact = response.json()['items'][0]
+        self.assertEqual(contact['id'], 1000)
+        self.assertIn('seeded', [tag['name'] for tag in contact['tags']])
+
+        response = session.get(MOCK_URL + '/api/tags?query=seeded', headers={'X-API-Key': '123'})
+        self.assertEqual(len(response.json()['items']), 1)
+
+    def test_seed_continues_after_existing_contacts(self):
+        session.post(MOCK_URL + '/api/contacts', json={'email': TEST_EMAIL}, headers={'X-API-Key': '123'})
+        result = self.seed({'contacts': 10})
+        self.assertEqual((result['firstId'], result['lastId']), (2, 11))
+
+        # Contacts created after seeding get the next id
+        response = session.post(MOCK_URL + '/api/contacts', json={'email': 'test2@example.com'}, headers={'X-API-Key': '123'})
+        self.assertEqual(response.json()['id'], 12)
+
+    def test_same_seed_gives_same_tags(self):
+        tagged = []
+        for _ in range(2):
+            session.post(MOCK_URL + '/test/reset')
+            self.seed({'contacts': 50, 'tags': {'tag1': 0.5}, 'seed': 7})
+            response = session.get(MOCK_URL + '/api/contacts?limit=50', headers={'X-API-Key': '123'})
+            tagged.append([contact['id'] for contact in response.json()['items'] if contact['tags']])
+        self.assertEqual(tagged[0], tagged[1])
+
+    def test_seed_many_contacts_quickly(self):
+        start = time.perf_counter()
+        self.seed({'contacts': 100_000, 'tags': {'tag1': 0.5, 'tag2': 0.1}})
+        self.assertLess(time.perf_counter() - start, 5)
+
+    def test_invalid_parameters(self):
+        for parameters in [{}, {'contacts': -1}, {'contacts': True}, {'contacts': 10, 'tags': ['tag1']},
+                           {'contacts': 10, 'tags': {'tag1': 2}}, {'contacts': 10, 'tags': {'tag1': True}},
+                           {'contacts': 10, 'seed': [1]}, {'contacts': 10, 'seed': {}}]:
+            response = session.post(MOCK_URL + '/test/seed', json=parameters)
+            self.assertEqual(response.status_code, 400, parameters)
+
+    def test_body_that_is_not_an_object(self):
+        for body in [None, b'not json', b'[1]']:
+            response = session.post(MOCK_URL + '/test/seed', data=body, headers={'Content-Type': 'application/json'})
+            self.assertEqual(response.status_code, 400)
+
+
+class TestCallCounts(unittest.TestCase):
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+
+    def test_count_calls_per_route(self):
+        response = session.post(MOCK_URL + '/api/contacts', json={'email': TEST_EMAIL}, headers={'X-API-Key': '123'})
+        contact = response.json()
+        session.post(f'{MOCK_URL}/api/contacts/{contact["id"]}/tags', json={'tagId': 1}, headers={'X-API-Key': '123'})
+        session.post(f'{MOCK_URL}/api/contacts/{contact["id"]}/tags', json={'tagId': 2}, headers={'X-API-Key': '123'})
+        session.get(MOCK_URL + '/api/tags?query=tag1', headers={'X-API-Key': '123'})
+
+        response = session.get(MOCK_URL + '/test/calls')
+        self.assertEqual(response.json(), {
+            'POST /api/contacts': 1,
+            'POST /api/contacts/<int:contact_id>/tags': 2,
+            'GET /api/tags': 1
+        })
+
+    def test_reset_clears_counts(self):
+        session.get(MOCK_URL + '/api/tags', headers={'X-API-Key': '123'})
+        session.post(MOCK_URL + '/test/reset')
+
+        response = session.get(MOCK_URL + '/test/calls')
+        self.assertEqual(response.json(), {})
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+
+    def test_count_requests_and_bytes_per_route_and_status(self):
+        response = session.post(MOCK_URL + '/api/contacts', json={'email': TEST_EMAIL}, headers={'X-API-Key': '123'})
+        request_bytes = int(response.request.headers['Content-Length'])
+        response_bytes = len(response.content)
+        duplicate = session.post(MOCK_URL + '/api/contacts', json={'email': TEST_EMAIL}, headers={'X-API-Key': '123'})
+        request_bytes += int(duplicate.request.headers['Content-Length'])
+        response_bytes += len(duplicate.content)
+
+        metrics = session.get(MOCK_URL + '/test/metrics?format=json').json()
+        self.assertEqual(list(metrics), ['POST /api/contacts'])
+        route = metrics['POST /api/contacts']
+        self.assertEqual(route['requests'], {'201': 1, '422': 1})
+        self.assertEqual(route['requestBytes'], request_bytes)
+        self.assertEqual(route['responseBytes'], response_bytes)
+        self.assertEqual(route['duration']['count'], 2)
+        self.assertEqual(route['duration']['buckets']['+Inf'], 2)
+
+    def test_latency_histogram(self):
+        session.post(MOCK_URL + '/test/faults', json={
+            'GET /api/tags': {'latency': {'distribution': 'uniform', 'min': 0.3, 'max': 0.3}}
+        })
+        session.get(MOCK_URL + '/api/tags', headers={'X-API-Key': '123'})
+
+        duration = session.get(MOCK_URL + '/test/metrics?format=json').json()['GET /api/tags']['duration']
+        self.assertEqual(duration['buckets']['0.25'], 0)
+        self.assertEqual(duration['buckets']['0.5'], 1)
+        self.assertGreaterEqual(duration['sum'], 0.3)
+
+    def test_prometheus_format(self):
+        session.get(MOCK_URL + '/api/tags', headers={'X-API-Key': '123'})
+
+        response = session.get(MOCK_URL + '/test/metrics')
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = response.text.splitlines()
+        self.assertIn('# TYPE mock_request_duration_seconds histogram', lines)
+        self.assertIn('mock_requests_total{method="GET",path="/api/tags",status="200"} 1', lines)
+        self.assertIn('mock_request_duration_seconds_bucket{method="GET",path="/api/tags",le="+Inf"} 1', lines)
+        self.assertIn('mock_request_duration_seconds_count{method="GET",path="/api/tags"} 1', lines)
+
+    def test_recent_calls_in_order(self):
+        response = session.post(MOCK_URL + '/api/contacts', json={'email': TEST_EMAIL}, headers={'X-API-Key': '123'})
+        request_bytes = int(response.request.headers['Content-Length'])
+        session.get(MOCK_URL + '/api/contacts?email=' + TEST_EMAIL, headers={'X-API-Key': '123'})
+
+        calls = session.get(MOCK_URL + '/test/requests').json()
+        self.assertEqual([(call['route'], call['path'], call['status'], call['requestBytes']) for call in calls], [
+            ('POST /api/contacts', '/api/contacts', 201, request_bytes),
+            ('GET /api/contacts', '/api/contacts?email=' + TEST_EMAIL, 200, 0)
+        ])
+
+    def test_reset_clears_metrics(self):
+        session.get(MOCK_URL + '/api/tags', headers={'X-API-Key': '123'})
+        session.post(MOCK_URL + '/test/reset')
+
+        self.assertEqual(session.get(MOCK_URL + '/test/metrics?format=json').json(), {})
+        self.assertEqual(session.get(MOCK_URL + '/test/requests').json(), [])
+
+
+def wait_for_next_second():
+    time.sleep(1 - time.time() % 1)
+
+
+class TestConditionalRequests(unittest.TestCase):
+    HEADERS = {'X-API-Key': '123'}
+
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+        self.contact = session.post(MOCK_URL + '/api/contacts', json={'email': TEST_EMAIL}, headers=self.HEADERS).json()
+
+    def lookup(self, path, etag=None, **headers):
+        if etag:
+            headers['If-None-Match'] = etag
+        return session.get(MOCK_URL + path, headers=dict(self.HEADERS, **headers))
+
+    def assert_not_modified(self, path, etag):
+        response = self.lookup(path, etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def assert_modified(self, path, etag):
+        response = self.lookup(path, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        return response.headers['ETag']
+
+    def test_contact_lookup_is_revalidated(self):
+        path = f'/api/contacts?email={TEST_EMAIL}'
+        response = self.lookup(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Last-Modified', response.headers)
+        etag = response.headers['ETag']
+        self.assert_not_modified(path, etag)
+
+        # Patching the contact changes its version, even if nothing changes
+        session.patch(MOCK_URL + f'/api/contacts/{self.contact["id"]}', json={'fields': [{'slug': 'first_name', 'value': 'John'}]},
+                      headers=dict(self.HEADERS, **{'Content-Type': 'application/merge-patch+json'}))
+        etag = self.assert_modified(path, etag)
+        self.assert_not_modified(path, etag)
+
+        # Assigning a tag changes it, but assigning it again does not
+        session.post(MOCK_URL + f'/api/contacts/{self.contact["id"]}/tags', json={'tagId': 1}, headers=self.HEADERS)
+        etag = self.assert_modified(path, etag)
+        session.post(MOCK_URL + f'/api/contacts/{self.contact["id"]}/tags', json={'tagId': 1}, headers=self.HEADERS)
+        self.assert_not_modified(path, etag)
+
+    def test_changes_to_other_contacts_keep_lookup_current(self):
+        path = f'/api/contacts?email={TEST_EMAIL}'
+        etag = self.lookup(path).headers['ETag']
+        session.post(MOCK_URL + '/api/contacts', json={'email': 'other@example.com'}, headers=self.HEADERS)
+        self.assert_not_modified(path, etag)
+
+    def test_lookup_of_missing_contact_changes_when_contact_is_added(self):
+        path = '/api/contacts?email=new@example.com'
+        etag = self.lookup(path).headers['ETag']
+        self.assert_not_modified(path, etag)
+        session.post(MOCK_URL + '/api/contacts', json={'email': 'new@example.com'}, headers=self.HEADERS)
+        response = self.lookup(path, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['items'][0]['email'], 'new@example.com')
+
+    def test_tag_lookup_changes_when_tags_change(self):
+        path = '/api/tags?query=tag1'
+        etag = self.lookup(path).headers['ETag']
+        self.assert_not_modified(path, etag)
+        self.assert_not_modified('/api/tags', etag)
+        session.post(MOCK_URL + '/test/seed', json={'contacts': 1, 'tags': {'newtag': 1}})
+        self.assert_modified(path, etag)
+
+    def test_reset_changes_every_etag(self):
+        path = f'/api/contacts?email={TEST_EMAIL}'
+        etag = self.lookup(path).headers['ETag']
+        session.post(MOCK_URL + '/test/reset')
+        session.post(MOCK_URL + '/api/contacts', json={'email': TEST_EMAIL}, headers=self.HEADERS)
+        self.assert_modified(path, etag)
+
+    def test_if_modified_since(self):
+        path = '/api/tags?query=tag1'
+        last_modified = self.lookup(path).headers['Last-Modified']
+        self.assertEqual(self.lookup(path, **{'If-Modified-Since': last_modified}).status_code, 304)
+        self.assertEqual(self.lookup(path, **{'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'}).status_code, 200)
+        # If-None-Match takes precedence
+        self.assertEqual(self.lookup(path, '"other"', **{'If-Modified-Since': last_modified}).status_code, 200)
+
+    def test_contact_lookup_is_revalidated_by_modification_time(self):
+        path = '/api/contacts?email=new@example.com'
+        last_modified = self.lookup(path).headers['Last-Modified']
+        self.assertEqual(self.lookup(path, **{'If-Modified-Since': last_modified}).status_code, 304)
+
+        # Last-Modified has whole seconds, so a change in the same second as the copy would go unnoticed
+        wait_for_next_second()
+        contact = session.post(MOCK_URL + '/api/contacts', json={'email': 'new@example.com'}, headers=self.HEADERS).json()
+        response = self.lookup(path, **{'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['items'][0]['id'], contact['id'])
+        last_modified = response.headers['Last-Modified']
+        self.assertEqual(self.lookup(path, **{'If-Modified-Since': last_modified}).status_code, 304)
+
+        wait_for_next_second()
+        session.patch(MOCK_URL + f'/api/contacts/{contact["id"]}', json={'fields': [{'slug': 'first_name', 'value': 'John'}]},
+                      headers=dict(self.HEADERS, **{'Content-Type': 'application/merge-patch+json'}))
+        response = self.lookup(path, **{'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['items'][0]['fields'], [{'slug': 'first_name', 'value': 'John'}])
+
+    def test_not_modified_responses_are_counted_without_body(self):
+        path = '/api/tags?query=tag1'
+        etag = self.lookup(path).headers['ETag']
+        self.lookup(path, etag)
+        route = session.get(MOCK_URL + '/test/metrics?format=json').json()['GET /api/tags']
+        self.assertEqual(route['requests'], {'200': 1, '304': 1})
+        calls = session.get(MOCK_URL + '/test/requests').json()
+        self.assertEqual(calls[-1]['status'], 304)
+        self.assertEqual(calls[-1]['responseBytes'], 0)
+
+
+class TestConcurrencyCounts(unittest.TestCase):
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+
+    def test_count_overlapping_calls(self):
+        session.post(MOCK_URL + '/test/faults', json={'GET /api/tags': {'latency': {'distribution': 'uniform', 'min': 0.3, 'max': 0.3}}})
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            list(executor.map(lambda _: session.get(MOCK_URL + '/api/tags', headers={'X-API-Key': '123'}), range(3)))
+        session.get(MOCK_URL + '/api/contacts', headers={'X-API-Key': '123'})
+
+        response = session.get(MOCK_URL + '/test/concurrency')
+        self.assertEqual(response.json(), {
+            'GET /api/tags': {'current': 0, 'max': 3},
+            'GET /api/contacts': {'current': 0, 'max': 1}
+        })
+
+
+class TestFaults(unittest.TestCase):
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+
+    def set_faults(self, faults):
+        response = session.post(MOCK_URL + '/test/faults', json=faults)
+        self.assertEqual(response.status_code, 204)
+
+    def get_tags(self):
+        return session.get(MOCK_URL + '/api/tags?query=tag1', headers={'X-API-Key': '123'})
+
+    def test_latency(self):
+        self.set_faults({'GET /api/tags': {'latency': {'distribution': 'uniform', 'min': 0.2, 'max': 0.3}}})
+        start = time.perf_counter()
+        response = self.get_tags()
+        elapsed = time.perf_counter() - start
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(elapsed, 0.2)
+
+        # Other routes are not affected
+        start = time.perf_counter()
+        session.get(MOCK_URL + '/api/contacts', headers={'X-API-Key': '123'})
+        self.assertLess(time.perf_counter() - start, 0.2)
+
+    def test_failure_rate(self):
+        self.set_faults({'POST /api/contacts': {'failureRate': 1}})
+        response = session.post(MOCK_URL + '/api/contacts', json={'email': TEST_EMAIL}, headers={'X-API-Key': '123'})
+        self.assertEqual(response.status_code, 500)
+
+    def test_rate_limit(self):
+        self.set_faults({'GET /api/tags': {'rateLimit': {'rate': 0.5, 'burst': 2}}})
+        self.assertEqual(self.get_tags().status_code, 200)
+        self.assertEqual(self.get_tags().status_code, 200)
+        response = self.get_tags()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn(response.headers['Retry-After'], ['1', '2'])
+
+    def test_remove_and_reset_faults(self):
+        self.set_faults({'GET /api/tags': {'failureRate': 1}, 'POST /api/contacts': {'failureRate': 1}})
+        self.set_faults({'GET /api/tags': {}})
+        response = session.get(MOCK_URL + '/test/faults')
+        self.assertEqual(response.json(), {'POST /api/contacts': {'failureRate': 1}})
+        self.assertEqual(self.get_tags().status_code, 200)
+
+        session.post(MOCK_URL + '/test/reset')
+        response = session.get(MOCK_URL + '/test/faults')
+        self.assertEqual(response.json(), {})
+
+    def test_invalid_faults(self):
+        for faults in [
+            {'GET /api/unknown': {'failureRate': 1}},
+            {'GET /api/tags': {'failureRate': 2}},
+            {'GET /api/tags': {'latency': {'distribution': 'bimodal'}}},
+            {'GET /api/tags': {'latency': {'distribution': 'exponential'}}},
+            {'GET /api/tags': {'rateLimit': {'rate': 1}}}
+        ]:
+            response = session.post(MOCK_URL + '/test/faults', json=faults)
+            self.assertEqual(response.status_code, 400, faults)
+
+    def test_body_that_is_not_an_object(self):
+        for body, content_type in [(b'not json', 'application/json'), (b'[1]', 'application/json'), (b'{}', 'text/plain')]:
+            response = session.post(MOCK_URL + '/test/faults', data=body, headers={'Content-Type': content_type})
+            self.assertEqual(response.status_code, 400, body)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+
+        response = session.post(MOCK_URL + '/api/contacts', json={'email': TEST_EMAIL, 'fields': [{'slug': 'first_name', 'value': 'John'}]}, headers={'X-API-Key': '123'})
+        self.contact = response.json()
+        session.post(f'{MOCK_URL}/api/contacts/{self.contact["id"]}/tags', json={'tagId': 1}, headers={'X-API-Key': '123'})
+        response = session.post(MOCK_URL + '/test/snapshot', json={'name': 'test'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['contacts'], 1)
+
+    def restore(self, name='test'):
+        return session.post(MOCK_URL + '/test/restore', json={'name': name})
+
+    def get_contacts(self):
+        response = session.get(MOCK_URL + '/api/contacts', headers={'X-API-Key': '123'})
+        return response.json()['items']
+
+    def test_restore_undoes_changes(self):
+        session.patch(f'{MOCK_URL}/api/contacts/{self.contact["id"]}', json={'email': 'test2@example.com', 'fields': [{'slug': 'first_name', 'value': 'Jane'}]}, headers={'X-API-Key': '123', 'Content-Type': 'application/merge-patch+json'})
+        session.post(f'{MOCK_URL}/api/contacts/{self.contact["id"]}/tags', json={'tagId': 2}, headers={'X-API-Key': '123'})
+        session.post(MOCK_URL + '/api/contacts', json={'email': 'test3@example.com'}, headers={'X-API-Key': '123'})
+        session.post(MOCK_URL + '/test/break')
+
+        # Restore twice, since the second restore reuses the snapshot that was loaded by the first
+        for _ in range(2):
+            response = self.restore()
+            self.assertEqual(response.status_code, 200)
+            contacts = self.get_contacts()
+            self.assertEqual(len(contacts), 1)
+            self.assertEqual(contacts[0]['email'], TEST_EMAIL)
+            self.assertEqual(contacts[0]['fields'], [{'slug': 'first_name', 'value': 'John'}])
+            self.assertEqual([tag['id'] for tag in contacts[0]['tags']], [1])
+
+            response = session.get(MOCK_URL + '/api/contacts?email=test2@example.com', headers={'X-API-Key': '123'})
+            self.assertEqual(response.json()['items'], [])
+
+            # Ids continue from where they were when the snapshot was taken
+            response = session.post(MOCK_URL + '/api/contacts', json={'email': 'test2@example.com'}, headers={'X-API-Key': '123'})
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.json()['id'], 2)
+
+    @unittest.skipIf(os.environ.get('MOCK_URL'), 'needs the garbage collector of a mock served by the tests')
+    def test_restores_freeze_no_objects(self):
+        frozen = gc.get_freeze_count()
+        for _ in range(2):
+            # A new snapshot file is loaded again rather than reused
+            session.post(MOCK_URL + '/test/snapshot', json={'name': 'test'})
+            self.assertEqual(self.restore().status_code, 200)
+        self.assertEqual(gc.get_freeze_count(), frozen)
+
+    def test_restore_unknown_snapshot(self):
+        self.assertEqual(self.restore('unknown').status_code, 404)
+        self.assertEqual(self.restore('../test').status_code, 400)
+
+    def test_restore_large_snapshot_quickly(self):
+        session.post(MOCK_URL + '/test/seed', json={'contacts': 1_000_000, 'tags': {'tag1': 0.5}})
+        session.post(MOCK_URL + '/test/snapshot', json={'name': 'large'})
+        self.assertEqual(self.restore('large').status_code, 200)
+
+        session.post(MOCK_URL + '/api/contacts', json={'email': 'test2@example.com'}, headers={'X-API-Key': '123'})
+        start = time.perf_counter()
+        response = self.restore('large')
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(response.json()['contacts'], 1_000_001)
+
+
+class TestMemory(unittest.TestCase):
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+
+    def add_contact(self, email):
+        return session.post(MOCK_URL + '/api/contacts', json={'email': email}, headers={'X-API-Key': '123'})
+
+    def get_contacts(self, email):
+        return session.get(MOCK_URL + '/api/contacts?email=' + email, headers={'X-API-Key': '123'}).json()['items']
+
+    def test_report_bytes_per_contact(self):
+        session.post(MOCK_URL + '/test/seed', json={'contacts': 10000, 'tags': {'tag1': 0.5}})
+        memory = session.get(MOCK_URL + '/test/memory').json()
+        self.assertEqual(memory['contacts'], 10000)
+        self.assertEqual(memory['evictedContacts'], 0)
+        self.assertIsNone(memory['maxContacts'])
+        # A seeded contact takes about 235 bytes including the indexes here, and 275 among 100,000 as the indexes grow;
+        # as a dict of lists of dicts it took over 500
+        self.assertLess(memory['bytesPerContact'], 400)
+
+    def test_oldest_contacts_are_evicted_beyond_cap(self):
+        response = session.post(MOCK_URL + '/test/memory', json={'maxContacts': 3})
+        self.assertEqual(response.json()['maxContacts'], 3)
+        for i in range(5):
+            self.assertEqual(self.add_contact(f'test{i}@example.com').status_code, 201)
+
+        self.assertEqual(self.get_contacts('test0@example.com'), [])
+        self.assertEqual(self.get_contacts('test1@example.com'), [])
+        self.assertEqual(self.get_contacts('test4@example.com')[0]['id'], 5)
+        response = session.get(MOCK_URL + '/api/contacts', headers={'X-API-Key': '123'})
+        self.assertEqual([contact['id'] for contact in response.json()['items']], [3, 4, 5])
+
+        memory = session.get(MOCK_URL + '/test/memory').json()
+        self.assertEqual((memory['contacts'], memory['evictedContacts']), (3, 2))
+
+        # An evicted email can be added again
+        self.assertEqual(self.add_contact('test0@example.com').json()['id'], 6)
+
+    def test_lowering_cap_evicts_and_reset_removes_it(self):
+        session.post(MOCK_URL + '/test/seed', json={'contacts': 10})
+        memory = session.post(MOCK_URL + '/test/memory', json={'maxContacts': 4}).json()
+        self.assertEqual((memory['contacts'], memory['evictedContacts']), (4, 6))
+
+        session.post(MOCK_URL + '/test/reset')
+        self.assertIsNone(session.get(MOCK_URL + '/test/memory').json()['maxContacts'])
+
+    def test_seeding_beyond_cap_counts_kept_contacts(self):
+        session.post(MOCK_URL + '/test/memory', json={'maxContacts': 4})
+        response = session.post(MOCK_URL + '/test/seed', json={'contacts': 10, 'tags': {'tag1': 1.0, 'tag2': 0.5}})
+        self.assertEqual(response.json()['tags'], {'tag1': 4, 'tag2': 2})
+        response = session.get(MOCK_URL + '/api/contacts', headers={'X-API-Key': '123'})
+        tag_names = [tag['name'] for contact in response.json()['items'] for tag in contact['tags']]
+        self.assertEqual((tag_names.count('tag1'), tag_names.count('tag2')), (4, 2))
+
+    def test_invalid_cap(self):
+        response = session.post(MOCK_URL + '/test/memory', json={'maxContacts': 0})
+        self.assertEqual(response.status_code, 400)
+        response = session.post(MOCK_URL + '/test/memory', data=b'not json', headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestTestRuns(unittest.TestCase):
+    RUN_A = {'X-Test-Run': os.environ.get('TEST_RUN', '') + 'a', 'X-API-Key': '123'}
+    RUN_B = {'X-Test-Run': os.environ.get('TEST_RUN', '') + 'b', 'X-API-Key': '123'}
+
+    def setUp(self):
+        for headers in [self.RUN_A, self.RUN_B]:
+            requests.post(MOCK_URL + '/test/reset', headers=headers)
+
+    def get_contacts(self, headers):
+        return requests.get(MOCK_URL + '/api/contacts?email=' + TEST_EMAIL, headers=headers).json()['items']
+
+    def test_contacts_are_separate(self):
+        response = requests.post(MOCK_URL + '/api/contacts', json={'email': TEST_EMAIL}, headers=self.RUN_A)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.get_contacts(self.RUN_A)), 1)
+        self.assertEqual(self.get_contacts(self.RUN_B), [])
+
+        # The same email can be added to the other run, with its own ids
+        response = requests.post(MOCK_URL + '/api/contacts', json={'email': TEST_EMAIL}, headers=self.RUN_B)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['id'], 1)
+
+    def test_reset_only_affects_own_run(self):
+        for headers in [self.RUN_A, self.RUN_B]:
+            requests.post(MOCK_URL + '/api/contacts', json={'email': TEST_EMAIL}, headers=headers)
+        requests.post(MOCK_URL + '/test/reset', headers=self.RUN_A)
+        self.assertEqual(self.get_contacts(self.RUN_A), [])
+        self.assertEqual(len(self.get_contacts(self.RUN_B)), 1)
+
+    def test_broken_only_affects_own_run(self):
+        requests.post(MOCK_URL + '/test/break', headers=self.RUN_A)
+        response = requests.get(MOCK_URL + '/api/tags', headers=self.RUN_A)
+        self.assertEqual(response.status_code, 500)
+        response = requests.get(MOCK_URL + '/api/tags', headers=self.RUN_B)
+        self.assertEqual(response.status_code, 200)
+
+    def test_slack_payloads_and_calls_are_separate(self):
+        requests.post(MOCK_URL + '/api/chat.postMessage', json={'channel': '#api-errors', 'text': 'error'},
+                      headers={'X-Test-Run': self.RUN_A['X-Test-Run'], 'Authorization': 'Bearer 123'})
+        self.assertEqual(len(requests.get(MOCK_URL + '/test/slack/payloads', headers=self.RUN_A).json()), 1)
+        self.assertEqual(requests.get(MOCK_URL + '/test/slack/payloads', headers=self.RUN_B).json(), [])
+        self.assertEqual(requests.get(MOCK_URL + '/test/calls', headers=self.RUN_B).json(), {})
+
+
+class TestConcurrency(unittest.TestCase):
+    PORT = 8091
+
+    @classmethod
+    def setUpClass(cls):
+        # A separate mock with several worker processes sharing one state
+        environment = dict(os.environ, MOCK_WORKERS='4', MOCK_PORT=str(cls.PORT), MOCK_LOG_SAMPLE_RATE='0')
+        cls.mock = subprocess.Popen([sys.executable, api_mock.__file__], env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        cls.url = f'http://localhost:{cls.PORT}'
+        for _ in range(50):
+            try:
+                session.get(cls.url)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mock.terminate()
+        cls.mock.wait()
+
+    def setUp(self):
+        session.post(self.url + '/test/reset')
+
+    def post_contacts(self, emails):
+        def post(email):
+            return session.post(self.url + '/api/contacts', json={'email': email}, headers={'X-API-Key': '123'})
+        with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
+            return list(executor.map(post, emails))
+
+    def test_ids_are_unique(self):
+        responses = self.post_contacts([f'test{i}@example.com' for i in range(100)])
+        self.assertEqual([response.status_code for response in responses], [201] * 100)
+        self.assertEqual(sorted(response.json()['id'] for response in responses), list(range(1, 101)))
+
+    def test_only_one_of_parallel_duplicates_is_created(self):
+        responses = self.post_contacts([TEST_EMAIL] * 50)
+        status_codes = [response.status_code for response in responses]
+        self.assertEqual(status_codes.count(201), 1)
+        self.assertEqual(status_codes.count(422), 49)
+
+    def test_state_is_shared_between_workers(self):
+        self.post_contacts([TEST_EMAIL])
+        for _ in range(20):
+            response = session.get(f'{self.url}/api/contacts?email={TEST_EMAIL}', headers={'X-API-Key': '123'})
+            self.assertEqual(len(response.json()['items']), 1)
+
+        response = session.get(self.url + '/test/calls')
+        self.assertEqual(response.json(), {'POST /api/contacts': 1, 'GET /api/contacts': 20})
+
+    def test_test_runs_are_shared_between_workers(self):
+        headers = {'X-Test-Run': os.environ.get('TEST_RUN', '') + 'workers', 'X-API-Key': '123'}
+        requests.post(self.url + '/test/reset', headers=headers)
+        requests.post(self.url + '/api/contacts', json={'email': TEST_EMAIL}, headers=headers)
+        for _ in range(20):
+            response = requests.get(f'{self.url}/api/contacts?email={TEST_EMAIL}', headers=headers)
+            self.assertEqual(len(response.json()['items']), 1)
+        response = session.get(f'{self.url}/api/contacts?email={TEST_EMAIL}', headers={'X-API-Key': '123'})
+        self.assertEqual(response.json()['items'], [])
+
+
+class TestStoreScaling(unittest.TestCase):
+    # Drives the mock in-process so that the timings are not dominated by HTTP overhead
+    SIZES = [1_000, 10_000, 100_000, 1_000_000]
+    SAMPLES = 200
+
+    def setUp(self):
+        api_mock.store.reset()
+        self.client = api_mock.app.test_client()
+
+    def tearDown(self):
+        api_mock.store.reset()
+
+    def test_request_latency_is_flat_as_contacts_grow(self):
+        headers = {'X-API-Key': '123'}
+        patch_headers = {'X-API-Key': '123', 'Content-Type': 'application/merge-patch+json'}
+        medians = []
+        for size in self.SIZES:
+            first_index = api_mock.store.latest_contact_id
+            api_mock.store.add_contacts([f'user{i}@example.com' for i in range(first_index, size)])
+
+            timings = []
+            for i in range(self.SAMPLES):
+                contact_id = size - i
+                email = f'user{contact_id - 1}@example.com'
+                start = time.perf_counter()
+                self.assertEqual(self.client.get(f'/api/contacts?email={email}', headers=headers).status_code, 200)
+                self.assertEqual(self.client.post('/api/contacts', json={'email': email}, headers=headers).status_code, 422)
+                self.assertEqual(self.client.patch(f'/api/contacts/{contact_id}', json={'fields': [{'slug': 'first_name', 'value': 'John'}]}, headers=patch_headers).status_code, 200)
+                self.assertEqual(self.client.post(f'/api/contacts/{contact_id}/tags', json={'tagId': 1}, headers=headers).status_code, 204)
+                timings.append(time.perf_counter() - start)
+            medians.append(statistics.median(timings))
+
+        # A linear scan would make the largest size ~1000 times slower than the smallest
+        self.assertLess(max(medians) / min(medians), 3, f'median seconds per submission by size: {medians}')
+
+
+class TestRequestLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'requests.txt')
+        self.original_log = api_mock.request_log
+        api_mock.request_log = api_mock.RequestLog(self.path)
+        self.client = api_mock.app.test_client()
+
+    def tearDown(self):
+        api_mock.request_log.flush()
+        api_mock.request_log = self.original_log
+        api_mock.store.reset()
+        self.directory.cleanup()
+
+    def read_records(self, path=None):
+        api_mock.request_log.flush()
+        with open(path or self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_one_json_line_per_request(self):
+        self.client.post('/api/contacts', json={'email': TEST_EMAIL}, headers={'X-API-Key': '123'})
+        self.client.get(f'/api/contacts?email={TEST_EMAIL}', headers={'X-API-Key': '123'})
+
+        records = self.read_records()
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['method'], 'POST')
+        self.assertEqual(records[0]['path'], '/api/contacts')
+        self.assertEqual(records[0]['status'], 201)
+        self.assertEqual(json.loads(records[0]['body']), {'email': TEST_EMAIL})
+        self.assertGreater(records[0]['requestBytes'], 0)
+        self.assertGreater(records[0]['responseBytes'], 0)
+        self.assertGreaterEqual(records[0]['duration'], 0)
+        self.assertEqual(records[1]['method'], 'GET')
+        self.assertEqual(records[1]['path'], f'/api/contacts?email={TEST_EMAIL}')
+        self.assertEqual(records[1]['status'], 200)
+
+    def test_logging_switched_off(self):
+        response = self.client.post('/test/log', json={'sampleRate': 0})
+        self.assertEqual(response.status_code, 204)
+        self.client.get('/api/tags', headers={'X-API-Key': '123'})
+
+        # Only the request that switched logging off is logged
+        self.assertEqual(len(self.read_records()), 1)
+
+    def test_invalid_sample_rate(self):
+        response = self.client.post('/test/log', json={'sampleRate': 2})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/test/log')
+        self.assertEqual(response.status_code, 400)
+
+    def test_rotates_by_size(self):
+        api_mock.request_log.max_bytes = 1000
+        api_mock.request_log.backups = 2
+        for _ in range(20):
+            self.client.get('/api/tags', headers={'X-API-Key': '123'})
+            api_mock.request_log.flush()
+
+        self.assertTrue(os.path.exists(self.path + '.1'))
+        self.assertTrue(os.path.exists(self.path + '.2'))
+        self.assertFalse(os.path.exists(self.path + '.3'))
+        self.assertLess(os.path.getsize(self.path + '.1'), 2000)
+        for record in self.read_records(self.path + '.1'):
+            self.assertEqual(record['path'], '/api/tags')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,21 +1,41 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
+import json
+import os
+import re
+import statistics
+import time
 import unittest
 import requests
 
+# Requests made by the tests carry the X-Test-Run header if TEST_RUN is set, so that
+# several test runs can share the mock without seeing each other's state
+session = requests.Session()
+if os.environ.get('TEST_RUN'):
+    session.headers['X-Test-Run'] = os.environ['TEST_RUN']
+
+# The web container that serves the script, and the mock container that it calls
+WEB_URL = os.environ.get('WEB_URL', 'http://web:8080')
+MOCK_URL = os.environ.get('MOCK_URL', 'http://localhost:8081')
+
+# The switches of the diagnostic page need the drain token, which is set in the Makefile
+DRAIN_HEADERS = {'X-Drain-Token': 'test-drain-token'}
+
 TEST_EMAIL = 'test@example.com'
 SUCCESS_URL = 'https://example.com/success'
 
 class TestPostAddContactPHP(unittest.TestCase):
     def setUp(self):
-        requests.post('http://localhost:8081/test/reset')
+        session.post(MOCK_URL + '/test/reset')
+        session.get(WEB_URL + '/add-systeme-io-contact.php?reset-circuit-breaker&reset-notifications', headers=DRAIN_HEADERS)
 
     def test_add_new_contact_without_name(self):
         form_data = {
             'email': TEST_EMAIL,
             'redirect-to': SUCCESS_URL
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 303)
         contact = self.assert_get_contact_succeeds(form_data['email'])
         self.assertEqual(contact['fields'], [])
@@ -26,7 +46,7 @@ class TestPostAddContactPHP(unittest.TestCase):
             'email': TEST_EMAIL,
             'redirect-to': SUCCESS_URL
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 303)
         self.assertEqual(response.headers['Location'], form_data['redirect-to'])
         contact = self.assert_get_contact_succeeds(form_data['email'])
@@ -39,7 +59,7 @@ class TestPostAddContactPHP(unittest.TestCase):
             'email': ' ' + TEST_EMAIL + ' ',
             'redirect-to': SUCCESS_URL
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 303)
         self.assertEqual(response.headers['Location'], form_data['redirect-to'])
         contact = self.assert_get_contact_succeeds(TEST_EMAIL)
@@ -52,8 +72,8 @@ class TestPostAddContactPHP(unittest.TestCase):
             'email': TEST_EMAIL,
             'redirect-to': SUCCESS_URL
         }
-        response = requests.post(
-            'http://web:8080/add-systeme-io-contact.php',
+        response = session.post(
+            WEB_URL + '/add-systeme-io-contact.php',
             data=form_data,
             headers={'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8'},
             allow_redirects=False
@@ -69,8 +89,8 @@ class TestPostAddContactPHP(unittest.TestCase):
             'email': TEST_EMAIL,
             'redirect-to': SUCCESS_URL
         }
-        response = requests.post(
-            'http://web:8080/add-systeme-io-contact.php',
+        response = session.post(
+            WEB_URL + '/add-systeme-io-contact.php',
             data=form_data,
             headers={'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8'},
             allow_redirects=False
@@ -86,7 +106,7 @@ class TestPostAddContactPHP(unittest.TestCase):
             'email': TEST_EMAIL,
             'redirect-to': SUCCESS_URL
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 400)
 
     def test_add_new_contact_missing_email(self):
@@ -94,7 +114,7 @@ class TestPostAddContactPHP(unittest.TestCase):
             'first_name': 'John',
             'redirect-to': SUCCESS_URL
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 400)
 
     def test_add_new_contact_invalid_email(self):
@@ -103,7 +123,7 @@ class TestPostAddContactPHP(unittest.TestCase):
             'email': 'test', # Invalid email
             'redirect-to': SUCCESS_URL
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 400)
 
     def test_add_new_contact_missing_redirect_to(self):
@@ -111,7 +131,7 @@ class TestPostAddContactPHP(unittest.TestCase):
             'first_name': 'John',
             'email': TEST_EMAIL
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 400)
 
     def test_add_new_contact_invalid_redirect_to(self):
@@ -120,7 +140,7 @@ class TestPostAddContactPHP(unittest.TestCase):
             'email': TEST_EMAIL,
             'redirect-to': 'invalid-url' # Invalid URL
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 400)
 
     def test_add_new_contact_the_way_a_bot_would_do_it(self):
@@ -131,7 +151,7 @@ class TestPostAddContactPHP(unittest.TestCase):
             'email': TEST_EMAIL,
             'redirect-to': SUCCESS_URL
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 400)
 
     def test_add_contact_and_assign_tag(self):
@@ -141,7 +161,7 @@ class TestPostAddContactPHP(unittest.TestCase):
             'redirect-to': SUCCESS_URL,
             'tags': 'tag1'
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 303)
         self.assertEqual(response.headers['Location'], form_data['redirect-to'])
         contact = self.assert_get_contact_succeeds(form_data['email'])
@@ -154,7 +174,7 @@ class TestPostAddContactPHP(unittest.TestCase):
             'redirect-to': SUCCESS_URL,
             'tags': 'tag1,tag2'
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 303)
         self.assertEqual(response.headers['Location'], form_data['redirect-to'])
         contact = self.assert_get_contact_succeeds(form_data['email'])
@@ -167,12 +187,12 @@ class TestPostAddContactPHP(unittest.TestCase):
             'redirect-to': SUCCESS_URL,
             'tags': 'tag1'
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 303)
         self.assertEqual(response.headers['Location'], form_data['redirect-to'])
 
         # Subscribe again, with the same tag
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 303)
         self.assertEqual(response.headers['Location'], form_data['redirect-to'])
         contact = self.assert_get_contact_succeeds(form_data['email'])
@@ -185,13 +205,13 @@ class TestPostAddContactPHP(unittest.TestCase):
             'redirect-to': SUCCESS_URL,
             'tags': 'tag1'
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 303)
         self.assertEqual(response.headers['Location'], form_data['redirect-to'])
 
         # Subscribe again, with a different tag
         form_data['tags'] = 'tag2'
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 303)
         self.assertEqual(response.headers['Location'], form_data['redirect-to'])
         contact = self.assert_get_contact_succeeds(form_data['email'])
@@ -204,13 +224,13 @@ class TestPostAddContactPHP(unittest.TestCase):
             'first_name': ''
         }
 
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 303)
         self.assertEqual(response.headers['Location'], form_data['redirect-to'])
 
         # Update the contact's first name
         form_data['first_name'] = 'John'
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 303)
         self.assertEqual(response.headers['Location'], form_data['redirect-to'])
 
@@ -224,13 +244,13 @@ class TestPostAddContactPHP(unittest.TestCase):
             'redirect-to': SUCCESS_URL,
             'first_name': 'John'
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 303)
         self.assertEqual(response.headers['Location'], form_data['redirect-to'])
 
         # Update the contact's first name
         form_data['first_name'] = 'Jane'
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 303)
         self.assertEqual(response.headers['Location'], form_data['redirect-to'])
 
@@ -242,16 +262,16 @@ class TestPostAddContactPHP(unittest.TestCase):
         pass
 
     def test_add_contact_indicates_success_and_notifies_with_mention_when_api_is_broken(self):
-        requests.post('http://localhost:8081/test/break')
+        session.post(MOCK_URL + '/test/break')
         form_data = {
             'email': TEST_EMAIL,
             'redirect-to': SUCCESS_URL
         }
-        response = requests.post('http://web:8080/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
         self.assertEqual(response.status_code, 303)
         self.assertEqual(response.headers['Location'], SUCCESS_URL)
 
-        slack_payloads = requests.get('http://localhost:8081/test/slack/payloads').json()
+        slack_payloads = session.get(MOCK_URL + '/test/slack/payloads').json()
         self.assertEqual(len(slack_payloads), 1)
         self.assertIn('error', slack_payloads[0]['text'])
         self.assertIn('@someone', slack_payloads[0]['text'])
@@ -262,7 +282,7 @@ class TestPostAddContactPHP(unittest.TestCase):
     # --- Utility Functions ---
 
     def assert_get_contact_succeeds(self, email):
-        response = requests.get('http://localhost:8081/api/contacts?email=' + email, headers={"X-API-Key":"123"})
+        response = session.get(MOCK_URL + '/api/contacts?email=' + email, headers={"X-API-Key":"123"})
         contact = response.json()['items'][0]
         self.assertEqual(contact['email'], email)
         return contact
@@ -272,5 +292,766 @@ class TestPostAddContactPHP(unittest.TestCase):
         for tag in list(tag['name'] for tag in contact['tags']):
             self.assertIn(tag, tags)
 
+class TestTagCache(unittest.TestCase):
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+        response = session.get(WEB_URL + '/add-systeme-io-contact.php?clear-tag-cache&reset-circuit-breaker&reset-notifications', headers=DRAIN_HEADERS)
+        self.assertIn('Tag cache cleared', response.text)
+
+    def submit(self, email, tags):
+        form_data = {
+            'email': email,
+            'redirect-to': SUCCESS_URL,
+            'tags': tags
+        }
+        return session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+
+    def get_tag_lookups(self):
+        return session.get(MOCK_URL + '/test/calls').json().get('GET /api/tags', 0)
+
+    def test_repeat_submissions_make_no_tag_lookups(self):
+        response = self.submit(TEST_EMAIL, 'tag1,tag2')
+        self.assertEqual(response.status_code, 303)
+        self.assertEqual(self.get_tag_lookups(), 2)
+
+        response = self.submit('test2@example.com', 'tag1,tag2')
+        self.assertEqual(response.status_code, 303)
+        self.assertEqual(self.get_tag_lookups(), 2)
+
+        contact = session.get(MOCK_URL + '/api/contacts?email=test2@example.com', headers={"X-API-Key":"123"}).json()['items'][0]
+        self.assertEqual(sorted(tag['name'] for tag in contact['tags']), ['tag1', 'tag2'])
+
+    def test_only_uncached_tags_are_looked_up(self):
+        self.submit(TEST_EMAIL, 'tag1')
+        self.submit(TEST_EMAIL, 'tag1,tag2')
+        self.assertEqual(self.get_tag_lookups(), 2)
+
+    def test_unknown_tag_is_looked_up_every_time(self):
+        for _ in range(2):
+            response = self.submit(TEST_EMAIL, 'unknown')
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get_tag_lookups(), 2)
+
+    def test_clear_tag_cache(self):
+        self.submit(TEST_EMAIL, 'tag1')
+        session.get(WEB_URL + '/add-systeme-io-contact.php?clear-tag-cache', headers=DRAIN_HEADERS)
+        self.submit(TEST_EMAIL, 'tag1')
+        self.assertEqual(self.get_tag_lookups(), 2)
+
+    def test_clear_tag_cache_needs_the_drain_token(self):
+        self.submit(TEST_EMAIL, 'tag1')
+        response = session.get(WEB_URL + '/add-systeme-io-contact.php?clear-tag-cache')
+        self.assertNotIn('Tag cache cleared', response.text)
+        self.submit(TEST_EMAIL, 'tag1')
+        self.assertEqual(self.get_tag_lookups(), 1)
+
+    def test_concurrent_submissions_keep_each_others_tags_cached(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            list(executor.map(lambda tag: self.submit(f'{tag}@example.com', tag), ['tag1', 'tag2', 'tag3']))
+        self.submit(TEST_EMAIL, 'tag1,tag2,tag3')
+        self.assertEqual(self.get_tag_lookups(), 3)
+
+
+class TestParallelTagCalls(unittest.TestCase):
+    TAG_LOOKUP = 'GET /api/tags'
+    TAG_ASSIGNMENT = 'POST /api/contacts/<int:contact_id>/tags'
+
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+        session.get(WEB_URL + '/add-systeme-io-contact.php?clear-tag-cache&reset-circuit-breaker&reset-notifications', headers=DRAIN_HEADERS)
+        latency = {'latency': {'distribution': 'uniform', 'min': 0.3, 'max': 0.3}}
+        session.post(MOCK_URL + '/test/faults', json={self.TAG_LOOKUP: latency, self.TAG_ASSIGNMENT: latency})
+
+    def submit(self, tags):
+        form_data = {
+            'email': TEST_EMAIL,
+            'redirect-to': SUCCESS_URL,
+            'tags': tags
+        }
+        return session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+
+    def test_tag_calls_run_in_parallel(self):
+        start = time.perf_counter()
+        response = self.submit('tag1,tag2,tag3')
+        elapsed = time.perf_counter() - start
+        self.assertEqual(response.status_code, 303)
+
+        concurrency = session.get(MOCK_URL + '/test/concurrency').json()
+        self.assertEqual(concurrency[self.TAG_LOOKUP]['max'], 3)
+        self.assertEqual(concurrency[self.TAG_ASSIGNMENT]['max'], 3)
+        # Three lookups and three assignments one at a time would take at least 1.8 seconds
+        self.assertLess(elapsed, 1.2)
+
+        contact = session.get(MOCK_URL + '/api/contacts?email=' + TEST_EMAIL, headers={"X-API-Key":"123"}).json()['items'][0]
+        self.assertEqual(sorted(tag['name'] for tag in contact['tags']), ['tag1', 'tag2', 'tag3'])
+
+    def test_unknown_tag_among_others(self):
+        response = self.submit('tag1,unknown,tag2')
+        self.assertEqual(response.status_code, 400)
+
+    def test_failed_assignment_is_spooled(self):
+        session.post(MOCK_URL + '/test/faults', json={self.TAG_ASSIGNMENT: {'failureRate': 1}})
+        response = self.submit('tag1,tag2')
+        self.assertEqual(response.status_code, 303)
+        self.assertEqual(response.headers['Location'], SUCCESS_URL)
+        self.assertIn('Spooled submissions: 1', session.get(WEB_URL + '/add-systeme-io-contact.php').text)
+
+
+class TestConnectionReuse(unittest.TestCase):
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+        session.get(WEB_URL + '/add-systeme-io-contact.php?clear-tag-cache&reset-circuit-breaker&reset-notifications', headers=DRAIN_HEADERS)
+
+    def submit(self, form_data):
+        form_data = dict(form_data, email=TEST_EMAIL)
+        form_data['redirect-to'] = SUCCESS_URL
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        self.assertEqual(response.status_code, 303)
+
+    def get_connection_count(self):
+        return session.get(MOCK_URL + '/test/connections').json()['connections']
+
+    def get_call_count(self):
+        return sum(session.get(MOCK_URL + '/test/calls').json().values())
+
+    def test_sequential_calls_share_one_connection(self):
+        self.submit({'first_name': 'John'})
+        session.post(MOCK_URL + '/test/reset')
+
+        # Look up the contact, then change its name
+        self.submit({'first_name': 'Jane'})
+        self.assertEqual(self.get_call_count(), 2)
+        self.assertEqual(self.get_connection_count(), 1)
+
+    def test_concurrent_calls_open_at_most_one_connection_each(self):
+        # Look up and create the contact, then look up and assign three tags
+        self.submit({'tags': 'tag1,tag2,tag3'})
+        self.assertEqual(self.get_call_count(), 8)
+        self.assertLessEqual(self.get_connection_count(), 3)
+
+
+class TestLatencyProbe(unittest.TestCase):
+    TAG_LOOKUP = 'GET /api/tags'
+    # Set in the script
+    TIME_LIMIT = 5
+
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+        session.get(WEB_URL + '/add-systeme-io-contact.php?reset-circuit-breaker', headers=DRAIN_HEADERS)
+        latency = {'latency': {'distribution': 'uniform', 'min': 0.1, 'max': 0.1}}
+        session.post(MOCK_URL + '/test/faults', json={self.TAG_LOOKUP: latency})
+
+    def get_calls(self):
+        return session.get(MOCK_URL + '/test/calls').json()
+
+    def test_diagnose_makes_no_calls_unless_asked_to_probe(self):
+        response = session.get(WEB_URL + '/add-systeme-io-contact.php')
+        self.assertNotIn('Probe:', response.text)
+        self.assertEqual(self.get_calls(), {})
+
+    def test_probe_reports_timings_as_json(self):
+        probe = session.get(WEB_URL + '/add-systeme-io-contact.php?probe&samples=4&format=json', headers=DRAIN_HEADERS).json()
+        self.assertEqual(self.get_calls()[self.TAG_LOOKUP], 4)
+        self.assertEqual(probe['samples'], 4)
+        self.assertIsNone(probe['stopped'])
+        self.assertEqual(probe['statuses'], {'200': 4})
+        self.assertEqual(probe['errors'], [])
+        # The first call opens the connection, the others reuse it
+        self.assertGreaterEqual(probe['reusedConnections'], 3)
+        self.assertEqual(set(probe['timings']), {'dns', 'connect', 'tls', 'firstByte', 'total'})
+        for timing in probe['timings'].values():
+            self.assertLessEqual(timing['min'], timing['median'])
+            self.assertLessEqual(timing['median'], timing['max'])
+        # The mock answers after 100ms
+        self.assertGreaterEqual(probe['timings']['firstByte']['min'], 100)
+        self.assertGreaterEqual(probe['timings']['total']['min'], probe['timings']['firstByte']['min'])
+
+    def test_probe_is_shown_without_anything_sensitive(self):
+        response = session.get(WEB_URL + '/add-systeme-io-contact.php?probe&samples=100', headers=DRAIN_HEADERS)
+        self.assertIn('Probe: 20 calls to GET /api/tags', response.text)
+        self.assertIn('firstByte', response.text)
+        self.assertIn('"reusedConnections"', response.text)
+        # Neither the API key nor the tags that the API returned
+        self.assertNotIn('0' * 64, response.text)
+        self.assertNotIn('tag1', response.text)
+
+    def test_probe_needs_the_drain_token(self):
+        response = session.get(WEB_URL + '/add-systeme-io-contact.php?probe')
+        self.assertIn('Ignored probe', response.text)
+        self.assertNotIn('Probe:', response.text)
+        self.assertEqual(self.get_calls(), {})
+
+    def test_probe_stops_at_its_time_limit(self):
+        latency = {'latency': {'distribution': 'uniform', 'min': 2, 'max': 2}}
+        session.post(MOCK_URL + '/test/faults', json={self.TAG_LOOKUP: latency})
+        start = time.perf_counter()
+        probe = session.get(WEB_URL + '/add-systeme-io-contact.php?probe&samples=20&format=json', headers=DRAIN_HEADERS).json()
+        self.assertLess(time.perf_counter() - start, self.TIME_LIMIT + 0.5)
+        self.assertLess(probe['samples'], 20)
+        self.assertEqual(probe['stopped'], f'time limit of {self.TIME_LIMIT}s reached')
+
+    def test_probe_makes_no_calls_while_the_circuit_is_open(self):
+        session.post(MOCK_URL + '/test/break')
+        for _ in range(2):
+            session.post(WEB_URL + '/add-systeme-io-contact.php', data={'email': TEST_EMAIL, 'redirect-to': SUCCESS_URL},
+                         allow_redirects=False)
+        calls = self.get_calls().get(self.TAG_LOOKUP, 0)
+        probe = session.get(WEB_URL + '/add-systeme-io-contact.php?probe&format=json', headers=DRAIN_HEADERS).json()
+        self.assertEqual(probe['samples'], 0)
+        self.assertEqual(probe['stopped'], 'circuit breaker is open')
+        self.assertEqual(self.get_calls().get(self.TAG_LOOKUP, 0), calls)
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        # Send off whatever earlier tests left in the spool, then start from a clean mock
+        self.repair()
+        self.drain()
+        self.repair()
+        session.get(WEB_URL + '/add-systeme-io-contact.php?clear-tag-cache', headers=DRAIN_HEADERS)
+
+    # Make the API work again, without waiting for the circuit breaker to let calls through
+    def repair(self):
+        session.post(MOCK_URL + '/test/reset')
+        session.get(WEB_URL + '/add-systeme-io-contact.php?reset-circuit-breaker&reset-notifications', headers=DRAIN_HEADERS)
+
+    def submit(self, tags=''):
+        form_data = {
+            'email': TEST_EMAIL,
+            'first_name': 'John',
+            'redirect-to': SUCCESS_URL,
+            'tags': tags
+        }
+        return session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+
+    def drain(self, token='test-drain-token'):
+        return session.post(WEB_URL + '/add-systeme-io-contact.php', headers={'X-Drain-Token': token})
+
+    def get_contact(self):
+        response = session.get(MOCK_URL + '/api/contacts?email=' + TEST_EMAIL, headers={"X-API-Key":"123"})
+        items = response.json()['items']
+        return items[0] if items else None
+
+    def test_submission_is_spooled_while_api_is_broken_and_sent_by_drain(self):
+        session.post(MOCK_URL + '/test/break')
+        response = self.submit('tag1,tag2')
+        self.assertEqual(response.status_code, 303)
+        self.assertEqual(response.headers['Location'], SUCCESS_URL)
+
+        self.repair()
+        response = self.drain()
+        self.assertEqual(response.json(), {'succeeded': 1, 'retried': 0, 'poisoned': 0, 'remaining': 0})
+        contact = self.get_contact()
+        self.assertEqual(contact['fields'], [{'slug': 'first_name', 'value': 'John'}])
+        self.assertEqual(sorted(tag['name'] for tag in contact['tags']), ['tag1', 'tag2'])
+
+    def test_drain_keeps_submissions_while_api_is_broken(self):
+        session.post(MOCK_URL + '/test/break')
+        self.submit()
+        self.submit()
+
+        response = self.drain()
+        self.assertEqual(response.json()['succeeded'], 0)
+        self.assertEqual(response.json()['remaining'], 2)
+
+        self.repair()
+        response = self.drain()
+        self.assertEqual(response.json(), {'succeeded': 2, 'retried': 0, 'poisoned': 0, 'remaining': 0})
+        self.assertIsNotNone(self.get_contact())
+
+    def test_drain_is_limited_to_max_submissions(self):
+        session.post(MOCK_URL + '/test/break')
+        for _ in range(3):
+            self.submit()
+        self.repair()
+
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php?max=2', headers={'X-Drain-Token': 'test-drain-token'})
+        self.assertEqual(response.json(), {'succeeded': 2, 'retried': 0, 'poisoned': 0, 'remaining': 1})
+        response = self.drain()
+        self.assertEqual(response.json(), {'succeeded': 1, 'retried': 0, 'poisoned': 0, 'remaining': 0})
+
+    def test_rejected_submission_is_moved_aside(self):
+        # The tag lookup fails while the API is broken, so whether the tag exists is not known until the drain
+        session.post(MOCK_URL + '/test/break')
+        self.submit('unknown')
+        self.repair()
+
+        response = self.drain()
+        self.assertEqual(response.json(), {'succeeded': 0, 'retried': 0, 'poisoned': 1, 'remaining': 0})
+        response = self.drain()
+        self.assertEqual(response.json(), {'succeeded': 0, 'retried': 0, 'poisoned': 0, 'remaining': 0})
+
+    def test_drain_requires_token(self):
+        self.assertEqual(self.drain('wrong').status_code, 403)
+
+
+class TestRetriesAndCircuitBreaker(unittest.TestCase):
+    CONTACT_LOOKUP = 'GET /api/contacts'
+
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+        session.get(WEB_URL + '/add-systeme-io-contact.php?clear-tag-cache&reset-circuit-breaker&reset-notifications', headers=DRAIN_HEADERS)
+
+    def submit(self):
+        form_data = {
+            'email': TEST_EMAIL,
+            'redirect-to': SUCCESS_URL
+        }
+        start = time.perf_counter()
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, allow_redirects=False)
+        self.assertEqual(response.status_code, 303)
+        return time.perf_counter() - start
+
+    def get_calls(self):
+        return session.get(MOCK_URL + '/test/calls').json()
+
+    # Calls to systeme.io, without the Slack notifications about the failed ones
+    def get_api_call_count(self):
+        return sum(count for route, count in self.get_calls().items() if 'chat.postMessage' not in route)
+
+    def get_circuit_state(self):
+        response = session.get(WEB_URL + '/add-systeme-io-contact.php')
+        return response.text.split('Circuit breaker: ')[1].split('\n')[0]
+
+    def test_failed_lookup_is_retried(self):
+        session.post(MOCK_URL + '/test/faults', json={self.CONTACT_LOOKUP: {'failureRate': 1}})
+        self.submit()
+        self.assertEqual(self.get_calls()[self.CONTACT_LOOKUP], 3)
+
+    def test_retry_after_is_honored(self):
+        # One lookup a second: the second submission is asked to wait a second, then goes through
+        session.post(MOCK_URL + '/test/faults', json={self.CONTACT_LOOKUP: {'rateLimit': {'rate': 1, 'burst': 1}}})
+        self.submit()
+        elapsed = self.submit()
+        self.assertGreaterEqual(elapsed, 0.9)
+        self.assertEqual(self.get_calls()[self.CONTACT_LOOKUP], 3)
+        contact = session.get(MOCK_URL + '/api/contacts?email=' + TEST_EMAIL, headers={"X-API-Key":"123"}).json()['items'][0]
+        self.assertEqual(contact['email'], TEST_EMAIL)
+
+    def test_circuit_opens_and_later_closes(self):
+        session.post(MOCK_URL + '/test/break')
+        # Three failed lookups and a failed create, then a failed lookup opens the breaker
+        self.submit()
+        self.submit()
+        self.assertEqual(self.get_circuit_state(), 'open')
+        calls = self.get_api_call_count()
+
+        # While the breaker is open, submissions are spooled without calling the API
+        elapsed = self.submit()
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(self.get_api_call_count(), calls)
+
+        # Once the breaker has been open for two seconds (set in the Makefile), a submission tries the API again
+        session.post(MOCK_URL + '/test/reset')
+        time.sleep(2.1)
+        self.assertEqual(self.get_circuit_state(), 'half-open')
+        self.submit()
+        self.assertEqual(self.get_circuit_state(), 'closed')
+        self.assertEqual(self.get_calls()[self.CONTACT_LOOKUP], 1)
+
+    def test_reset_circuit_breaker_needs_the_drain_token(self):
+        session.post(MOCK_URL + '/test/break')
+        self.submit()
+        self.submit()
+        response = session.get(WEB_URL + '/add-systeme-io-contact.php?reset-circuit-breaker')
+        self.assertIn('Ignored reset-circuit-breaker', response.text)
+        self.assertEqual(self.get_circuit_state(), 'open')
+
+        session.get(WEB_URL + '/add-systeme-io-contact.php?reset-circuit-breaker', headers=DRAIN_HEADERS)
+        self.assertEqual(self.get_circuit_state(), 'closed')
+
+
+class TestSubmissionDeadline(unittest.TestCase):
+    # A test run of its own, so that the submissions spooled here do not end up in the spool of other tests
+    TEST_RUN = {'X-Test-Run': os.environ.get('TEST_RUN', '') + 'deadline'}
+    # Set in the Makefile
+    DEADLINE = 3
+    # For the round trip between the tests and the web container
+    MARGIN = 0.3
+    CONTACT_ROUTES = ['GET /api/contacts', 'POST /api/contacts']
+    TAG_ROUTES = ['GET /api/tags', 'POST /api/contacts/<int:contact_id>/tags']
+
+    def setUp(self):
+        self.repair()
+        self.drain()
+        self.repair()
+        session.get(WEB_URL + '/add-systeme-io-contact.php?clear-tag-cache', headers=dict(self.TEST_RUN, **DRAIN_HEADERS))
+
+    def repair(self):
+        session.post(MOCK_URL + '/test/reset', headers=self.TEST_RUN)
+        session.get(WEB_URL + '/add-systeme-io-contact.php?reset-circuit-breaker&reset-notifications', headers=dict(self.TEST_RUN, **DRAIN_HEADERS))
+
+    def drain(self):
+        return session.post(WEB_URL + '/add-systeme-io-contact.php', headers=dict(self.TEST_RUN, **{'X-Drain-Token': 'test-drain-token'}))
+
+    def set_faults(self, routes, seconds, **fault):
+        latency = {'latency': {'distribution': 'uniform', 'min': seconds, 'max': seconds}}
+        session.post(MOCK_URL + '/test/faults', json={route: dict(latency, **fault) for route in routes}, headers=self.TEST_RUN)
+
+    # Submit and check that the visitor is redirected within the deadline, whatever the API does. Return the time taken.
+    def submit(self, tags=''):
+        form_data = {
+            'email': TEST_EMAIL,
+            'first_name': 'John',
+            'redirect-to': SUCCESS_URL,
+            'tags': tags
+        }
+        start = time.perf_counter()
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, headers=self.TEST_RUN, allow_redirects=False)
+        elapsed = time.perf_counter() - start
+        self.assertEqual(response.status_code, 303)
+        self.assertEqual(response.headers['Location'], SUCCESS_URL)
+        self.assertLess(elapsed, self.DEADLINE + self.MARGIN)
+        return elapsed
+
+    def get_spooled_count(self):
+        response = session.get(WEB_URL + '/add-systeme-io-contact.php', headers=self.TEST_RUN)
+        return int(response.text.split('Spooled submissions: ')[1].split('\n')[0])
+
+    # Make the API fast again and check that the drain completes the submission
+    def assert_completed_by_drain(self, tags=()):
+        self.repair()
+        self.assertEqual(self.drain().json()['succeeded'], 1)
+        response = session.get(MOCK_URL + '/api/contacts?email=' + TEST_EMAIL, headers=dict(self.TEST_RUN, **{"X-API-Key": "123"}))
+        contact = response.json()['items'][0]
+        self.assertEqual(contact['fields'], [{'slug': 'first_name', 'value': 'John'}])
+        self.assertEqual(sorted(tag['name'] for tag in contact['tags']), sorted(tags))
+
+    def test_hanging_call_is_cut_off_at_the_deadline(self):
+        # Without the deadline, the lookup would wait for its own timeout
+        self.set_faults(['GET /api/contacts'], 5)
+        self.submit()
+        self.assertEqual(self.get_spooled_count(), 1)
+        self.assert_completed_by_drain()
+
+    def test_deadline_spans_all_calls_of_a_submission(self):
+        # Each call is well within a timeout of its own, but the four rounds of calls together are not
+        self.set_faults(self.CONTACT_ROUTES + self.TAG_ROUTES, 0.6)
+        self.submit('tag1,tag2,tag3')
+        self.assertEqual(self.get_spooled_count(), 1)
+        self.assert_completed_by_drain(['tag1', 'tag2', 'tag3'])
+
+    def test_no_retry_is_started_past_the_deadline(self):
+        # Three slow failing lookups and the delays between them would take longer than the deadline
+        self.set_faults(['GET /api/contacts'], 0.9, failureRate=1)
+        self.submit()
+        self.assertLess(session.get(MOCK_URL + '/test/calls', headers=self.TEST_RUN).json()['GET /api/contacts'], 3)
+        self.assertEqual(self.get_spooled_count(), 1)
+        self.assert_completed_by_drain()
+
+    def test_fast_submission_is_not_affected(self):
+        self.submit('tag1')
+        self.assertEqual(self.get_spooled_count(), 0)
+
+
+class TestErrorNotifications(unittest.TestCase):
+    # A test run of its own, so that the submissions spooled here do not end up in the spool of other tests
+    TEST_RUN = {'X-Test-Run': os.environ.get('TEST_RUN', '') + 'notifications'}
+    # Set in the Makefile
+    NOTIFY_INTERVAL = 2
+
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset', headers=self.TEST_RUN)
+        session.get(WEB_URL + '/add-systeme-io-contact.php?reset-circuit-breaker&reset-notifications', headers=dict(self.TEST_RUN, **DRAIN_HEADERS))
+
+    def submit(self, i=0):
+        form_data = {
+            'email': f'flood{i}@example.com',
+            'redirect-to': SUCCESS_URL
+        }
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, headers=self.TEST_RUN, allow_redirects=False)
+        self.assertEqual(response.status_code, 303)
+
+    def get_slack_payloads(self):
+        return session.get(MOCK_URL + '/test/slack/payloads', headers=self.TEST_RUN).json()
+
+    def test_errors_are_coalesced(self):
+        session.post(MOCK_URL + '/test/break', headers=self.TEST_RUN)
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
+            list(executor.map(self.submit, range(1000)))
+        elapsed = time.perf_counter() - start
+        # The first error is reported at once, then at most one message per interval
+        payloads = self.get_slack_payloads()
+        self.assertGreaterEqual(len(payloads), 1)
+        self.assertLessEqual(len(payloads), elapsed // self.NOTIFY_INTERVAL + 1)
+
+        # Once the interval has passed, the next submission reports the rest, so that every error is counted once
+        session.post(MOCK_URL + '/test/reset', headers=self.TEST_RUN)
+        session.get(WEB_URL + '/add-systeme-io-contact.php?reset-circuit-breaker', headers=dict(self.TEST_RUN, **DRAIN_HEADERS))
+        time.sleep(self.NOTIFY_INTERVAL + 0.1)
+        self.submit()
+        payloads = payloads + self.get_slack_payloads()
+        self.assertEqual(sum(int(re.search(r'errors: (\d+)', payload['text'])[1]) for payload in payloads), 1000)
+        for payload in payloads:
+            self.assertIn('@someone', payload['text'])
+            self.assertEqual(payload['channel'], '#api-errors')
+
+    def test_no_notification_without_errors(self):
+        self.submit()
+        time.sleep(self.NOTIFY_INTERVAL + 0.1)
+        self.submit()
+        self.assertEqual(self.get_slack_payloads(), [])
+
+    def test_pending_errors_are_kept_without_the_drain_token(self):
+        session.post(MOCK_URL + '/test/break', headers=self.TEST_RUN)
+        # The first error is reported at once, the second one is held back
+        self.submit(1)
+        self.submit(2)
+        response = session.get(WEB_URL + '/add-systeme-io-contact.php?reset-notifications', headers=self.TEST_RUN)
+        self.assertIn('Ignored reset-notifications', response.text)
+
+        payloads = self.get_slack_payloads()
+        session.post(MOCK_URL + '/test/reset', headers=self.TEST_RUN)
+        session.get(WEB_URL + '/add-systeme-io-contact.php?reset-circuit-breaker', headers=dict(self.TEST_RUN, **DRAIN_HEADERS))
+        time.sleep(self.NOTIFY_INTERVAL + 0.1)
+        self.submit(3)
+        payloads = payloads + self.get_slack_payloads()
+        self.assertEqual([int(re.search(r'errors: (\d+)', payload['text'])[1]) for payload in payloads], [1, 1])
+
+
+class TestImport(unittest.TestCase):
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+        session.get(WEB_URL + '/add-systeme-io-contact.php?clear-tag-cache&reset-circuit-breaker&reset-notifications', headers=DRAIN_HEADERS)
+
+    def import_contacts(self, data, query=''):
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php?import' + query, data=data.encode(),
+                                headers={'X-Drain-Token': 'test-drain-token'})
+        self.assertEqual(response.status_code, 200, response.text)
+        return response.json()
+
+    def get_contact(self, email):
+        response = session.get(MOCK_URL + '/api/contacts?email=' + email, headers={"X-API-Key":"123"})
+        items = response.json()['items']
+        return items[0] if items else None
+
+    def get_calls(self):
+        return session.get(MOCK_URL + '/test/calls').json()
+
+    def test_csv_is_imported_with_the_rules_of_the_form(self):
+        session.post(WEB_URL + '/add-systeme-io-contact.php', data={'email': 'old@example.com', 'first_name': 'Old',
+                     'redirect-to': SUCCESS_URL, 'tags': 'tag1'}, allow_redirects=False)
+        tag_lookups = self.get_calls()['GET /api/tags']
+        summary = self.import_contacts('email,first_name,tags\n'
+                                       'new@example.com,Håkan,"tag1,tag2"\n'
+                                       'old@example.com,,tag1\n'
+                                       'old@example.com,New,tag1\n'
+                                       'not-an-email,John,\n'
+                                       'unknown@example.com,,nosuchtag\n')
+        self.assertEqual(summary['created'], 1)
+        self.assertEqual(summary['unchanged'], 1)
+        self.assertEqual(summary['updated'], 1)
+        self.assertEqual(summary['invalid'], 2)
+        self.assertEqual(summary['failed'], 0)
+        self.assertEqual(summary['remaining'], 0)
+        self.assertEqual(summary['errors'], [{'row': 4, 'error': 'Invalid email'}, {'row': 5, 'error': 'Unknown tag: nosuchtag'}])
+
+        contact = self.get_contact('new@example.com')
+        self.assertEqual(contact['fields'], [{'slug': 'first_name', 'value': 'Håkan'}])
+        self.assertEqual(sorted(tag['name'] for tag in contact['tags']), ['tag1', 'tag2'])
+        self.assertEqual(self.get_contact('old@example.com')['fields'], [{'slug': 'first_name', 'value': 'New'}])
+        self.assertIsNone(self.get_contact('unknown@example.com'))
+        # Each tag is looked up once for the whole import
+        self.assertEqual(self.get_calls()['GET /api/tags'] - tag_lookups, 3)
+
+    def test_json_lines_are_imported(self):
+        summary = self.import_contacts('{"email": "a@example.com", "tags": ["tag1", "tag3"]}\n'
+                                       '{"email": "b@example.com", "first_name": "Jane"}\n')
+        self.assertEqual(summary['created'], 2)
+        self.assertEqual(sorted(tag['name'] for tag in self.get_contact('a@example.com')['tags']), ['tag1', 'tag3'])
+
+    def test_import_resumes_from_checkpoint(self):
+        data = 'email,tags\n' + ''.join(f'resume{i}@example.com,tag1\n' for i in range(120))
+        summary = self.import_contacts(data, '&max=60')
+        self.assertEqual(summary['created'], 60)
+        self.assertEqual(summary['remaining'], 60)
+
+        summary = self.import_contacts(data)
+        self.assertEqual(summary['created'], 120)
+        self.assertEqual(summary['remaining'], 0)
+        # Every contact was looked up and added once
+        self.assertEqual(self.get_calls()['POST /api/contacts'], 120)
+        self.assertIsNotNone(self.get_contact('resume119@example.com'))
+
+        # Once finished, the same data is imported again from the start, and nothing changes
+        summary = self.import_contacts(data)
+        self.assertEqual(summary['unchanged'], 120)
+
+    def test_import_slows_down_when_rate_limited(self):
+        session.post(MOCK_URL + '/test/faults', json={'POST /api/contacts': {'rateLimit': {'rate': 20, 'burst': 5}}})
+        data = 'email\n' + ''.join(f'limited{i}@example.com\n' for i in range(60))
+        summary = self.import_contacts(data, '&concurrency=16')
+        self.assertEqual(summary['created'], 60)
+        self.assertEqual(summary['failed'], 0)
+        self.assertGreater(summary['rateLimited'], 0)
+        self.assertLess(summary['concurrency'], 16)
+
+    def test_import_requires_token(self):
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php?import', data=b'email\n',
+                                headers={'X-Drain-Token': 'wrong'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_csv_without_email_column_is_rejected(self):
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php?import', data=b'name\nJohn\n',
+                                headers={'X-Drain-Token': 'test-drain-token'})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestCallBudgets(unittest.TestCase):
+    # The systeme.io calls that each scenario may make, in order, and the request body bytes it may send.
+    # A change that needs more has to raise the budget in call_budgets.json, so that the cost shows in review.
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'call_budgets.json')) as f:
+        BUDGETS = json.load(f)
+
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+        session.get(WEB_URL + '/add-systeme-io-contact.php?clear-tag-cache&reset-circuit-breaker&reset-notifications', headers=DRAIN_HEADERS)
+
+    def add_contact(self, first_name):
+        contact = {'email': TEST_EMAIL, 'fields': [{'slug': 'first_name', 'value': first_name}]}
+        session.post(MOCK_URL + '/api/contacts', json=contact, headers={"X-API-Key":"123"})
+
+    # Submit the form and return the systeme.io calls that the submission made
+    def submit(self, first_name='', tags='', strategy='lookup-first'):
+        calls_before = len(session.get(MOCK_URL + '/test/requests').json())
+        form_data = {
+            'email': TEST_EMAIL,
+            'first_name': first_name,
+            'redirect-to': SUCCESS_URL,
+            'tags': tags
+        }
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, headers={'X-Upsert-Strategy': strategy},
+                                allow_redirects=False)
+        self.assertEqual(response.status_code, 303)
+        return session.get(MOCK_URL + '/test/requests').json()[calls_before:]
+
+    def assert_within_budget(self, scenario, calls):
+        budget = self.BUDGETS[scenario]
+        routes = [call['route'] for call in calls]
+        request_bytes = sum(call['requestBytes'] for call in calls)
+        actual = json.dumps({'calls': routes, 'requestBytes': request_bytes})
+        # Calls may be left out, but not added or reordered
+        budgeted_routes = iter(budget['calls'])
+        self.assertTrue(all(route in budgeted_routes for route in routes), f'{scenario} is over its call budget: {actual}')
+        self.assertLessEqual(request_bytes, budget['requestBytes'], f'{scenario} is over its byte budget: {actual}')
+
+    def test_new_contact(self):
+        self.assert_within_budget('new contact', self.submit())
+
+    def test_returning_contact(self):
+        self.add_contact('John')
+        self.assert_within_budget('returning contact', self.submit('John'))
+
+    def test_name_change(self):
+        self.add_contact('John')
+        self.assert_within_budget('name change', self.submit('Jane'))
+
+    def test_three_tags(self):
+        self.assert_within_budget('three tags', self.submit(tags='tag1,tag2,tag3'))
+
+    def test_new_contact_create_first(self):
+        self.assert_within_budget('new contact, create first', self.submit(strategy='create-first'))
+
+    def test_returning_contact_create_first(self):
+        self.add_contact('John')
+        self.assert_within_budget('returning contact, create first', self.submit('John', strategy='create-first'))
+
+    def test_name_change_create_first(self):
+        self.add_contact('John')
+        self.assert_within_budget('name change, create first', self.submit('Jane', strategy='create-first'))
+
+
+class TestUpsertStrategies(unittest.TestCase):
+    # Benchmark the upsert strategies with a realistic round trip to systeme.io on every call
+    SUBMISSIONS = 20
+    ROUND_TRIP = 0.05
+    CONTACT_ROUTES = ['GET /api/contacts', 'POST /api/contacts', 'PATCH /api/contacts/<int:contact_id>']
+
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+        session.get(WEB_URL + '/add-systeme-io-contact.php?reset-circuit-breaker&reset-notifications', headers=DRAIN_HEADERS)
+        latency = {'latency': {'distribution': 'uniform', 'min': self.ROUND_TRIP, 'max': self.ROUND_TRIP}}
+        session.post(MOCK_URL + '/test/faults', json={route: latency for route in self.CONTACT_ROUTES})
+
+    # Submit new or returning contacts with a strategy, and return the calls per submission and the median latency
+    def run_scenario(self, strategy, scenario):
+        emails = [f'{strategy}-{scenario}-{i}@example.com' for i in range(self.SUBMISSIONS)]
+        if scenario == 'returning':
+            for email in emails:
+                session.post(MOCK_URL + '/api/contacts', json={'email': email}, headers={"X-API-Key":"123"})
+        calls_before = sum(session.get(MOCK_URL + '/test/calls').json().values())
+        latencies = []
+        for email in emails:
+            start = time.perf_counter()
+            response = session.post(WEB_URL + '/add-systeme-io-contact.php', data={'email': email, 'redirect-to': SUCCESS_URL},
+                                    headers={'X-Upsert-Strategy': strategy}, allow_redirects=False)
+            latencies.append(time.perf_counter() - start)
+            self.assertEqual(response.status_code, 303)
+        calls = sum(session.get(MOCK_URL + '/test/calls').json().values()) - calls_before
+        return calls / self.SUBMISSIONS, statistics.median(latencies)
+
+    def test_create_first_saves_a_round_trip_for_new_contacts(self):
+        results = {(strategy, scenario): self.run_scenario(strategy, scenario)
+                   for strategy in ['lookup-first', 'create-first'] for scenario in ['new', 'returning']}
+        # The numbers of every strategy and scenario, to compare them when an assertion fails
+        summary = '\n' + '\n'.join(f'{strategy:12} {scenario:9} {calls:.1f} calls {latency * 1000:6.1f} ms'
+                                    for (strategy, scenario), (calls, latency) in results.items())
+
+        self.assertEqual(results[('lookup-first', 'new')][0], 2, summary)
+        self.assertEqual(results[('create-first', 'new')][0], 1, summary)
+        self.assertEqual(results[('lookup-first', 'returning')][0], 1, summary)
+        self.assertEqual(results[('create-first', 'returning')][0], 2, summary)
+        saved = results[('lookup-first', 'new')][1] - results[('create-first', 'new')][1]
+        self.assertGreater(saved, self.ROUND_TRIP / 2, summary)
+        lost = results[('create-first', 'returning')][1] - results[('lookup-first', 'returning')][1]
+        self.assertGreater(lost, self.ROUND_TRIP / 2, summary)
+
+
+class TestTestRun(unittest.TestCase):
+    # Another test run than the one of the session
+    TEST_RUN = {'X-Test-Run': os.environ.get('TEST_RUN', '') + 'other'}
+
+    def setUp(self):
+        session.post(MOCK_URL + '/test/reset')
+        session.post(MOCK_URL + '/test/reset', headers=self.TEST_RUN)
+
+    def get_contacts(self, headers):
+        response = session.get(MOCK_URL + '/api/contacts?email=' + TEST_EMAIL, headers=dict(headers, **{"X-API-Key":"123"}))
+        return response.json()['items']
+
+    def test_submission_goes_to_the_test_run_of_the_request(self):
+        form_data = {
+            'email': TEST_EMAIL,
+            'redirect-to': SUCCESS_URL,
+            'tags': 'tag1'
+        }
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data=form_data, headers=self.TEST_RUN, allow_redirects=False)
+        self.assertEqual(response.status_code, 303)
+
+        self.assertEqual(len(self.get_contacts(self.TEST_RUN)), 1)
+        self.assertEqual(self.get_contacts({}), [])
+
+    def test_broken_api_in_another_test_run_does_not_open_circuit(self):
+        self.addCleanup(session.get, WEB_URL + '/add-systeme-io-contact.php?reset-circuit-breaker',
+                        headers=dict(self.TEST_RUN, **DRAIN_HEADERS))
+        session.post(MOCK_URL + '/test/break', headers=self.TEST_RUN)
+        for _ in range(3):
+            session.post(WEB_URL + '/add-systeme-io-contact.php', data={'email': TEST_EMAIL, 'redirect-to': SUCCESS_URL},
+                         headers=self.TEST_RUN, allow_redirects=False)
+        response = session.get(WEB_URL + '/add-systeme-io-contact.php', headers=self.TEST_RUN)
+        self.assertIn('Circuit breaker: open', response.text)
+
+        # While the circuit of the other test run is open, that of the session's stays closed
+        response = session.get(WEB_URL + '/add-systeme-io-contact.php')
+        self.assertIn('Circuit breaker: closed', response.text)
+        response = session.post(WEB_URL + '/add-systeme-io-contact.php', data={'email': TEST_EMAIL, 'redirect-to': SUCCESS_URL},
+                                allow_redirects=False)
+        self.assertEqual(response.status_code, 303)
+        self.assertEqual(len(self.get_contacts({})), 1)
+        response = session.get(WEB_URL + '/add-systeme-io-contact.php', headers=self.TEST_RUN)
+        self.assertIn('Circuit breaker: open', response.text)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,195 @@
+import argparse
+import json
+import os
+import tempfile
+import unittest
+import requests
+
+import api_mock
+import replay
+
+# The mock to capture from and replay against. Without MOCK_URL, a mock is served from a thread of this process,
+# which also lets the tests capture its request log.
+MOCK_URL = os.environ.get('MOCK_URL')
+mock_server = None
+
+def setUpModule():
+    global MOCK_URL, mock_server
+    if not MOCK_URL:
+        if 'MOCK_LOG_PATH' not in os.environ:
+            api_mock.request_log.sample_rate = 0
+        mock_server = api_mock.serve_in_background()
+        MOCK_URL = mock_server.url
+
+def tearDownModule():
+    if mock_server:
+        mock_server.close()
+
+HEADERS = {'X-API-Key': '123', 'X-Test-Run': 'replay-test-capture'}
+
+def replay_arguments(**overrides):
+    arguments = dict(trace='trace.jsonl', url=None, mock_url=MOCK_URL, speed=0, concurrency=10, test_run=None)
+    return argparse.Namespace(**dict(arguments, **overrides))
+
+
+class TestCapture(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    @unittest.skipIf(os.environ.get('MOCK_URL'), 'needs the request log of a mock served by the tests')
+    def test_mock_log_becomes_trace_of_api_calls(self):
+        path = os.path.join(self.directory.name, 'requests.txt')
+        original_log = api_mock.request_log
+        api_mock.request_log = api_mock.RequestLog(path)
+        try:
+            requests.post(MOCK_URL + '/test/reset', headers=HEADERS)
+            contact = requests.post(MOCK_URL + '/api/contacts', json={'email': 'a@example.com'}, headers=HEADERS).json()
+            requests.post(MOCK_URL + f'/api/contacts/{contact["id"]}/tags', json={'tagId': 1}, headers=HEADERS)
+            requests.get(MOCK_URL + '/api/contacts?email=b@example.com', headers=dict(HEADERS, **{'X-Test-Run': 'other'}))
+            api_mock.request_log.flush()
+        finally:
+            api_mock.request_log = original_log
+
+        header, trace = replay.capture([path], test_run='replay-test-capture')
+        self.assertEqual(header['kind'], 'api')
+        self.assertEqual(header['requests'], 2)
+        [offset, method, path, status, duration, body, created_id, segment] = trace[0]
+        self.assertEqual((offset, method, path, status), (0, 'POST', '/api/contacts', 201))
+        self.assertGreaterEqual(duration, 0)
+        self.assertEqual(json.loads(body), {'email': 'a@example.com'})
+        self.assertEqual(created_id, contact['id'])
+        self.assertEqual(segment, 0)
+        self.assertEqual(trace[1][1:4], ['POST', f'/api/contacts/{contact["id"]}/tags', 204])
+        self.assertGreaterEqual(trace[1][0], 0)
+
+    @unittest.skipIf(os.environ.get('MOCK_URL'), 'needs the request log of a mock served by the tests')
+    def test_resets_start_new_segments(self):
+        path = os.path.join(self.directory.name, 'requests.txt')
+        original_log = api_mock.request_log
+        api_mock.request_log = api_mock.RequestLog(path)
+        try:
+            # As in a test suite, where each test starts with a reset, ids and emails repeat after each reset
+            for email in ['a@example.com', 'b@example.com']:
+                requests.post(MOCK_URL + '/test/reset', headers=HEADERS)
+                requests.post(MOCK_URL + '/api/contacts', json={'email': email}, headers=HEADERS)
+                requests.post(MOCK_URL + '/api/contacts', json={'email': 'c@example.com'}, headers=HEADERS)
+                requests.post(MOCK_URL + '/api/contacts/1/tags', json={'tagId': 1}, headers=HEADERS)
+            api_mock.request_log.flush()
+        finally:
+            api_mock.request_log = original_log
+
+        header, trace = replay.capture([path], test_run='replay-test-capture')
+        self.assertEqual((header['requests'], header['segments']), (6, 2))
+        self.assertEqual([entry[7] for entry in trace], [0, 0, 0, 1, 1, 1])
+        self.assertEqual([entry[6] for entry in trace], [1, 2, None, 1, 2, None])
+
+        # Each segment is replayed from an empty mock, so nothing is a duplicate and the tags go to the first contact of each
+        replayer = replay.Replay(replay_arguments(concurrency=1), header, trace)
+        report = replayer.run()
+        self.assertEqual(report['divergence']['statuses'], 0)
+        for segment, email in enumerate(['a@example.com', 'b@example.com']):
+            contact = requests.get(MOCK_URL + f'/api/contacts?email={email}',
+                                   headers={'X-API-Key': '123', 'X-Test-Run': replayer.segment_test_run(segment)}).json()['items'][0]
+            self.assertEqual([tag['id'] for tag in contact['tags']], [1])
+
+    def test_access_log_becomes_trace_of_form_posts(self):
+        path = self.write('access.log', '\n'.join([
+            '10.0.0.1 - - [18/Oct/2026:12:00:00 +0000] "POST /add-systeme-io-contact.php HTTP/1.1" 303 - 120000',
+            '10.0.0.2 - - [18/Oct/2026:12:00:00 +0000] "POST /add-systeme-io-contact.php HTTP/1.1" 400 14 3000',
+            '10.0.0.3 - - [18/Oct/2026:12:00:00 +0000] "GET /add-systeme-io-contact.php HTTP/1.1" 200 512 1000',
+            '10.0.0.4 - - [18/Oct/2026:12:00:02 +0000] "POST /add-systeme-io-contact.php HTTP/1.1" 303 - '
+            '"https://example.com/" "Mozilla/5.0" 80000',
+            '10.0.0.5 - - [18/Oct/2026:12:00:03 +0000] "POST /other.php HTTP/1.1" 200 10',
+            'not a log line'
+        ]))
+        header, trace = replay.capture([path])
+        self.assertEqual(header['kind'], 'form')
+        self.assertEqual(header['duration'], 2)
+        # The two posts of the first second are spread over it
+        self.assertEqual([entry[0] for entry in trace], [0, 0.5, 2])
+        self.assertEqual([entry[3] for entry in trace], [303, 400, 303])
+        self.assertEqual([entry[4] for entry in trace], [0.12, 0.003, 0.08])
+
+    def test_server_duration(self):
+        response = requests.get(MOCK_URL + '/api/tags', headers=HEADERS)
+        duration = replay.server_duration(response)
+        self.assertGreater(duration, 0)
+        self.assertLess(duration, response.elapsed.total_seconds())
+
+    def test_trace_round_trips(self):
+        header, trace = {'trace': 1, 'kind': 'api', 'requests': 1, 'duration': 0, 'segments': 1, 'start': 0}, [[0, 'GET', '/api/tags', 200, 0.01, None, None, 0]]
+        path = os.path.join(self.directory.name, 'trace.jsonl')
+        with open(path, 'w') as f:
+            replay.write_trace(header, trace, f)
+        self.assertEqual(replay.read_trace(path), (header, trace))
+
+
+class TestReplay(unittest.TestCase):
+    HEADER = {'trace': 1, 'kind': 'api', 'start': 0}
+
+    def run_replay(self, trace, **arguments):
+        header = dict(self.HEADER, requests=len(trace), duration=trace[-1][0])
+        return replay.Replay(replay_arguments(**arguments), header, trace).run()
+
+    def test_contact_ids_are_mapped_to_those_of_the_replay(self):
+        # In the original run, the contact got id 42; in the replay it gets another
+        trace = [
+            [0, 'POST', '/api/contacts', 201, 0.01, '{"email": "a@example.com"}', 42, 0],
+            [0.01, 'POST', '/api/contacts/42/tags', 204, 0.01, '{"tagId": 1}', None, 0],
+            [0.02, 'GET', '/api/contacts?email=a@example.com', 200, 0.01, None, None, 0]
+        ]
+        report = self.run_replay(trace, concurrency=1)
+        self.assertEqual(report['requests'], 3)
+        self.assertEqual(report['divergence']['statuses'], 0)
+        self.assertEqual(set(report['latency']), {'POST /api/contacts', 'POST /api/contacts/<id>/tags', 'GET /api/contacts'})
+        # Like the original latency, the replayed one is the mock's, without the round trip
+        self.assertEqual(report['latencyMeasures'], {'original': 'server', 'replayed': 'server'})
+        self.assertEqual(report['latency']['GET /api/contacts']['replayed']['count'], 1)
+        self.assertIsNotNone(report['latency']['GET /api/contacts']['p95Ratio'])
+
+        contact = requests.get(MOCK_URL + '/api/contacts?email=a@example.com',
+                               headers={'X-API-Key': '123', 'X-Test-Run': report['config']['testRun']}).json()['items'][0]
+        self.assertEqual([tag['id'] for tag in contact['tags']], [1])
+
+    def test_requests_for_a_contact_wait_for_its_create(self):
+        # Replayed as fast as possible, each assignment would otherwise often go out before its contact exists
+        trace = []
+        for i in range(20):
+            trace.append([i * 0.001, 'POST', '/api/contacts', 201, 0.01, json.dumps({'email': f'c{i}@example.com'}), 100 + i, 0])
+            trace.append([i * 0.001, 'POST', f'/api/contacts/{100 + i}/tags', 204, 0.01, '{"tagId": 1}', None, 0])
+        report = self.run_replay(trace, speed=0, concurrency=20)
+        self.assertEqual(report['divergence']['statuses'], 0)
+        self.assertEqual(report['statuses'], {'201': 20, '204': 20})
+
+    def test_status_divergence_is_reported(self):
+        # The second create was accepted in the original run, but is a duplicate in the replay
+        trace = [
+            [0, 'POST', '/api/contacts', 201, 0.01, '{"email": "a@example.com"}', 1, 0],
+            [0.1, 'POST', '/api/contacts', 201, 0.01, '{"email": "a@example.com"}', 2, 0]
+        ]
+        report = self.run_replay(trace, concurrency=1)
+        self.assertEqual(report['divergence']['statuses'], 1)
+        self.assertEqual(report['divergence']['byChange'], {'201 -> 422': 1})
+        self.assertEqual(report['statuses'], {'201': 1, '422': 1})
+
+    def test_timing_is_scaled(self):
+        trace = [[offset, 'GET', '/api/tags', 200, 0.01, None, None, 0] for offset in [0, 0.5, 1.0]]
+        report = self.run_replay(trace, speed=5)
+        self.assertGreaterEqual(report['elapsed'], 0.2)
+        self.assertLess(report['elapsed'], 0.6)
+
+        report = self.run_replay(trace, speed=0)
+        self.assertLess(report['elapsed'], 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()